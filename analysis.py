@@ -0,0 +1,282 @@
+#!python3
+
+"""
+Batch modes of simulator.py:
+ - one program with many configurations: the program is parsed and compiled once,
+   then every configuration is simulated on the same device, or on a pool of
+   processes that compile the program once each.
+ - many programs (a directory or a glob) with one configuration: the files are
+   spread over a pool of processes, each worker loads the configuration once.
+Incremental mode: the checkpoints of a simulation are saved in a session file,
+the next simulation of a modified version of the program only simulates the changes.
+"""
+
+import sys
+import os
+import glob
+import pickle
+import hashlib
+from multiprocessing import Pool
+
+# in order to be able to import code from another directory
+sys.path.append("./device/")
+sys.path.append("./parser/")
+sys.path.append("./config_file/")
+
+from parser_avr_8 import *
+from device import *
+from config import Configuration
+
+def createDevice(program, options={}):
+	""" options: attributes of the device, e.g. {"transitionWarning": True} """
+	device = Device()
+	for name, value in options.items():
+		setattr(device, name, value)
+	device.loadProgram(program, ([], []))
+	return device
+
+def parseProgram(filenameCode, cache=None, options={}):
+	""" returns the instructions of a file and the options of its device,
+		the data symbols of a listing (see avr_8_objdump_parser) name addresses in the configurations
+	"""
+	parser = get_parser(filenameCode, cache)
+	program = parser.parse()
+	if getattr(parser, "symbols", None):
+		options = dict(options, dataSymbols=parser.symbols)
+	return program, options
+
+def analyseConfiguration(device, filenameConfig):
+	"""simulates the program loaded in the device with a configuration, returns the findings"""
+	device.resetState()
+	device.loadConfiguration(Configuration(filenameConfig))
+	device.runProgram()
+	return device.findings
+
+# device of a worker process (the program is compiled once per process)
+workerDevice = None
+
+def initWorker(program, options):
+	global workerDevice
+	workerDevice = createDevice(program, options)
+
+def analyseInWorker(filenameConfig):
+	return analyseConfiguration(workerDevice, filenameConfig)
+
+def analyseConfigurations(program, filenamesConfig, processes=1, options={}):
+	""" program: list of instructions (e.g. avr_8_parser.parse())
+		returns [(filename config, FindingsCollector)] in the order of the configurations
+		(a list: the same filename can be given twice)
+	"""
+	if processes <= 1 or len(filenamesConfig) <= 1:
+		device = createDevice(program, options)
+		return [(filenameConfig, analyseConfiguration(device, filenameConfig)) for filenameConfig in filenamesConfig]
+
+	with Pool(processes, initializer=initWorker, initargs=(program, options)) as pool:
+		results = pool.map(analyseInWorker, filenamesConfig)
+	return list(zip(filenamesConfig, results))
+
+def getAsmFiles(path):
+	"""returns the .s files of a directory or the files that match a glob pattern"""
+	if os.path.isdir(path):
+		return sorted(glob.glob(os.path.join(path, "*.s")))
+	return sorted(glob.glob(path))
+
+def analyseFile(filenameCode, configuration, cache=None, options={}):
+	"""parses (see parse_cache) and simulates one file, returns the findings (a file that can not be analysed gives an error finding)"""
+	try:
+		program, options = parseProgram(filenameCode, cache, options)
+		device = createDevice(program, options)
+		device.loadConfiguration(configuration)
+		device.runProgram()
+		return device.findings
+	except Exception as e:
+		findings = FindingsCollector()
+		findings.add(Finding(0, FINDING_ERROR, detail=e))
+		return findings
+
+# configuration, parse cache and device options of a worker process (loaded once per process)
+workerConfig = None
+workerCache = None
+workerOptions = {}
+
+def initFileWorker(filenameConfig, cache, options):
+	global workerConfig, workerCache, workerOptions
+	workerConfig = Configuration(filenameConfig)
+	workerCache = cache
+	workerOptions = options
+
+def analyseFileInWorker(filenameCode):
+	return analyseFile(filenameCode, workerConfig, workerCache, workerOptions)
+
+def analyseFiles(filenamesCode, filenameConfig, processes=1, cache=None, options={}):
+	""" filenamesCode: list of assembly files (see getAsmFiles)
+		cache: optional parse_cache used by all the processes
+		returns [(filename asm, FindingsCollector)] in the order of the files
+	"""
+	if processes <= 1 or len(filenamesCode) <= 1:
+		configuration = Configuration(filenameConfig)
+		return [(filenameCode, analyseFile(filenameCode, configuration, cache, options)) for filenameCode in filenamesCode]
+
+	with Pool(processes, initializer=initFileWorker, initargs=(filenameConfig, cache, options)) as pool:
+		results = pool.map(analyseFileInWorker, filenamesCode)
+	return list(zip(filenamesCode, results))
+
+# ---- incremental analysis ----
+
+DEFAULT_CHECKPOINT_INTERVAL = 1000
+SESSION_VERSION = 3
+
+def getFileHash(filename):
+	with open(filename, "rb") as myfile:
+		return hashlib.sha256(myfile.read()).hexdigest()
+
+def loadSession(filenameSession, configKey, interval):
+	""" returns the saved (program, checkpoints, number of compile findings) if they were obtained
+		with the same configuration (None otherwise), the instructions of the program are plain tuples
+	"""
+	try:
+		with open(filenameSession, "rb") as sessionFile:
+			session = pickle.load(sessionFile)
+	except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, TypeError): # e.g. states of an older version
+		return None
+	if not isinstance(session, dict) or session.get("version") != SESSION_VERSION:
+		return None
+	if session.get("config") != configKey or session.get("interval") != interval:
+		return None
+	if 0 not in session["checkpoints"]: # e.g. a program with control flow
+		return None
+	program = session["program"]
+	# the findings of a checkpoint are the first findings of the last one
+	findings = [Finding(pc, kind, avr_8_ins._make(program[pc]), locations, states, detail)\
+				for pc, kind, locations, states, detail in session["findings"]]
+	checkpoints = {pc: DeviceSnapshot(pc, state, findings, findingsNbr) for pc, (state, findingsNbr) in session["checkpoints"].items()}
+	return (program, checkpoints, session["compileFindings"])
+
+def saveSession(filenameSession, configKey, device):
+	checkpoints = {pc: (checkpoint.state, checkpoint.findingsNbr) for pc, checkpoint in device.checkpoints.items()}
+	end = device.checkpoints.get(len(device.program))
+	findings = end.findings[:end.findingsNbr] if end is not None else ()
+	# the instructions of the findings are found in the program
+	findings = tuple((finding.pc, finding.kind, finding.locations, finding.states, finding.detail) for finding in findings)
+	session = {"version":SESSION_VERSION, "config":configKey, "interval":device.checkpointInterval,\
+			   "program":tuple(map(tuple, device.program)), "checkpoints":checkpoints, "findings":findings,\
+			   "compileFindings":len(device.compileFindings)}
+	with open(filenameSession, "wb") as sessionFile:
+		pickle.dump(session, sessionFile, pickle.HIGHEST_PROTOCOL)
+
+def analyseIncremental(program, filenameConfig, filenameSession, interval=DEFAULT_CHECKPOINT_INTERVAL, options={}):
+	""" simulates the program, the simulation of the previous version saved in filenameSession
+		is reused (see Device.reanalyse), then the session is replaced by this simulation
+		returns (device, pc where the simulation started, pc where it converged or None)
+	"""
+	configKey = getFileHash(filenameConfig) + repr(sorted(options.items())) # the findings depend on the options
+	session = loadSession(filenameSession, configKey, interval)
+	if session is None:
+		device = createDevice(program, options)
+		device.checkpointInterval = interval
+		device.loadConfiguration(Configuration(filenameConfig))
+		device.runProgram()
+		resumed = (0, None)
+	else:
+		device = Device()
+		for name, value in options.items():
+			setattr(device, name, value)
+		device.checkpointInterval = interval
+		device.loadConfiguration(Configuration(filenameConfig)) # share thresholds (the state comes from the session)
+		resumed = device.reanalyse(program, session)
+	saveSession(filenameSession, configKey, device)
+	return (device,) + resumed
+
+def getFindingsMatrix(results):
+	""" results: [(filename config, FindingsCollector)] (see analyseConfigurations)
+		returns (pcs, matrix) where pcs are the lines with findings (for any configuration)
+		and matrix[i][j] is the number of findings of the i-th configuration at pcs[j]
+	"""
+	pcs = sorted({finding.pc for filenameConfig, findings in results for finding in findings})
+	column = {pcs[i]: i for i in range(len(pcs))}
+
+	matrix = []
+	for filenameConfig, findings in results:
+		row = [0] * len(pcs)
+		for finding in findings:
+			row[column[finding.pc]] += 1
+		matrix.append(row)
+	return (pcs, matrix)
+
+def getFindingsMatrixStr(results, program):
+	""" one line per line of the program with findings and one column per configuration
+		(numbered in the order of the configurations, as in getSummaryStr)
+	"""
+	pcs, matrix = getFindingsMatrix(results)
+	text = "line\t" + "\t".join("#{0}".format(i+1) for i in range(len(results))) + "\tinstruction\n"
+	for j in range(len(pcs)):
+		line = program[pcs[j]].line if pcs[j] < len(program) else ""
+		text += "{0}\t{1}\t{2}\n".format(pcs[j], "\t".join(str(row[j]) for row in matrix), line)
+	return text
+
+def getSummaryStr(results, title="configuration"):
+	""" results: [(filename, FindingsCollector)]
+		one line per configuration (or file) with the number of findings of each kind, and the totals
+	"""
+	kinds = [FINDING_VALUE, FINDING_NEIGHBOUR, FINDING_TRANSITION, FINDING_CARRY, FINDING_INSTRUCTION, FINDING_ERROR]
+	summary = title + "\ttotal\t" + "\t".join(kinds) + "\n"
+	totals = [0] * len(kinds)
+	for index in range(len(results)):
+		filename, findings = results[index]
+		counts = [len(findings.getKind(kind)) for kind in kinds]
+		totals = [totals[i] + counts[i] for i in range(len(kinds))]
+		summary += "#{0} {1}\t{2}\t{3}\n".format(index+1, filename, len(findings), "\t".join(str(count) for count in counts))
+	if len(results) > 1:
+		summary += "TOTAL\t{0}\t{1}\n".format(sum(totals), "\t".join(str(count) for count in totals))
+	return summary
+
+if __name__ == "__main__":
+	import tempfile
+
+	source = """lds r1, 0x1122
+lds r3, 0x1123
+lds r5, 0x1124
+eor r1, r3
+eor r1, r5
+"""
+	config = """mask_list_of_addr:
+    - [0x1122, a, 0]
+    - [0x1123, a, 1]
+    - [0x1124, a, 2]
+mask_shares:
+  a: 3
+"""
+	options = {"orderAware": True}
+	with tempfile.TemporaryDirectory() as directory:
+		filenameConfig = os.path.join(directory, "conf.yaml")
+		with open(filenameConfig, "w") as myfile:
+			myfile.write(config)
+		filenameCode = os.path.join(directory, "code.s")
+		filenameSession = os.path.join(directory, "code.session")
+
+		print("-------- INCREMENTAL ORDER-AWARE --------")
+		for code in (source, source.replace("eor r1, r3", "nop\neor r1, r3")):
+			with open(filenameCode, "w") as myfile:
+				myfile.write(code)
+			program = get_parser(filenameCode).parse()
+			device, start, converged = analyseIncremental(program, filenameConfig, filenameSession, 1, options)
+			full = createDevice(program, options)
+			full.loadConfiguration(Configuration(filenameConfig))
+			full.runProgram()
+			print("Simulated from line", start, "findings:", len(device.findings), "same as a full run:", str(device.findings) == str(full.findings))
+		print("------------ END ------------")
+
+		print("-------- FINDINGS MATRIX --------")
+		# two configurations with the same name in different directories
+		filenamesConfig = []
+		for name, shares in (("first", "[0x1124, a, 2]"), ("second", "[0x1124, b, 0]")):
+			os.mkdir(os.path.join(directory, name))
+			filenamesConfig.append(os.path.join(directory, name, "conf.yaml"))
+			with open(filenamesConfig[-1], "w") as myfile:
+				myfile.write(config.replace("[0x1124, a, 2]", shares))
+		program = get_parser(filenameCode).parse()
+		results = analyseConfigurations(program, filenamesConfig)
+		pcs, matrix = getFindingsMatrix(results)
+		print("Lines:", pcs, "matrix:", matrix)
+		print(getFindingsMatrixStr(results, program))
+		print("------------ END ------------")
@@ -0,0 +1,83 @@
+#!python3
+
+"""
+Rough throughput measurements of the tool.
+The input listing is repeated in order to obtain a big workload
+(like a fully unrolled implementation).
+
+Usage: python3 benchmark.py [<filename asm>] [<repeat>] [<filename config>]
+"""
+
+import sys
+import os
+import time
+import contextlib
+
+# in order to be able to import code from another directory
+sys.path.append("./device/")
+sys.path.append("./parser/")
+sys.path.append("./config_file/")
+
+from parser_avr_8 import *
+from device import *
+from config import Configuration
+
+def timeIt(function, *args):
+	start = time.perf_counter()
+	function(*args)
+	return time.perf_counter() - start
+
+def getLines(filename, repeat):
+	parser = avr_8_parser(filename)
+	return parser.sanitize_asm_file(filename) * repeat
+
+# -------- parser --------
+
+def parseLegacy(parser, lines):
+	# the grammar was built again for every single line
+	for line in lines:
+		parser.parsed_line_to_obj(build_grammar().parseString(line), line)
+
+def parseGrammarOnly(parser, lines):
+	for line in lines:
+		parser.parsed_line_to_obj(avr_grammar.parseString(line), line)
+
+def parseCurrent(parser, lines):
+	for line in lines:
+		parser.parsed_line_to_obj(parser.parse_line(line), line)
+
+def benchParser(lines):
+	parser = avr_8_parser(None)
+	print("-------- Parser ({0} lines) --------".format(len(lines)))
+	for name, function in [("grammar per line (old)", parseLegacy),\
+						   ("grammar built once", parseGrammarOnly),\
+						   ("fast tokenizer", parseCurrent)]:
+		elapsed = timeIt(function, parser, lines)
+		print("{0:<24}{1:>12.0f} lines/s".format(name, len(lines)/elapsed))
+
+# -------- simulator --------
+
+def runDevice(program, config):
+	device = Device()
+	device.loadProgram(program, config)
+	device.runProgram()
+
+def benchDevice(program, filenameConfig):
+	config = Configuration(filenameConfig)
+	config = {CONF_RND:config.get_rand_list_of_addr(), CONF_MASK:config.get_mask_list_of_addr()}
+	print("-------- Simulator ({0} instructions) --------".format(len(program)))
+	# the findings are not part of the measure
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		elapsed = timeIt(runDevice, program, config)
+	print("{0:<24}{1:>12.0f} instructions/s".format("loadProgram+runProgram", len(program)/elapsed))
+
+if __name__ == "__main__":
+	filename = sys.argv[1] if len(sys.argv) > 1 else "examples/code.s"
+	repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+	filenameConfig = sys.argv[3] if len(sys.argv) > 3 else "examples/code_conf.yaml"
+
+	lines = getLines(filename, repeat)
+	benchParser(lines)
+	
+	parser = avr_8_parser(None)
+	benchDevice([parser.parsed_line_to_obj(parser.parse_line(line), line) for line in lines], filenameConfig)
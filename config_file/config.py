@@ -4,7 +4,7 @@ import yaml
 class Configuration:
 
   def __init__(self, conf_file):
-    self.conf_file = yaml.load(open(conf_file).read())
+    self.conf_file = yaml.load(open(conf_file).read(), Loader=yaml.SafeLoader)
 
   def test_f(self):
     print (self.conf_file)
@@ -39,6 +39,23 @@ class Configuration:
   def get_label_addr_rng(self):
     return self.conf_file['rng']
 
+  def get_list(self, key):
+    """ returns an empty list if the key is not in the file """
+    return self.conf_file.get(key) or []
+
+  def get_mask_shares(self):
+    """ returns {mask ID: number of shares}, from 'mask_shares' or
+        deduced from the shares of the lists of masks """
+    shares = {}
+    for mask in self.get_list('mask_list_of_addr') + self.get_list('mask_list_of_labels') + self.get_list('mask_list_of_regs'):
+      shares[mask[1]] = max(shares.get(mask[1], 0), mask[2] + 1)
+    shares.update(self.conf_file.get('mask_shares') or {})
+    return shares
+
+  def get_leakage_threshold(self):
+    """ returns the number of shares of a mask that leak when they are combined (None: all the shares) """
+    return self.conf_file.get('leakage_threshold')
+
 
 if __name__ == "__main__":
   config_obj = Configuration("config_expl.yaml")
@@ -56,4 +73,8 @@ if __name__ == "__main__":
   print ("constants, list of regs:", config_obj.get_constants_list_of_regs())
 
   print ("rng:", config_obj.get_label_addr_rng())
+
+  order_aware_obj = Configuration("config_order_aware.yaml")
+  print ("mask shares:", order_aware_obj.get_mask_shares())
+  print ("leakage threshold:", order_aware_obj.get_leakage_threshold())
   
\ No newline at end of file
@@ -4,8 +4,13 @@ __date__ = "02/2016"
 __author__ = "Nikita Veshchikov"
 
 import copy
+import heapq
+from collections import namedtuple
 from tracked_value import *
-from warnings import *
+from maskWarnings import *
+from memory import *
+from traceFile import TraceWriter, Trace, DEST_REG, DEST_T, DEST_SP, DEST_STACK, DEST_MEM, DEST_BUS, DEST_FLAG, NO_SOURCE
+from instructionSet import *
 from math import log, ceil
 
 CONF_RND = 0
@@ -18,16 +23,46 @@ PARAM_VAL = 1
 HIGH = 1
 LOW = 0
 
+# name of the label pseudo-instruction (see avr_8_parser)
+LABEL_INSTRUCTION = "label"
+
+# abstract state of the device (immutable value states)
+# flags: states of the SREG flags in the order of STATUS_FLAGS (empty: not initialized)
+DeviceState = namedtuple("DeviceState", "registers bitStorage memory stack sp bus flags", defaults=(EMPTY, ()))
+# snapshot of a simulation: program counter, DeviceState and the first findingsNbr findings of the list findings
+# (findings are only appended, so the snapshots of a simulation share the list of its findings)
+DeviceSnapshot = namedtuple("DeviceSnapshot", "pc state findings findingsNbr")
+
 #TODO: X, Y, Z  = R27-26; R29-28; R31-30 
 
+# constant value of the program memory (lpm)
+FLASH_DATA = makeState(None, 0, True)
+
+def offsetAddress(adr, offset):
+	"""returns adr + offset for an address or a label (e.g. 'key' + 1 -> 'key+1')"""
+	if offset == 0:
+		return adr
+	if isinstance(adr, int):
+		return (adr + offset) & 0xFFFF
+	label, sign, base = adr.rpartition("+")
+	if not sign or constToInt(base) is None:
+		label, sign, base = adr.rpartition("-")
+	if sign and label and constToInt(base) is not None:
+		offset += constToInt(base) if sign == "+" else -constToInt(base)
+	else:
+		label = adr
+	if offset == 0:
+		return label
+	return "{0}{1:+d}".format(label, offset)
+
 class Device:
-	def __init__(self):
+	def __init__(self, sramSize=SRAM_SIZE):
 		self.pc = None # program counter / instruction pointer aka current instruciton index
 		self.program = []
 		self.sp = None # stack pointer
 		self.stack = []
 		self.registerNbr = 32
-		self.registers = [TrackedValue() for i in range(self.registerNbr)]
+		self.registers = [TrackedValue() for i in range(self.registerNbr)] # cells sharing interned states
 		
 		self.specialRegisters = {"X":(26,27), "Y":(28,29), "Z":(30,31)}
 		
@@ -38,30 +73,82 @@ class Device:
 							16:[17],17:[16], 18:[19],19:[18], 20:[21],21:[20], 22:[23],23:[22],\
 							24:[25],25:[24], 26:[27],27:[26], 28:[29],29:[28], 30:[31],31:[30]}
 		self.neighbours[1].append(0)
+		self.buildNeighbourBits()
+		
+		# index of the registers holding shares of each mask: maskIndex -> bitmask of registers
+		self.maskRegisters = {}
+		self.indexedStates = [EMPTY]*self.registerNbr # register states that are in the index
 		self.bitStorage = TrackedValue()
-		self.memory = {} # dict of "adr" -> TrackedValue or "label" -> TrackedValue
+		self.flags = {flag: TrackedValue() for flag in STATUS_FLAGS} # SREG flags (T is the bitStorage)
+		self.memory = Memory(sramSize) # "adr" -> value or "label" -> value
+		self.maskThresholds = NO_THRESHOLDS # order-aware mode: maskIndex -> number of shares (see loadConfiguration)
+		self.findings = FindingsCollector(thresholds=self.maskThresholds)
+		self.streamInstruction = None # current instruction when a stream is simulated
 		
 		
 		self.unknownInstructionWarning = True
-		self.unsafeInstructions = {"mov":self.mov, \
-							"bst":self.bst, "bld":self.bld,\
-							"push":self.push, "pop":self.pop, \
-							"eor":self.combine, "and":self.combine, "or":self.combine,\
-							"add":self.combine, "adc":self.combineCarry, "sub":self.combineCarry, "sbc":self.combine,\
-							"mul":self.mulCombine, "muls":self.mulCombine, "mulsu":self.mulCombine,\
-							"fmul":self.mulCombine, "fmuls":self.mulCombine, "fmulsu":self.mulCombine,\
-							"cp":self.combine, "cpc":self.combineCarry,\
-							"ldi":self.ldi, "lds":self.lds, "ld":self.ld, "sts":self.sts, "st":self.st}
+		# handlers and operands of the instructions, generated from the ISA table (see instructionSet.py)
+		self.unsafeInstructions = {name: getattr(self, entry.handler) for name, entry in ISA.items() if entry.handler is not None}
+		# operands that are not register indexes in the parsed program: name -> (op1 type, op2 type)
+		self.operandTypes = {name: entry.operandTypes for name, entry in ISA.items() if entry.operandTypes}
+		# registers written by the handlers: name -> operand positions, or fixed register indexes
+		self.writtenOperands = {name: entry.written for name, entry in ISA.items() if entry.written}
+		self.writtenRegisters = {name: entry.registers for name, entry in ISA.items() if entry.registers}
+		# operands added by the table (e.g. the step of a pointer and the status flags written) and operands of the short forms
+		self.extraOperands = {}
+		for name, entry in ISA.items():
+			flags = entry.flagsWritten.replace("T", "")
+			if entry.extra or flags:
+				self.extraOperands[name] = entry.extra + ((flags,) if flags else ())
+		self.implicitOperands = {name: entry.implicit for name, entry in ISA.items() if entry.implicit}
+		self.notImplemented = {name for name, entry in ISA.items() if not entry.implemented}
+		self.compiled = [] # program as a list of (handler, operands, written registers)
+		self.compileFindings = [] # findings reported while compiling the program
+		self.flagged = set() # mnemonics that were already reported at compile time
+		self.compileCache = {} # (name, op1, op2) -> (handler, operands, written registers)
+		
+		# control flow, the target is the last operand
+		self.jumpInstructions = {"rjmp", "jmp"}
+		self.branchInstructions = {"brbs", "brbc", "breq", "brne", "brcs", "brcc", "brsh", "brlo", "brmi", "brpl",\
+							"brge", "brlt", "brhs", "brhc", "brts", "brtc", "brvs", "brvc", "brie", "brid"}
+		self.skipInstructions = {"cpse", "sbrc", "sbrs", "sbic", "sbis"} # skip the next instruction
+		self.callInstructions = {"rcall", "call"}
+		self.returnInstructions = {"ret", "reti"}
+		self.indirectInstructions = {"ijmp", "icall", "eijmp", "eicall"} # target is not known
+		self.controlInstructions = self.jumpInstructions | self.branchInstructions | self.skipInstructions |\
+								self.callInstructions | self.returnInstructions | self.indirectInstructions
+		self.labels = {} # label -> pc
+		self.hasControlFlow = False
+		self.blocks = {}
+		self.summaries = {}
+		self.summaryHits = 0
+		self.activeCalls = []
 		
+		# snapshots taken every checkpointInterval instructions of a program without control flow (0: never)
+		self.checkpointInterval = 0
+		self.checkpoints = {} # pc -> DeviceSnapshot
+		
+		self.tracer = None # TraceWriter when the state changes are recorded (see startTrace)
+		
+		# the carry flag is added to a value (adc, sbc, rol, ...): it is checked against the value
 		self.unsafeCarryWarning = True
 		
+		# order-aware masking: only the combinations of enough shares of a mask leak (see loadConfiguration)
+		self.orderAware = False
+		self.shareThreshold = None # number of shares that leak (None: all the shares of the mask)
+		
+		# transition leakage: a value transferred by the load/store bus is checked against the previous one
+		# (overwritten registers and memory cells are always checked against their previous value)
+		self.transitionWarning = False
+		self.busState = EMPTY # last value on the load/store bus
+		
+		# labels of the configuration that name SRAM addresses (e.g. the data symbols of an avr-objdump listing)
+		self.dataSymbols = {} # label -> address
+		
 		# these instructions chage positions of bits in a byte and can also chage the carry flag
 		# if different mask shares are stored in different parts of a byte than it is potentially unsafe
 		self.byteUnsafeWarning = True
-		self.potentiallyUnsafe = {"swap", "lsr", "lsl", "ror", "rol", "asr"}
-		
-		# XXX all operations with Carry flag as potentially unsafe
-		# TODO: BST, BLD (T as a normal register)
+		self.potentiallyUnsafe = {name for name, entry in ISA.items() if entry.bitwise}
 		
 		# others should be safe
 		
@@ -74,14 +161,17 @@ class Device:
 				regStr+= "R{0}\t{1}\n".format(i, self.registers[i])
 		return regStr
 	
+	def getFlagsStr(self):
+		flagsStr = ""
+		for flag in reversed(SREG_BITS):
+			cell = self.bitStorage if flag == "T" else self.flags[flag]
+			flagsStr += "{0}\t{1}\n".format(flag, cell)
+		return flagsStr
+	
 	def getMemoryStr(self):
-		memStr = ""
-		if len(self.memory) == 0:
+		memStr = str(self.memory)
+		if len(memStr) == 0:
 			memStr = "[Empty Memory]"
-		else:
-			for cellKey in self.memory:
-				fmt = {"cell":cellKey, "val":self.memory[cellKey]}
-				memStr+= "{cell:#04X}\t{val}\n".format(**fmt)
 		return memStr
 	
 	def getProgramStr(self):
@@ -116,12 +206,25 @@ class Device:
 	# printers
 	def printRegisters(self):
 		print(self.getRegStr())
+	def printFlags(self):
+		print(self.getFlagsStr())
 	def printMemory(self):
 		print(self.getMemoryStr())
 	def printProgram(self):
 		print(self.getProgramStr())
 	def printStack(self):
 		print(self.getStackStr())
+	def printFindings(self):
+		findings = FindingsCollector(thresholds=self.maskThresholds)
+		findings.setFindings(self.getOrderedFindings())
+		print(findings)
+	
+	def getOrderedFindings(self):
+		""" returns the findings with the findings of the compilation (the first ones)
+			merged by pc into the findings of the simulation
+		"""
+		compileNbr = len(self.compileFindings)
+		return list(heapq.merge(self.findings.findings[:compileNbr], self.findings.findings[compileNbr:], key=lambda finding: finding.pc))
 	
 	def __str__(self):
 		if self.pc is None:
@@ -137,110 +240,848 @@ class Device:
 		
 		self.pc = 0
 		self.program = copy.copy(program)
+		self.findings = FindingsCollector(thresholds=self.maskThresholds)
+		self.compiled = self.compileProgram(self.program)
+		self.checkpoints = {}
 		
 		self.sp = 0
 		self.stack = []
+		self.busState = EMPTY
 		
-		for adr in config[CONF_RND]:
-			self.memory[adr] = TrackedValue()
-			self.memory[adr].setToRandom()
-		
+		self.memory.fillRandom(config[CONF_RND])
 		
 		for mask in config[CONF_MASK]:
-			self.memory[mask[0]] = TrackedValue()
-			self.memory[mask[0]].loadMask( (mask[1], mask[2]) )
+			self.memory.store(mask[0], makeState({internMask(mask[1]): 1 << mask[2]}))
+	
+	def resetState(self):
+		""" clears the registers, memory, stack and findings of the simulation,
+			the loaded (compiled) program is kept, so it can be simulated again (e.g. with another configuration)
+		"""
+		self.pc = 0
+		self.registers = [TrackedValue() for i in range(self.registerNbr)]
+		self.bitStorage = TrackedValue()
+		self.flags = {flag: TrackedValue() for flag in STATUS_FLAGS}
+		self.memory = Memory(self.memory.size)
+		self.sp = 0
+		self.stack = []
+		self.busState = EMPTY
+		self.findings = FindingsCollector(thresholds=self.maskThresholds)
+		for finding in self.compileFindings:
+			self.findings.add(finding)
+		self.checkpoints = {}
+		self.buildShareIndex()
+	
+	def loadConfiguration(self, configuration):
+		"""initializes the memory from a Configuration (addresses and labels of randoms and masks)"""
+		self.memory.loadConfiguration(configuration, self.dataSymbols)
+		if self.orderAware:
+			threshold = self.shareThreshold or configuration.get_leakage_threshold()
+			shares = configuration.get_mask_shares()
+			self.maskThresholds = makeThresholds({maskId: min(shares[maskId], threshold) if threshold else shares[maskId] for maskId in shares})
+		else:
+			self.maskThresholds = NO_THRESHOLDS
+		self.findings.maskThresholds = self.maskThresholds
 	
-	def runProgram(self):
-		for instruction in self.program:
-			#exec self.program[self.pc]
+	def runProgram(self, instructions=None):
+		""" instructions: optional iterable of instructions (e.g. avr_8_parser.parse_iter())
+			that are executed as they come instead of the loaded program,
+			they are not stored so memory usage does not depend on the program length
+		"""
+		self.buildShareIndex() # registers could have been set directly
+		
+		if instructions is None and self.hasControlFlow:
+			self.runBlocks()
+			return
+		
+		if instructions is not None:
+			for instruction in instructions:
+				self.streamInstruction = instruction
+				self.executeCompiled(self.compileInstruction(instruction))
+			self.streamInstruction = None
+			return
+		
+		if self.checkpointInterval > 0:
+			self.runCheckpointed(self.pc, len(self.compiled))
+			return
+		
+		if self.tracer is not None:
+			self.executeBlock(self.pc, len(self.compiled))
+			self.pc = len(self.compiled)
+			return
+		
+		updateShareIndex = self.updateShareIndex
+		for handler, operands, written in self.compiled:
+			if handler is not None:
+				try:
+					handler(*operands)
+				except Exception as e:
+					self.report(FINDING_ERROR, detail=e)
+				for regId in written:
+					updateShareIndex(regId)
+			self.pc+=1
+	
+	def executeCompiled(self, compiledInstruction):
+		if self.tracer is not None:
+			self.executeTraced(compiledInstruction)
+			self.pc+=1
+			return
+		handler, operands, written = compiledInstruction
+		if handler is not None:
 			try:
-				self.handleInstruction(instruction)
+				handler(*operands)
 			except Exception as e:
-				print("At line", self.pc, " > ", instruction.line)
-				print(e)
-				
-			self.pc+=1
-			#print("-----------")
-			#self.printProgram()
+				self.report(FINDING_ERROR, detail=e)
+			for regId in written:
+				self.updateShareIndex(regId)
+		
+		self.pc+=1
+	
+	def executeBlock(self, start, end):
+		"""executes instructions [start, end[ of the compiled program"""
+		compiled = self.compiled
+		if self.tracer is not None:
+			for self.pc in range(start, end):
+				self.executeTraced(compiled[self.pc])
+			return
+		updateShareIndex = self.updateShareIndex
+		for self.pc in range(start, end):
+			handler, operands, written = compiled[self.pc]
+			if handler is not None:
+				try:
+					handler(*operands)
+				except Exception as e:
+					self.report(FINDING_ERROR, detail=e)
+				for regId in written:
+					updateShareIndex(regId)
+	
+	# --------  -------- snapshots -------- -------- 
+	
+	def snapshot(self):
+		""" returns the current state of the simulation (DeviceSnapshot),
+			value states are immutable, memory pages are shared (copy on write)
+			and the findings are not copied so it is cheap
+		"""
+		return DeviceSnapshot(self.pc, self.getState(), self.findings.findings, len(self.findings))
+	
+	def restore(self, snapshot):
+		"""goes back (or forward) to a snapshot, including the findings reported at that time"""
+		self.setState(snapshot.state)
+		self.pc = snapshot.pc
+		self.findings.setFindings(snapshot.findings[:snapshot.findingsNbr])
+	
+	def runCheckpointed(self, start, end, probes=None):
+		""" executes instructions [start, end[ of a program without control flow,
+			with a checkpoint every checkpointInterval instructions and at the end
+			probes: pc -> DeviceSnapshot, the simulation stops at the first probe that has the same state
+			returns the pc of this probe (None if the simulation reached the end)
+		"""
+		if probes is None:
+			probes = {}
+		interval = self.checkpointInterval
+		stops = set(range(start - start % interval + interval, end, interval))
+		stops.update(pc for pc in probes if start <= pc < end)
+		stops = sorted(stops) + [end]
+		pc = start
+		for nextPc in stops:
+			self.pc = pc
+			if pc in probes and self.getStateKey(self.getState()) == self.getStateKey(probes[pc].state):
+				return pc
+			if pc % interval == 0:
+				self.checkpoints[pc] = self.snapshot()
+			self.executeBlock(pc, nextPc)
+			pc = nextPc
+		self.pc = end
+		self.checkpoints[end] = self.snapshot()
+		return None
+	
+	def getCheckpoint(self, pc):
+		"""returns the last checkpoint taken at or before pc (None if there is none)"""
+		pcs = [checkpointPc for checkpointPc in self.checkpoints if checkpointPc <= pc]
+		if len(pcs) == 0:
+			return None
+		return self.checkpoints[max(pcs)]
+	
+	def reanalyse(self, program, previous=None):
+		""" simulates a modified version of the program that was simulated with checkpoints
+			(checkpointInterval > 0), only from the last checkpoint before the first changed instruction:
+			the simulation stops as soon as the state is the same as in the previous simulation
+			at the same point of the unchanged end of the program, the previous findings are reused
+			previous: (program, checkpoints, number of compile findings) of a previous simulation
+			that is not loaded in the device (e.g. saved in a file), by default the current simulation
+			returns (pc where the simulation restarted, pc where it converged or None)
+		"""
+		if previous is None:
+			previous = (self.program, self.checkpoints, len(self.compileFindings))
+		oldProgram, oldCheckpoints, oldCompileNbr = previous
+		if 0 not in oldCheckpoints or len(oldProgram) not in oldCheckpoints:
+			raise(Exception(createError("The previous program was not simulated with checkpoints.")))
+		
+		size = min(len(oldProgram), len(program))
+		first = 0 # first changed instruction
+		while first < size and oldProgram[first] == program[first]:
+			first += 1
+		suffix = 0 # length of the unchanged end
+		while suffix < size - first and oldProgram[-1-suffix] == program[-1-suffix]:
+			suffix += 1
+		delta = len(program) - len(oldProgram)
+		
+		self.program = copy.copy(program)
+		self.findings = FindingsCollector(thresholds=self.maskThresholds)
+		self.compiled = self.compileProgram(self.program)
+		compileNbr = len(self.compileFindings)
+		
+		# checkpoints of the unchanged beginning are kept (the findings of a checkpoint are the first findings of the last one)
+		start = 0 if self.hasControlFlow else max(pc for pc in oldCheckpoints if pc <= first)
+		oldEnd = oldCheckpoints[len(oldProgram)]
+		kept = self.compileFindings + oldEnd.findings[oldCompileNbr:oldCheckpoints[start].findingsNbr]
+		self.checkpoints = {}
+		for pc in oldCheckpoints:
+			if pc <= start:
+				checkpoint = oldCheckpoints[pc]
+				self.checkpoints[pc] = DeviceSnapshot(pc, checkpoint.state, kept, compileNbr + checkpoint.findingsNbr - oldCompileNbr)
+		self.restore(self.checkpoints[start])
+		
+		if self.hasControlFlow:
+			self.checkpoints = {}
+			self.runProgram()
+			return (start, None)
+		
+		# previous states in the unchanged end (shifted to the pcs of the new program)
+		probes = {pc + delta: oldCheckpoints[pc] for pc in oldCheckpoints if pc >= len(oldProgram) - suffix and pc + delta > start}
+		converged = self.runCheckpointed(start, len(self.program), probes)
+		if converged is None:
+			return (start, None)
+		
+		# the end is the same as in the previous simulation
+		oldPc = converged - delta
+		findingsNbr = len(self.findings)
+		oldFindingsNbr = oldCheckpoints[oldPc].findingsNbr
+		oldFindings = oldEnd.findings[oldFindingsNbr:oldEnd.findingsNbr]
+		findings = self.findings.findings + [Finding(finding.pc + delta, finding.kind, self.program[finding.pc + delta],\
+													 finding.locations, finding.states, finding.detail) for finding in oldFindings]
+		for pc in oldCheckpoints:
+			if pc >= oldPc:
+				checkpoint = oldCheckpoints[pc]
+				self.checkpoints[pc + delta] = DeviceSnapshot(pc + delta, checkpoint.state, findings,\
+															  findingsNbr + checkpoint.findingsNbr - oldFindingsNbr)
+		self.restore(self.checkpoints[len(self.program)])
+		return (start, converged)
+	
+	def rewind(self, pc):
+		"""goes back to the state before the instruction at pc (from the nearest checkpoint)"""
+		checkpoint = self.getCheckpoint(pc)
+		if checkpoint is None:
+			raise(Exception(createError("No checkpoint before line {0}".format(pc))))
+		self.restore(checkpoint)
+		self.executeBlock(checkpoint.pc, pc)
+		self.pc = pc
+	
+	# --------  -------- traces -------- -------- 
+	
+	def startTrace(self, filename):
+		"""the next simulations record every state change in a trace file (see traceFile.py)"""
+		self.tracer = TraceWriter(filename)
+		self.recordState()
+	
+	def stopTrace(self):
+		self.tracer.close(self.memory)
+		self.tracer = None
+	
+	def recordState(self):
+		self.tracer.recordState([cell.state for cell in self.registers], self.bitStorage.state,\
+								[cell.state for cell in self.stack], self.sp, self.memory, self.busState,\
+								[self.flags[flag].state for flag in STATUS_FLAGS])
+	
+	def executeTraced(self, compiledInstruction):
+		"""executes one instruction and records the values it writes"""
+		handler, operands, written = compiledInstruction
+		tracer = self.tracer
+		tracer.step += 1
+		if handler is None:
+			return
+		bitState, sp, busState = self.bitStorage.state, self.sp, self.busState
+		flagStates = [self.flags[flag].state for flag in STATUS_FLAGS]
+		try:
+			handler(*operands)
+		except Exception as e:
+			self.report(FINDING_ERROR, detail=e)
+		sources = tracer.sources
+		for regId in written:
+			self.updateShareIndex(regId)
+			tracer.record(self.pc, DEST_REG + regId, self.registers[regId].state.uid, sources.get(DEST_REG + regId, NO_SOURCE))
+		if self.bitStorage.state is not bitState:
+			tracer.record(self.pc, DEST_T, self.bitStorage.state.uid, sources.get(DEST_T, NO_SOURCE))
+		if self.sp != sp:
+			if self.sp > sp: # push
+				tracer.record(self.pc, DEST_STACK + sp, self.stack[sp].state.uid, sources.get(DEST_STACK + sp, NO_SOURCE))
+			tracer.record(self.pc, DEST_SP, self.sp)
+		if self.busState is not busState:
+			tracer.record(self.pc, DEST_BUS, self.busState.uid)
+		for index in range(len(STATUS_FLAGS)):
+			state = self.flags[STATUS_FLAGS[index]].state
+			if state is not flagStates[index]:
+				tracer.record(self.pc, DEST_FLAG + index, state.uid)
+		sources.clear()
+	
+	def getTraceDestination(self, location):
+		"""returns the trace destination (DEST_*) of a location, e.g. (LOC_REG, 3)"""
+		if location[0] == LOC_REG:
+			return DEST_REG + location[1]
+		elif location[0] == LOC_STACK:
+			return DEST_STACK + location[1]
+		elif location[0] == LOC_T:
+			return DEST_T
+		elif location[0] == LOC_BUS:
+			return DEST_BUS
+		elif location[0] == LOC_SREG:
+			return DEST_FLAG + STATUS_FLAGS.index(location[1])
+		return DEST_MEM + self.memory.getCell(location[1])
+	
+	def replay(self, trace, step):
+		"""sets the state of the device to the state after a step of a trace (0: initial state)"""
+		registers, bitStorage, memory, stack, sp, bus, flags, pc = trace.getState(step, self.registerNbr)
+		self.setState(DeviceState(registers, bitStorage, memory, stack, sp, bus, flags))
+		if pc is not None:
+			self.pc = pc
+	
+	def getInstruction(self, pc):
+		if self.streamInstruction is not None:
+			return self.streamInstruction
+		return self.program[pc]
+	
+	def report(self, kind, locations=(), states=(), detail=None, pc=None):
+		"""adds a finding for the current instruction (nothing is formatted here)"""
+		if pc is None:
+			pc = self.pc
+		self.findings.add(Finding(pc, kind, self.getInstruction(pc), locations, states, detail))
+	
+	# --------  -------- compilation -------- -------- 
+	
+	def compileProgram(self, program):
+		"""returns the program as a list of (handler, operands, written registers)"""
+		self.flagged = set()
+		self.compileCache = {}
+		self.labels = {}
+		self.hasControlFlow = False
+		compiled = []
+		for pc in range(len(program)):
+			instruction = program[pc]
+			if instruction.name == LABEL_INSTRUCTION:
+				self.labels[instruction.op1] = pc
+				self.hasControlFlow = True
+			elif instruction.name in self.controlInstructions:
+				self.hasControlFlow = True
+			compiled.append(self.compileInstruction(instruction, pc))
+		self.compileFindings = list(self.findings)
+		return compiled
+	
+	def compileInstruction(self, instruction, pc=None):
+		""" returns (handler, operands, written registers) with operands resolved to register indexes
+			handler is None if there is nothing to execute, in this case the instruction
+			is reported (only once per mnemonic)
+		"""
+		name = instruction.name
+		key = (name, instruction.op1, instruction.op2)
+		compiled = self.compileCache.get(key)
+		if compiled is not None: # unrolled code repeats the same instructions many times
+			return compiled
+		
+		if pc is None:
+			pc = self.pc
+		# the parser uses "EMPTY" for a missing second operand
+		operands = [op for op in key[1:] if not (op is None or op == "EMPTY")]
+		
+		if name in self.unsafeInstructions:
+			if name in self.potentiallyUnsafe and self.byteUnsafeWarning and name not in self.flagged:
+				self.flagged.add(name)
+				self.report(FINDING_INSTRUCTION, pc=pc, detail="Unsafe if different shares are in different parts of a byte.\n"+\
+																"Is it a weird bitslice implementation?\n"+\
+																"To disable this warning use: \"dev.byteUnsafeWarning=False\""+\
+																"\n(other '{0}' instructions are not reported)".format(name))
+			if len(operands) == 0:
+				operands = list(self.implicitOperands.get(name, ()))
+			types = self.operandTypes.get(name, (OP_ANY, OP_ANY))
+			try:
+				for i in range(len(operands)):
+					operands[i] = self.resolveOperand(types[i], operands[i])
+			except Exception as e:
+				self.report(FINDING_ERROR, detail=e, pc=pc)
+				return (None, (), ())
+			if name in self.writtenRegisters:
+				written = self.writtenRegisters[name]
+			else:
+				written = ()
+				for i in self.writtenOperands.get(name, ()):
+					# a pointer or a register pair is written as a whole
+					written += operands[i] if isinstance(operands[i], tuple) else (operands[i],)
+			compiled = (self.unsafeInstructions[name], tuple(operands) + self.extraOperands.get(name, ()), written)
+			self.compileCache[key] = compiled
+			return compiled
+		
+		if name == LABEL_INSTRUCTION or name in self.controlInstructions or name in ISA and name not in self.notImplemented: # no effect on values
+			return (None, (), ())
+		
+		if name in self.flagged:
+			return (None, (), ())
+		self.flagged.add(name)
+		
+		if self.unknownInstructionWarning:
+			self.report(FINDING_INSTRUCTION, pc=pc, detail="Instruction Not implemented.\n"+\
+															"To disable this warning use: \"dev.unknownInstructionWarning=False\""+\
+															"\n(other '{0}' instructions are not reported)".format(name))
+		return (None, (), ())
+	
+	def resolveOperand(self, opType, op):
+		if opType == OP_REG:
+			return self.getRegisterId(op)
+		elif opType == OP_PTR:
+			return self.specialRegisters[op]
+		elif opType == OP_PAIR: # low register, the high register follows it
+			if op in self.specialRegisters:
+				return self.specialRegisters[op]
+			regId = self.getRegisterId(op)
+			return (regId, regId+1)
+		elif opType == OP_DISP: # 'Y+q' -> (pointer, q)
+			pointer, plus, displacement = str(op).partition("+")
+			return (self.specialRegisters[pointer], int(displacement, 0) if plus else 0)
+		elif opType == OP_IO:
+			adr = constToInt(IO_REGISTERS.get(op, op))
+			return op if adr is None else adr + IO_OFFSET
+		return op
 	
-	# --------  -------- instructions -------- -------- 
+	def getRegisterId(self, reg):
+		"""returns the index of a register given as an index or as a half of a special register, e.g. XH"""
+		if isinstance(reg, str):
+			if len(reg) == 2 and reg[0] in self.specialRegisters: # [REG][High/Low], e.g. XH, XL or ZH, ZL
+				if reg[1].lower() == 'h':
+					return self.specialRegisters[reg[0]][HIGH]
+				elif reg[1].lower() == 'l':
+					return self.specialRegisters[reg[0]][LOW]
+			raise(Exception("Unknown register {0}".format(reg)))
+		return reg
 	
 	def handleInstruction(self, instruction):
 		# instruction = program line
-		if instruction.name in self.unsafeInstructions:
-			if not (instruction.op2 is None):
-				self.unsafeInstructions[instruction.name](instruction.op1, instruction.op2)
-			elif not (instruction.op1 is None):
-				self.unsafeInstructions[instruction.name](instruction.op1)
+		handler, operands, written = self.compileInstruction(instruction)
+		if handler is not None:
+			try:
+				handler(*operands)
+			finally:
+				for regId in written:
+					self.updateShareIndex(regId)
+	
+	# --------  -------- control flow -------- -------- 
+	
+	def getTarget(self, instruction):
+		target = instruction.op2 if instruction.op2 not in (None, "EMPTY") else instruction.op1
+		if target not in self.labels:
+			raise(Exception(createError("Unknown label {0}".format(target))))
+		return self.labels[target]
+	
+	def buildBlocks(self):
+		""" splits the program in basic blocks
+			returns {start pc: (end pc, list of successors, pc of the called subroutine or None)}
+			a block that ends with a call goes to the return site (see callSubroutine)
+			and a block that ends with a return has no successors
+		"""
+		size = len(self.program)
+		leaders = {0}
+		targets = {} # pc of a control instruction -> pc of the target
+		for pc in range(size):
+			instruction = self.program[pc]
+			name = instruction.name
+			if name == LABEL_INSTRUCTION:
+				leaders.add(pc)
+			elif name in self.controlInstructions:
+				leaders.add(pc+1)
+				if name in self.skipInstructions:
+					leaders.add(pc+2)
+				elif name in self.jumpInstructions or name in self.branchInstructions or name in self.callInstructions:
+					try:
+						targets[pc] = self.getTarget(instruction)
+					except Exception as e:
+						self.report(FINDING_ERROR, detail=e, pc=pc)
+						continue
+					leaders.add(targets[pc])
+				elif name in self.indirectInstructions:
+					self.report(FINDING_INSTRUCTION, pc=pc, detail="Indirect jump or call, the target is not analysed.")
+		
+		leaders = sorted(leader for leader in leaders if leader < size)
+		blocks = {}
+		for i in range(len(leaders)):
+			start = leaders[i]
+			end = leaders[i+1] if i+1 < len(leaders) else size
+			last = end-1
+			name = self.program[last].name
+			called = None
+			if name in self.callInstructions:
+				successors = [end] if last in targets else []
+				called = targets.get(last)
+			elif name in self.jumpInstructions:
+				successors = [targets[last]] if last in targets else []
+			elif name in self.branchInstructions:
+				successors = [end] + ([targets[last]] if last in targets else [])
+			elif name in self.skipInstructions:
+				successors = [end, end+1]
+			elif name in self.returnInstructions:
+				successors = []
+			elif name in self.indirectInstructions:
+				successors = []
 			else:
-				self.unsafeInstructions[instruction.name]()
+				successors = [end]
+			blocks[start] = (end, [pc for pc in successors if pc < size], called)
+		return blocks
+	
+	def getState(self):
+		"""returns the current state of the registers, memory and stack (DeviceState)"""
+		return DeviceState(tuple(cell.state for cell in self.registers), self.bitStorage.state,\
+						   self.memory.copy(), tuple(cell.state for cell in self.stack), self.sp, self.busState,\
+						   tuple(self.flags[flag].state for flag in STATUS_FLAGS))
+	
+	def setState(self, state):
+		self.registers = [TrackedValue(valueState) for valueState in state.registers]
+		self.bitStorage = TrackedValue(state.bitStorage)
+		self.memory = state.memory.copy()
+		self.stack = [TrackedValue(valueState) for valueState in state.stack]
+		self.sp = state.sp
+		self.busState = state.bus
+		flags = self.getFlagStates(state)
+		self.flags = {STATUS_FLAGS[i]: TrackedValue(flags[i]) for i in range(len(STATUS_FLAGS))}
+		self.buildShareIndex()
+		if self.tracer is not None:
+			self.recordState()
+	
+	def joinStates(self, state1, state2, pc):
+		"""returns a state that over-approximates both states"""
+		registers = tuple(state1.registers[i].joinedWith(state2.registers[i]) for i in range(self.registerNbr))
+		memory = state1.memory.joinedWith(state2.memory)
+		
+		if state1.sp != state2.sp or len(state1.stack) != len(state2.stack):
+			# the stack of the first state is kept, otherwise a loop that pushes would never converge
+			self.report(FINDING_ERROR, pc=pc, detail=createError("The stack is different depending on the path."))
+			stack = state1.stack
 		else:
-			if instruction.name in self.potentiallyUnsafe and self.byteUnsafeWarning:
-				raise( Exception(createWarning("Unsafe if different shares are in different parts of a byte.\n"+\
-											   "Is it a weird bitslice implementation?\n"+\
-											   "To disable this warning use: \"dev.byteUnsafeWarning=False\"")) )
-			elif self.unknownInstructionWarning:
-				raise( Exception(createWarning("Instruction Not implemented.\n"+\
-												"To disable this warning use: \"dev.unknownInstructionWarning=False\"")) )
+			stack = tuple(state1.stack[i].joinedWith(state2.stack[i]) for i in range(len(state1.stack)))
+		flags = tuple(flag1.joinedWith(flag2) for flag1, flag2 in zip(self.getFlagStates(state1), self.getFlagStates(state2)))
+		return DeviceState(registers, state1.bitStorage.joinedWith(state2.bitStorage), memory, stack, state1.sp,\
+						   state1.bus.joinedWith(state2.bus), flags)
+	
+	def getFlagStates(self, state):
+		return state.flags or (EMPTY,)*len(STATUS_FLAGS)
+	
+	def getStateKey(self, state):
+		"""hashable form of a DeviceState (value states are interned)"""
+		return (state.registers, state.bitStorage, state.memory.getKey(), state.stack, state.sp, state.bus, self.getFlagStates(state))
+	
+	def runBlocks(self):
+		""" worklist analysis of a program with control flow: every basic block is simulated
+			from the join of the states coming from its predecessors until nothing changes
+		"""
+		self.findings.unique = True # blocks can be simulated several times
+		self.blocks = self.buildBlocks()
+		self.summaries = {} # (subroutine pc, input state key) -> (output state, findings)
+		self.summaryHits = 0
+		self.activeCalls = []
+		if len(self.blocks) == 0:
+			return
+		
+		exitState = self.analyseFrom(0, self.getState())
+		if exitState is not None:
+			self.setState(exitState)
+		self.pc = len(self.program)
+	
+	def analyseFrom(self, entry, entryState):
+		""" worklist analysis starting at the block 'entry',
+			returns the join of the states at the returns / end of the program (None if never reached)
+		"""
+		entryStates = {entry: entryState}
+		exitState = None
+		worklist = [entry] # blocks are taken in program order
+		queued = {entry}
+		while worklist:
+			start = heapq.heappop(worklist)
+			queued.discard(start)
+			end, successors, called = self.blocks[start]
+			
+			self.setState(entryStates[start])
+			self.executeBlock(start, end)
+			state = self.getState()
+			if called is not None:
+				state = self.callSubroutine(called, state, end-1)
+				if state is None: # the subroutine never returns
+					continue
+			
+			if len(successors) == 0:
+				exitState = state if exitState is None else self.joinStates(exitState, state, end-1)
+			for successor in successors:
+				if successor in entryStates:
+					newState = self.joinStates(entryStates[successor], state, successor)
+					if newState == entryStates[successor]:
+						continue
+				else:
+					newState = state
+				entryStates[successor] = newState
+				if successor not in queued:
+					queued.add(successor)
+					heapq.heappush(worklist, successor)
+		
+		return exitState
+	
+	def callSubroutine(self, entry, state, pc):
+		""" returns the state after a call of the subroutine at 'entry'
+			the result is memoized: a call with the same input state reuses
+			the summary (output state and findings) instead of simulating the subroutine
+		"""
+		key = (entry, self.getStateKey(state))
+		if key in self.summaries:
+			self.summaryHits += 1
+			outputState, findings = self.summaries[key]
+			for finding in findings:
+				self.findings.add(finding)
+			return outputState
+		
+		if entry in self.activeCalls:
+			self.report(FINDING_ERROR, pc=pc, detail=createError("Recursive call, the subroutine is not analysed again."))
+			return state
+		
+		self.activeCalls.append(entry)
+		findingsNbr = len(self.findings)
+		outputState = self.analyseFrom(entry, state)
+		self.activeCalls.pop()
+		
+		self.summaries[key] = (outputState, self.findings.findings[findingsNbr:])
+		return outputState
 	
 	# ---- instruction handlers ----
 	
 	# neighbour test
+	def buildNeighbourBits(self):
+		"""precomputes the neighbours of each register as a bitmask"""
+		self.neighbourBits = [0]*self.registerNbr
+		for regId in self.neighbours:
+			for neighbourReg in self.neighbours[regId]:
+				self.neighbourBits[regId] |= 1 << neighbourReg
+	
+	def buildShareIndex(self):
+		self.maskRegisters = {}
+		self.indexedStates = [EMPTY]*self.registerNbr
+		for regId in range(self.registerNbr):
+			self.updateShareIndex(regId)
+	
+	def updateShareIndex(self, regId):
+		"""updates the mask -> registers index after a write to a register"""
+		oldState = self.indexedStates[regId]
+		newState = self.registers[regId].state
+		if oldState is newState:
+			return
+		
+		regBit = 1 << regId
+		for m in oldState.masks:
+			self.maskRegisters[m] &= ~regBit
+		for m in newState.masks:
+			self.maskRegisters[m] = self.maskRegisters.get(m, 0) | regBit
+		self.indexedStates[regId] = newState
+	
 	def checkNeighbours(self, regId):
-		msg = "Potential neighbouring register Leakage!\n"
-		for neighbourReg in self.neighbours[regId]:
-			msg+= self.registers[regId].checkMaskCombination(self.registers[neighbourReg].masks)
+		masks = self.registers[regId].masks
+		if not masks:
+			return
 		
-		if(len(msg) != 0): # there is a neighbour problem
-			raise (Exception(msg))
+		# neighbours that hold shares of the same masks
+		conflicts = 0
+		for m in masks:
+			conflicts |= self.maskRegisters.get(m, 0)
+		conflicts &= self.neighbourBits[regId]
+		
+		if conflicts and self.maskThresholds: # not enough shares in some pairs
+			state = self.registers[regId].state
+			for neighbourReg in self.neighbours[regId]:
+				if conflicts & (1 << neighbourReg) and not state.hasMaskConflict(self.registers[neighbourReg].masks, self.maskThresholds):
+					conflicts &= ~(1 << neighbourReg)
+		
+		if conflicts: # there is a neighbour problem
+			locations = [(LOC_REG, regId)]
+			states = [self.registers[regId].state]
+			for neighbourReg in self.neighbours[regId]:
+				if conflicts & (1 << neighbourReg):
+					locations.append((LOC_REG, neighbourReg))
+					states.append(self.registers[neighbourReg].state)
+			self.report(FINDING_NEIGHBOUR, tuple(locations), tuple(states))
+	
+	# value handlers, problems are reported instead of raising MaskingComplaint
+	def writeValue(self, cell, state, location, source=None):
+		""" cell <- state, the overwritten value is checked against the new one
+			source: location the value is copied from (recorded in traces, see Trace.getOrigin)
+		"""
+		if source is not None and self.tracer is not None:
+			self.tracer.sources[self.getTraceDestination(location)] = self.getTraceDestination(source)
+		oldState = cell.state
+		if oldState.hasConflict(state, self.maskThresholds):
+			self.report(FINDING_VALUE, (location,), (oldState, state))
+		cell.state = state
+	
+	def busTransfer(self, state):
+		"""a value goes through the load/store bus, it is checked against the previous one (transition)"""
+		if self.busState is not state and self.busState.hasConflict(state, self.maskThresholds): # the same value twice does not toggle the bus
+			self.report(FINDING_TRANSITION, ((LOC_BUS,),), (self.busState, state))
+		self.busState = state
+	
+	def storeValue(self, adr, state, source=None):
+		"""memory[adr] <- state, the overwritten value is checked against the new one"""
+		oldState = self.memory.load(adr)
+		if oldState.hasConflict(state, self.maskThresholds):
+			self.report(FINDING_VALUE, ((LOC_MEM, adr),), (oldState, state))
+		self.memory.store(adr, state)
+		if self.tracer is not None:
+			self.tracer.record(self.pc, DEST_MEM + self.memory.getCell(adr), state.uid,\
+							   NO_SOURCE if source is None else self.getTraceDestination(source))
+	
+	def combineValue(self, cell, state, location, xor=False):
+		"""cell <- cell combined with state (a random of both cancels only in a XOR)"""
+		oldState = cell.state
+		if oldState.hasConflict(state, self.maskThresholds):
+			self.report(FINDING_VALUE, (location,), (oldState, state))
+		cell.state = oldState.xoredWith(state) if xor else oldState.combinedWith(state)
+	
+	# status flags
+	def setFlags(self, flags, state):
+		"""the status flags written by an instruction depend on its result"""
+		for flag in flags:
+			self.flags[flag].state = state
+	
+	def addCarry(self, state, location):
+		"""returns state combined with the carry flag, the carry is checked against the value"""
+		carry = self.flags["C"].state
+		if not carry.masks and not carry.randoms: # a constant carry does not change the shares
+			return makeState(None, 0, True) if state.const else state
+		if self.unsafeCarryWarning and carry.hasConflict(state, self.maskThresholds):
+			self.report(FINDING_CARRY, ((LOC_SREG, "C"), location), (carry, state))
+		return state.combinedWith(carry)
+	
+	def setFlag(self, value, flags):
+		self.setFlags(flags, makeState(None, 0, True, value))
+	
+	def setFlagBit(self, bit, value):
+		flag = SREG_BITS[constToInt(bit)]
+		if flag == "T":
+			self.loadT(value)
+		else:
+			self.setFlag(value, flag)
 	
 	# generic handlers
-	def combine(self, op1, op2):
-		self.registers[op1].combineWith(self.registers[op2])
+	def combine(self, op1, op2, flags=""):
+		self.combineValue(self.registers[op1], self.registers[op2].state, (LOC_REG, op1))
+		self.setFlags(flags, self.registers[op1].state)
 	
-	def combineCarry(self, op1, op2):
-		if self.unsafeCarryWarning:
-			print(createWarning("This instruction uses the Carry Flag!\nIt is potentially unsafe if CF contain secret shares.") )
-			print("To disable this warning use: \"dev.unsafeCarryWarning=False\"")
-			
-		self.combine(self, op1, op2)
+	def xor(self, op1, op2, flags=""):
+		self.combineValue(self.registers[op1], self.registers[op2].state, (LOC_REG, op1), True)
+		self.setFlags(flags, self.registers[op1].state)
+	
+	def combineCarry(self, op1, op2, flags):
+		self.combine(op1, op2)
+		cell = self.registers[op1]
+		cell.state = self.addCarry(cell.state, (LOC_REG, op1))
+		self.setFlags(flags, cell.state)
+	
+	def compare(self, op1, op2, flags):
+		"""op1 - op2 only changes the flags, the two values are combined in the ALU"""
+		state1, state2 = self.registers[op1].state, self.registers[op2].state
+		if state1.hasConflict(state2, self.maskThresholds):
+			self.report(FINDING_VALUE, ((LOC_REG, op1), (LOC_REG, op2)), (state1, state2))
+		self.setFlags(flags, state1.combinedWith(state2))
+	
+	def compareCarry(self, op1, op2, flags):
+		self.compare(op1, op2, "")
+		state = self.registers[op1].state.combinedWith(self.registers[op2].state)
+		self.setFlags(flags, self.addCarry(state, (LOC_REG, op1)))
+	
+	def compareImmediate(self, regId, const, flags):
+		self.test(regId, flags)
+	
+	def test(self, regId, flags):
+		"""the register is only read, the flags depend on its value"""
+		self.checkNeighbours(regId)
+		self.setFlags(flags, self.registers[regId].state)
+	
+	def testBit(self, regId, bit):
+		"""a bit of the register is read (sbrc, sbrs)"""
+		self.checkNeighbours(regId)
+	
+	def unary(self, regId, operation, flags=""):
+		"""Rd <- operation(Rd), a constant stays a constant and the shares of a value stay in the value"""
+		self.checkNeighbours(regId)
+		cell = self.registers[regId]
+		if cell.const:
+			cell.setToConst(foldConst(operation, cell.constVal))
+		self.setFlags(flags, cell.state)
 	
-	def mulCombine(self, op1, op2):
+	def unaryCarry(self, regId, flags):
+		"""Rd <- operation(Rd, C), e.g. rol, ror"""
+		self.checkNeighbours(regId)
+		cell = self.registers[regId]
+		cell.state = self.addCarry(cell.state, (LOC_REG, regId))
+		self.setFlags(flags, cell.state)
+	
+	def immediate(self, regId, const, operation, flags):
+		"""Rd <- operation(Rd, K), a constant does not change the shares of a value"""
+		self.checkNeighbours(regId)
+		cell = self.registers[regId]
+		if cell.const:
+			cell.setToConst(foldConst(operation, cell.constVal, const))
+		self.setFlags(flags, cell.state)
+	
+	def immediateCarry(self, regId, const, flags):
+		self.unaryCarry(regId, flags)
+	
+	def addWord(self, pair, const, sign, flags):
+		"""Rd+1:Rd <- Rd+1:Rd + sign*K, used on pointers (adiw, sbiw)"""
+		self.checkNeighbours(pair[LOW])
+		self.checkNeighbours(pair[HIGH])
+		low, high = self.registers[pair[LOW]], self.registers[pair[HIGH]]
+		if low.const and high.const:
+			offset = constToInt(const)
+			if low.constVal is None or high.constVal is None or offset is None:
+				low.setToConst()
+				high.setToConst()
+			else:
+				self.setPointer(pair, offsetAddress(self.getAdrFromPointer(pair), sign*offset))
+		self.setFlags(flags, high.state if high.state is low.state else high.state.combinedWith(low.state))
+	
+	def mulCombine(self, op1, op2, flags=""):
 		# MUL Rd, Rr =>  R1:R0 <- Rd * Rr
-		exceptMsg = []
-		tmp = TrackedValue()
-		tmp.replaceBy(self.registers[op1])
-		try:
-			tmp.combineWith(self.registers[op2])
-		except Exception as e:
-			exceptMsg.append(str(e))
-		try:
-			self.registers[0].replaceBy(tmp)
-		except Exception as e:
-			exceptMsg.append(str(e)+" [reg 0]")
-		try:
-			self.registers[1].replaceBy(tmp)
-		except Exception as e:
-			exceptMsg.append(str(e)+" [reg 1]")
-		
-		raise( Exception("\n".join(exceptMsg)) )
+		tmp = TrackedValue(self.registers[op1].state)
+		self.combineValue(tmp, self.registers[op2].state, (LOC_REG, op1))
+		self.writeValue(self.registers[0], tmp.state, (LOC_REG, 0))
+		self.writeValue(self.registers[1], tmp.state, (LOC_REG, 1))
+		self.setFlags(flags, tmp.state)
 		
 	#special handlers
 	def mov(self, regId1, regId2):
 		self.checkNeighbours(regId1)
 		self.checkNeighbours(regId2)
-		self.registers[regId1].replaceBy(self.registers[regId2])
+		self.writeValue(self.registers[regId1], self.registers[regId2].state, (LOC_REG, regId1), (LOC_REG, regId2))
 	
 	def bst(self, regId, bit):
 		self.checkNeighbours(regId)
-		self.bitStorage.replaceBy(self.registers[regId])
+		self.writeValue(self.bitStorage, self.registers[regId].state, (LOC_T,), (LOC_REG, regId))
 		
 	def bld(self, regId, bit):
-		self.registers[regId].replaceBy(self.bitStorage)
+		self.writeValue(self.registers[regId], self.bitStorage.state, (LOC_REG, regId), (LOC_T,))
+	
+	def loadT(self, bit):
+		self.bitStorage.setToConst(bit)
+	
+	def movw(self, pair1, pair2):
+		self.mov(pair1[LOW], pair2[LOW])
+		self.mov(pair1[HIGH], pair2[HIGH])
 	
 	def getAdrFromSpecialRegister(self, reg): # X, Y or Z
-		realRegs = self.specialRegisters[reg]
+		return self.getAdrFromPointer(self.specialRegisters[reg])
+	
+	def getAdrFromPointer(self, realRegs): # (low, high) register indexes
 		highId, lowId = realRegs[HIGH], realRegs[LOW]
+		if self.registers[highId].constVal is None or self.registers[lowId].constVal is None:
+			raise(Exception(createError("The address in R{0}:R{1} is not a known constant".format(highId, lowId))))
 		
 		# TODO
 		# Here we suppose that we do not have any troubles with adresses
@@ -258,51 +1099,137 @@ class Device:
 		
 		return res
 	
-	def ldi(self, regId, const):
-		realId = regId
-		if isinstance(regId, str):
-			if len(regId) == 2: # [REG][High/Low], e.g. XH, XL or ZH, ZL
-				if regId[1].lower() == 'h':
-					realId = self.specialRegisters[regId[0]][HIGH]
-				elif regId[1].lower() == 'l':
-					realId = self.specialRegisters[regId[0]][LOW]
-				else:
-					raise(Exception("Unknown register {0}".format(regId)))
-			else:
-				raise(Exception("Unknown register {0}".format(regId)))
-		self.checkNeighbours(realId)
-		self.registers[realId].setToConst(const)
+	def setPointer(self, realRegs, adr):
+		"""(low, high) registers <- address (a label is kept in the low register)"""
+		if isinstance(adr, int):
+			low, high = adr & 0xFF, adr >> 8
+		else:
+			low, high = adr, ""
+		self.registers[realRegs[LOW]].setToConst(low)
+		self.registers[realRegs[HIGH]].setToConst(high)
+	
+	def getAdrFromStep(self, realRegs, step):
+		"""returns the address of a pointer access and updates the pointer (post-increment / pre-decrement)"""
+		adr = self.getAdrFromPointer(realRegs)
+		if step == PRE_DECREMENT:
+			adr = offsetAddress(adr, step)
+			self.setPointer(realRegs, adr)
+		elif step == POST_INCREMENT:
+			self.setPointer(realRegs, offsetAddress(adr, step))
+		return adr
+	
+	def ldi(self, regId, const, flags=""): # regId is resolved at compile time (e.g. XH)
+		self.checkNeighbours(regId)
+		self.registers[regId].setToConst(const)
+		self.setFlags(flags, self.registers[regId].state)
 	
 	def lds(self, regId, adr):
 		self.checkNeighbours(regId)
-		self.registers[regId].replaceBy(self.memory[adr])
+		state = self.memory.load(adr)
+		if self.transitionWarning:
+			self.busTransfer(state)
+		self.writeValue(self.registers[regId], state, (LOC_REG, regId), (LOC_MEM, adr))
+	
+	def ioIn(self, regId, adr):
+		"""Rd <- I/O register, SREG combines the values of all the flags"""
+		if adr != SREG_ADDRESS:
+			self.lds(regId, adr)
+			return
+		self.checkNeighbours(regId)
+		sreg = TrackedValue(self.bitStorage.state)
+		for flag in STATUS_FLAGS:
+			state = self.flags[flag].state
+			if state is not sreg.state:
+				self.combineValue(sreg, state, (LOC_SREG, flag))
+		self.writeValue(self.registers[regId], sreg.state, (LOC_REG, regId))
+	
+	def ioOut(self, adr, regId):
+		"""I/O register <- Rd, every flag of SREG gets the value of Rd"""
+		if adr != SREG_ADDRESS:
+			self.sts(adr, regId)
+			return
+		self.checkNeighbours(regId)
+		state = self.registers[regId].state
+		self.writeValue(self.bitStorage, state, (LOC_T,), (LOC_REG, regId))
+		self.setFlags(STATUS_FLAGS, state)
+	
+	def ld(self, regId, adrReg, step=0):
+		self.checkNeighbours(regId)
+		adr = self.getAdrFromStep(adrReg, step)
+		state = self.memory.load(adr)
+		if self.transitionWarning:
+			self.busTransfer(state)
+		self.writeValue(self.registers[regId], state, (LOC_REG, regId), (LOC_MEM, adr))
+	
+	def ldd(self, regId, displaced):
+		adrReg, displacement = displaced
+		self.lds(regId, offsetAddress(self.getAdrFromPointer(adrReg), displacement))
+	
+	def st(self, adrReg, regId, step=0):
+		self.checkNeighbours(regId)
+		adr = self.getAdrFromStep(adrReg, step)
+		if self.transitionWarning:
+			self.busTransfer(self.registers[regId].state)
+		self.storeValue(adr, self.registers[regId].state, (LOC_REG, regId))
+	
+	def std(self, displaced, regId):
+		adrReg, displacement = displaced
+		self.sts(offsetAddress(self.getAdrFromPointer(adrReg), displacement), regId)
 	
-	def ld(self, regId, adrReg):
+	def exchange(self, adrReg, regId, combined, xor=False):
+		"""MEM[Z] <-> Rd (xch), or MEM[Z] <- MEM[Z] combined with Rd (las, lac, lat)"""
 		self.checkNeighbours(regId)
-		adr = self.getAdrFromSpecialRegister(adrReg)
-		self.registers[regId].replaceBy(self.memory[adr])
+		adr = self.getAdrFromPointer(adrReg)
+		memState, regState = self.memory.load(adr), self.registers[regId].state
+		if self.transitionWarning:
+			self.busTransfer(memState)
+			self.busTransfer(regState)
+		if combined:
+			self.storeValue(adr, memState.xoredWith(regState) if xor else memState.combinedWith(regState))
+		else:
+			self.storeValue(adr, regState, (LOC_REG, regId))
+		self.writeValue(self.registers[regId], memState, (LOC_REG, regId), (LOC_MEM, adr))
 	
-	def st(self, adrReg, regId):
+	def lpm(self, regId, adrReg, step=0):
+		"""Rd <- FLASH[Z], a table lookup with a secret index keeps the shares of the index"""
 		self.checkNeighbours(regId)
-		adr = self.getAdrFromSpecialRegister(adrReg)
-		self.memory[adr].replaceBy(self.registers[regId])
+		low, high = self.registers[adrReg[LOW]].state, self.registers[adrReg[HIGH]].state
+		if low.const and high.const:
+			state = FLASH_DATA
+			if step and low.constVal is not None and high.constVal is not None:
+				self.getAdrFromStep(adrReg, step)
+		else:
+			state = low.combinedWith(high)
+		self.writeValue(self.registers[regId], state, (LOC_REG, regId))
+	
+	def dataWord(self, word):
+		"""a word of data of the program memory is only reported if it is reached"""
+		self.report(FINDING_INSTRUCTION, detail="Data word {0:#06x} of the program memory is executed.".format(constToInt(word)))
 	
 	def sts(self, adr, regId):
 		self.checkNeighbours(regId)
-		self.memory[adr].replaceBy(self.registers[regId])
+		if self.transitionWarning:
+			self.busTransfer(self.registers[regId].state)
+		self.storeValue(adr, self.registers[regId].state, (LOC_REG, regId))
 	
 	def push(self, regId):
 		self.checkNeighbours(regId)
+		if self.transitionWarning:
+			self.busTransfer(self.registers[regId].state)
 		if self.sp == len(self.stack): #using new memory cells
-			self.stack.append(self.registers[regId])
+			self.stack.append(TrackedValue(self.registers[regId].state)) # a copy, not the register itself
+			if self.tracer is not None:
+				self.tracer.sources[DEST_STACK + self.sp] = DEST_REG + regId
 		else: # some stack was already used and we are now rewriting on top of it
-			self.stack[self.sp].replaceBy(self.registers[regId])
+			self.writeValue(self.stack[self.sp], self.registers[regId].state, (LOC_STACK, self.sp), (LOC_REG, regId))
 		self.sp += 1
 	
 	def pop(self, regId):
 		self.checkNeighbours(regId)
 		self.sp-=1
-		self.registers[regId].replaceBy(self.stack[self.sp])
+		if self.transitionWarning:
+			self.busTransfer(self.stack[self.sp].state)
+		self.writeValue(self.registers[regId], self.stack[self.sp].state, (LOC_REG, regId), (LOC_STACK, self.sp))
 	
 if __name__ == "__main__":
 	class Instruction():
@@ -357,6 +1284,7 @@ if __name__ == "__main__":
 	dev.registers[9].loadMask(("a", 0))
 	
 	dev.runProgram()
+	dev.printFindings()
 	
 	print("-------- EXEC LOAD/STORE --------")
 	dev1 = Device()
@@ -372,15 +1300,17 @@ if __name__ == "__main__":
 	
 	dev1.loadProgram(program, config)
 	
-	dev1.memory["adr1"] = TrackedValue()
-	dev1.memory["adr2"] = TrackedValue()
-	dev1.memory["adr1"].loadMask(("a", 1))
-	dev1.memory["adr2"].loadMask(("b", 1))
+	value = TrackedValue()
+	value.loadMask(("a", 1))
+	dev1.memory["adr1"] = value
+	value.loadMask(("b", 1))
+	dev1.memory["adr2"] = value
 	dev1.registers[0].loadMask(("a", 1))
 	dev1.registers[1].loadMask(("a", 0))
 	
 	
 	dev1.runProgram()
+	dev1.printFindings()
 	
 	#print("Mem:")
 	#dev1.printMemory()
@@ -401,6 +1331,7 @@ if __name__ == "__main__":
 	dev2.loadProgram(program, config)
 	
 	dev2.runProgram()
+	dev2.printFindings()
 	print("------------ END ------------")
 	
 	print("-------- EXEC MASKING XOR --------")
@@ -420,6 +1351,172 @@ if __name__ == "__main__":
 	dev3.loadProgram(program, config)
 	
 	dev3.runProgram()
+	dev3.printFindings()
 	print("------------ END ------------")
 	
 	
+	
+	print("-------- EXEC LOOP --------")
+	
+	dev4 = Device()
+	program = [
+				Instruction("label", "loop"),\
+				Instruction("eor", 2, 3),\
+				Instruction("mov", 4, 2),\
+				Instruction("brne", "loop"),\
+				Instruction("rcall", "sub"),\
+				Instruction("rjmp", "end"),\
+				Instruction("label", "sub"),\
+				Instruction("eor", 6, 2),\
+				Instruction("ret"),\
+				Instruction("label", "end")]
+	
+	dev4.registers[2].loadMask(("a",0))
+	dev4.registers[3].loadMask(("a",1))
+	dev4.registers[6].setToRandom()
+	dev4.loadProgram(program, config)
+	
+	dev4.runProgram()
+	dev4.printFindings()
+	dev4.printRegisters()
+	print("------------ END ------------")
+	
+	
+	
+	print("-------- EXEC CARRY --------")
+	
+	dev7 = Device()
+	program = [
+				Instruction("add", 2, 4),\
+				Instruction("adc", 3, 5),\
+				Instruction("add", 6, 8),\
+				Instruction("adc", 7, 9),\
+				Instruction("add", 10, 12),\
+				Instruction("adc", 11, 12),\
+				Instruction("in", 0, "SREG")]
+	
+	dev7.registers[2].loadMask(("a",0)) # 16 bit share 0 + randoms, no finding
+	dev7.registers[3].loadMask(("a",0))
+	dev7.registers[4].setToRandom("r0")
+	dev7.registers[5].setToRandom("r1")
+	dev7.registers[6].loadMask(("a",1)) # 16 bit share 1 + randoms, no finding
+	dev7.registers[7].loadMask(("a",1))
+	dev7.registers[8].setToRandom("r2")
+	dev7.registers[9].setToRandom("r3")
+	dev7.registers[10].loadMask(("b",0)) # the carry of share 0 is added to share 1
+	dev7.registers[11].loadMask(("b",1))
+	dev7.registers[12].setToConst(0)
+	dev7.loadProgram(program, config)
+	
+	dev7.runProgram()
+	dev7.printFindings()
+	dev7.printFlags()
+	print("------------ END ------------")
+	
+	
+	
+	print("-------- EXEC RANDOMS --------")
+	
+	dev9 = Device()
+	program = [
+				Instruction("and", 1, 2),\
+				Instruction("eor", 3, 4)]
+	
+	dev9.registers[1].loadMask(("a",0)) # share 0 masked by r0
+	dev9.registers[1].addRandom("r0")
+	dev9.registers[2].setToRandom("r0")
+	dev9.registers[3].loadMask(("a",0))
+	dev9.registers[3].addRandom("r0")
+	dev9.registers[4].setToRandom("r0")
+	dev9.loadProgram(program, config)
+	
+	dev9.runProgram()
+	print("and keeps the random:", dev9.registers[1], " eor cancels it:", dev9.registers[3])
+	print("------------ END ------------")
+	
+	
+	
+	print("-------- SNAPSHOTS --------")
+	
+	dev5 = Device()
+	program = [
+				Instruction("lds", 1, 0xA000),\
+				Instruction("lds", 2, 0xA001),\
+				Instruction("sts", 0xB000, 1),\
+				Instruction("eor", 1, 2),\
+				Instruction("sts", 0xB001, 1)]
+	
+	dev5.loadProgram(program, ([], [(0xA000, "a", 0), (0xA001, "a", 1)]))
+	dev5.checkpointInterval = 2
+	dev5.runProgram()
+	end = dev5.snapshot()
+	print("Checkpoints:", sorted(dev5.checkpoints))
+	print("Findings:", len(dev5.findings))
+	
+	dev5.rewind(3)
+	print("Rewind to line 3, MEM[0XB001]:", dev5.memory.load(0xB001), "findings:", len(dev5.findings))
+	dev5.restore(end)
+	print("Restore end, MEM[0XB001]:", dev5.memory.load(0xB001), "findings:", len(dev5.findings))
+	print("Checkpoint memory is unchanged:", dev5.checkpoints[2].state.memory.load(0xB000))
+	
+	program = program[:3] + [Instruction("mov", 1, 1)] + program[3:]
+	print("Reanalyse from / until:", dev5.reanalyse(program), "findings:", len(dev5.findings))
+	print("------------ END ------------")
+	
+	
+	
+	print("-------- TRACE --------")
+	
+	import os, tempfile
+	
+	dev6 = Device()
+	program = [
+				Instruction("lds", 1, 0xA000),\
+				Instruction("mov", 4, 1),\
+				Instruction("push", 4),\
+				Instruction("lds", 2, 0xA001),\
+				Instruction("sts", 0xB000, 2),\
+				Instruction("pop", 6)]
+	
+	dev6.loadProgram(program, ([], [(0xA000, "a", 0), (0xA001, "a", 1)]))
+	filename = os.path.join(tempfile.mkdtemp(), "dev6.trace")
+	dev6.startTrace(filename)
+	dev6.runProgram()
+	dev6.stopTrace()
+	
+	trace = Trace(filename)
+	print("Records:", len(trace), "steps:", trace.getStepCount())
+	print("Lines with share 1 of a:", trace.getPcsWithMask("a", 1))
+	origin = trace.getOrigin(DEST_REG + 6, trace.getStepCount())
+	print("Origin of R6: step", origin[0], locationToStr(trace.getLocation(origin[2])))
+	dev6.replay(trace, 3)
+	print("After step 3, R4:", dev6.registers[4], "stack:", dev6.stack[0], "MEM[0XB000]:", dev6.memory.load(0xB000))
+	trace.close()
+	
+	# R6 holds a value equal to the loaded one, it is not its origin
+	dev8 = Device()
+	program = [
+				Instruction("mov", 7, 6),\
+				Instruction("lds", 3, 0xA000),\
+				Instruction("eor", 4, 5),\
+				Instruction("push", 4),\
+				Instruction("pop", 3)]
+	dev8.loadProgram(program, ([], [(0xA000, "a", 0)]))
+	dev8.registers[6].loadMask(("a", 0))
+	dev8.registers[4].loadMask(("b", 0))
+	dev8.registers[5].setToRandom()
+	dev8.transitionWarning = True # the loads and stores go through the bus
+	filename = os.path.join(tempfile.mkdtemp(), "dev8.trace")
+	dev8.startTrace(filename)
+	dev8.runProgram()
+	dev8.stopTrace()
+	
+	trace = Trace(filename)
+	origin = trace.getOrigin(DEST_REG + 3, 2)
+	print("Origin of R3 after step 2: step", origin[0], locationToStr(trace.getLocation(origin[2])))
+	origin = trace.getOrigin(DEST_REG + 3, trace.getStepCount())
+	print("Origin of R3 at the end: step", origin[0], locationToStr(trace.getLocation(origin[2])))
+	dev8.replay(trace, 3)
+	print("After step 3, Z flag:", dev8.flags["Z"], "bus:", dev8.busState)
+	trace.close()
+	print("------------ END ------------")
@@ -0,0 +1,226 @@
+#!python3
+
+"""
+Declarative description of the AVR-8 instruction set used by the Device.
+Every mnemonic of the parsers (see parser_avr_8*.py) has an IsaEntry:
+	handler: name of the Device method that simulates the instruction
+			 (None: no effect on the tracked values, e.g. control flow or I/O bits)
+	operandTypes: how the operands are resolved at compile time (OP_*)
+	written: operand positions of the registers written by the handler
+			 (a pointer or a register pair writes both of its registers)
+	registers: registers that are always written (e.g. R1:R0 for mul)
+	flagsRead, flagsWritten: SREG flags used and changed by the instruction ("ITHSVNZC"),
+			 the handler of an instruction that writes status flags gets them as its last operand
+	extra: operands added after the operands of the instruction (e.g. a step or an operation)
+	implicit: operands of the short form without operands (e.g. lpm -> lpm r0, Z)
+	bitwise: the bits of a byte are moved (unsafe if shares are in different parts of a byte)
+	implemented: False for a known instruction that is not simulated (it is reported)
+The handlers and the operand tables of the Device are generated from ISA.
+"""
+
+from collections import namedtuple
+
+# types of operands that are resolved at compile time
+OP_ANY = 0 # used as is (register index, constant, address or label)
+OP_REG = 1 # register index or name of a half of a special register, e.g. XH
+OP_PTR = 2 # special register used as a pointer: X, Y or Z
+OP_PAIR = 3 # register pair given by its low register (movw, adiw), e.g. 24 or X
+OP_DISP = 4 # pointer with a displacement, e.g. Y+5 (ldd, std)
+OP_IO = 5 # I/O address, resolved to its address in the data space
+
+# offset of the I/O registers in the data space (in / out)
+IO_OFFSET = 0x20
+# I/O registers that can be given by name
+IO_REGISTERS = {"SREG": 0x3F, "__SREG__": 0x3F, "SPH": 0x3E, "__SP_H__": 0x3E, "SPL": 0x3D, "__SP_L__": 0x3D}
+SREG_ADDRESS = IO_REGISTERS["SREG"] + IO_OFFSET
+
+# SREG flags in the order of their bits, the T flag is the bit storage of the Device
+SREG_BITS = "CZNVSHTI"
+STATUS_FLAGS = SREG_BITS.replace("T", "")
+
+# steps of the pointer of ld, st, lpm
+POST_INCREMENT = 1
+PRE_DECREMENT = -1
+
+IsaEntry = namedtuple("IsaEntry", "handler operandTypes written registers flagsRead flagsWritten extra implicit bitwise implemented",\
+					  defaults=((), (), (), "", "", (), (), False, True))
+
+def constToInt(value):
+	"""returns a constant operand or register value as an int (None if it is not a number, e.g. a label)"""
+	if isinstance(value, int):
+		return value
+	try:
+		return int(value, 0)
+	except (TypeError, ValueError):
+		return None
+
+def foldConst(operation, *values):
+	"""returns the result of an operation on known constants (None if it is not known)"""
+	values = [constToInt(value) for value in values]
+	if operation is None or None in values:
+		return None
+	return operation(*values)
+
+# operations on known constants (None: the result is not known, e.g. it depends on the carry)
+def inc(a): return (a + 1) & 0xFF
+def dec(a): return (a - 1) & 0xFF
+def com(a): return a ^ 0xFF
+def neg(a): return -a & 0xFF
+def lsl(a): return (a << 1) & 0xFF
+def lsr(a): return a >> 1
+def asr(a): return (a >> 1) | (a & 0x80)
+def swap(a): return ((a << 4) | (a >> 4)) & 0xFF
+def subi(a, k): return (a - k) & 0xFF
+def andi(a, k): return a & k
+def ori(a, k): return a | k
+def cbr(a, k): return a & ~k & 0xFF
+
+REG = (OP_REG,)
+REG_REG = (OP_REG, OP_REG)
+REG_CONST = (OP_REG, OP_ANY)
+ARITHMETIC = "HSVNZC"
+LOGIC = "SVNZ"
+
+ISA = {
+	# register transfers
+	"mov":    IsaEntry("mov", REG_REG, (0,)),
+	"movw":   IsaEntry("movw", (OP_PAIR, OP_PAIR), (0,)),
+	"ldi":    IsaEntry("ldi", REG_CONST, (0,)),
+	"clr":    IsaEntry("ldi", REG, (0,), flagsWritten=LOGIC, extra=(0,)),
+	"ser":    IsaEntry("ldi", REG, (0,), extra=(0xFF,)),
+
+	# Rd <- Rd op Rr
+	"add":    IsaEntry("combine", REG_REG, (0,), flagsWritten=ARITHMETIC),
+	"adc":    IsaEntry("combineCarry", REG_REG, (0,), flagsRead="C", flagsWritten=ARITHMETIC),
+	"sub":    IsaEntry("combine", REG_REG, (0,), flagsWritten=ARITHMETIC),
+	"sbc":    IsaEntry("combineCarry", REG_REG, (0,), flagsRead="CZ", flagsWritten=ARITHMETIC),
+	"and":    IsaEntry("combine", REG_REG, (0,), flagsWritten=LOGIC),
+	"or":     IsaEntry("combine", REG_REG, (0,), flagsWritten=LOGIC),
+	"eor":    IsaEntry("xor", REG_REG, (0,), flagsWritten=LOGIC),
+	# Rd - Rr, only the flags are written
+	"cp":     IsaEntry("compare", REG_REG, flagsWritten=ARITHMETIC),
+	"cpc":    IsaEntry("compareCarry", REG_REG, flagsRead="CZ", flagsWritten=ARITHMETIC),
+
+	# Rd <- Rd op K
+	"subi":   IsaEntry("immediate", REG_CONST, (0,), flagsWritten=ARITHMETIC, extra=(subi,)),
+	"sbci":   IsaEntry("immediateCarry", REG_CONST, (0,), flagsRead="CZ", flagsWritten=ARITHMETIC),
+	"andi":   IsaEntry("immediate", REG_CONST, (0,), flagsWritten=LOGIC, extra=(andi,)),
+	"cbr":    IsaEntry("immediate", REG_CONST, (0,), flagsWritten=LOGIC, extra=(cbr,)),
+	"ori":    IsaEntry("immediate", REG_CONST, (0,), flagsWritten=LOGIC, extra=(ori,)),
+	"sbr":    IsaEntry("immediate", REG_CONST, (0,), flagsWritten=LOGIC, extra=(ori,)),
+	"cpi":    IsaEntry("compareImmediate", REG_CONST, flagsWritten=ARITHMETIC),
+	"tst":    IsaEntry("test", REG, flagsWritten=LOGIC),
+	# Rd+1:Rd <- Rd+1:Rd +/- K
+	"adiw":   IsaEntry("addWord", (OP_PAIR, OP_ANY), (0,), flagsWritten="SVNZC", extra=(1,)),
+	"sbiw":   IsaEntry("addWord", (OP_PAIR, OP_ANY), (0,), flagsWritten="SVNZC", extra=(-1,)),
+
+	# Rd <- op Rd
+	"inc":    IsaEntry("unary", REG, (0,), flagsWritten=LOGIC, extra=(inc,)),
+	"dec":    IsaEntry("unary", REG, (0,), flagsWritten=LOGIC, extra=(dec,)),
+	"com":    IsaEntry("unary", REG, (0,), flagsWritten="SVNZC", extra=(com,)),
+	"neg":    IsaEntry("unary", REG, (0,), flagsWritten=ARITHMETIC, extra=(neg,)),
+	"lsl":    IsaEntry("unary", REG, (0,), flagsWritten=ARITHMETIC, extra=(lsl,), bitwise=True),
+	"rol":    IsaEntry("unaryCarry", REG, (0,), flagsRead="C", flagsWritten=ARITHMETIC, bitwise=True),
+	"lsr":    IsaEntry("unary", REG, (0,), flagsWritten="SVNZC", extra=(lsr,), bitwise=True),
+	"ror":    IsaEntry("unaryCarry", REG, (0,), flagsRead="C", flagsWritten="SVNZC", bitwise=True),
+	"asr":    IsaEntry("unary", REG, (0,), flagsWritten="SVNZC", extra=(asr,), bitwise=True),
+	"swap":   IsaEntry("unary", REG, (0,), extra=(swap,), bitwise=True),
+
+	# R1:R0 <- Rd * Rr
+	"mul":    IsaEntry("mulCombine", REG_REG, registers=(0,1), flagsWritten="ZC"),
+	"muls":   IsaEntry("mulCombine", REG_REG, registers=(0,1), flagsWritten="ZC"),
+	"mulsu":  IsaEntry("mulCombine", REG_REG, registers=(0,1), flagsWritten="ZC"),
+	"fmul":   IsaEntry("mulCombine", REG_REG, registers=(0,1), flagsWritten="ZC"),
+	"fmuls":  IsaEntry("mulCombine", REG_REG, registers=(0,1), flagsWritten="ZC"),
+	"fmulsu": IsaEntry("mulCombine", REG_REG, registers=(0,1), flagsWritten="ZC"),
+
+	# bits
+	"bst":    IsaEntry("bst", REG_CONST, flagsWritten="T"),
+	"bld":    IsaEntry("bld", REG_CONST, (0,), flagsRead="T"),
+	"set":    IsaEntry("loadT", flagsWritten="T", extra=(1,)),
+	"clt":    IsaEntry("loadT", flagsWritten="T", extra=(0,)),
+	"cbi":    IsaEntry(None),
+	"sbi":    IsaEntry(None),
+	"bset":   IsaEntry("setFlagBit", (OP_ANY,), extra=(1,)),
+	"bclr":   IsaEntry("setFlagBit", (OP_ANY,), extra=(0,)),
+
+	# data space
+	"lds":    IsaEntry("lds", REG_CONST, (0,)),
+	"sts":    IsaEntry("sts", (OP_ANY, OP_REG)),
+	"in":     IsaEntry("ioIn", (OP_REG, OP_IO), (0,)),
+	"out":    IsaEntry("ioOut", (OP_IO, OP_REG)),
+	"ld":     IsaEntry("ld", (OP_REG, OP_PTR), (0,)),
+	"ld+":    IsaEntry("ld", (OP_REG, OP_PTR), (0, 1), extra=(POST_INCREMENT,)),
+	"ld-":    IsaEntry("ld", (OP_REG, OP_PTR), (0, 1), extra=(PRE_DECREMENT,)),
+	"ldd":    IsaEntry("ldd", (OP_REG, OP_DISP), (0,)),
+	"st":     IsaEntry("st", (OP_PTR, OP_REG)),
+	"st+":    IsaEntry("st", (OP_PTR, OP_REG), (0,), extra=(POST_INCREMENT,)),
+	"st-":    IsaEntry("st", (OP_PTR, OP_REG), (0,), extra=(PRE_DECREMENT,)),
+	"std":    IsaEntry("std", (OP_DISP, OP_REG)),
+	"xch":    IsaEntry("exchange", (OP_PTR, OP_REG), (1,), extra=(False,)),
+	"las":    IsaEntry("exchange", (OP_PTR, OP_REG), (1,), extra=(True,)),
+	"lac":    IsaEntry("exchange", (OP_PTR, OP_REG), (1,), extra=(True,)),
+	"lat":    IsaEntry("exchange", (OP_PTR, OP_REG), (1,), extra=(True, True)),
+	"push":   IsaEntry("push", REG),
+	"pop":    IsaEntry("pop", REG, (0,)),
+
+	# program memory
+	"lpm":    IsaEntry("lpm", (OP_REG, OP_PTR), (0,), implicit=(0, "Z")),
+	"lpm+":   IsaEntry("lpm", (OP_REG, OP_PTR), (0, 1), extra=(POST_INCREMENT,)),
+	"elpm":   IsaEntry("lpm", (OP_REG, OP_PTR), (0,), implicit=(0, "Z")),
+	"elpm+":  IsaEntry("lpm", (OP_REG, OP_PTR), (0, 1), extra=(POST_INCREMENT,)),
+	"spm":    IsaEntry(None),
+	"spm+":   IsaEntry(None),
+	".dw":    IsaEntry("dataWord"), # data in the program memory (see parser_avr_8_binary.DATA_WORD)
+
+	# MCU control
+	"nop":    IsaEntry(None),
+	"sleep":  IsaEntry(None),
+	"wdr":    IsaEntry(None),
+	"break":  IsaEntry(None),
+
+	# cryptography (the rounds of the DES are not simulated)
+	"des":    IsaEntry(None, (OP_ANY,), flagsRead="H", implemented=False),
+
+	# control flow (see Device.controlInstructions)
+	"rjmp":   IsaEntry(None),
+	"jmp":    IsaEntry(None),
+	"ijmp":   IsaEntry(None),
+	"eijmp":  IsaEntry(None),
+	"rcall":  IsaEntry(None),
+	"call":   IsaEntry(None),
+	"icall":  IsaEntry(None),
+	"eicall": IsaEntry(None),
+	"ret":    IsaEntry(None),
+	"reti":   IsaEntry(None),
+	"cpse":   IsaEntry("compare", REG_REG, extra=("",)), # the skips read their registers
+	"sbrc":   IsaEntry("testBit", REG_CONST),
+	"sbrs":   IsaEntry("testBit", REG_CONST),
+	"sbic":   IsaEntry(None),
+	"sbis":   IsaEntry(None),
+	"brbs":   IsaEntry(None),
+	"brbc":   IsaEntry(None),
+}
+
+# the instructions that set and clear the SREG flags and the branches that test them
+FLAG_INSTRUCTIONS = {"C": ("sec", "clc", "brcs", "brcc", "brsh", "brlo"),\
+					 "Z": ("sez", "clz", "breq", "brne"),\
+					 "N": ("sen", "cln", "brmi", "brpl"),\
+					 "V": ("sev", "clv", "brvs", "brvc"),\
+					 "S": ("ses", "cls", "brge", "brlt"),\
+					 "H": ("seh", "clh", "brhs", "brhc"),\
+					 "T": ("set", "clt", "brts", "brtc"),\
+					 "I": ("sei", "cli", "brie", "brid")}
+for flag, names in FLAG_INSTRUCTIONS.items():
+	for name, value in zip(names[:2], (1, 0)):
+		if name not in ISA:
+			ISA[name] = IsaEntry("setFlag", flagsWritten=flag, extra=(value,))
+	for name in names[2:]:
+		ISA[name] = IsaEntry(None, flagsRead=flag)
+
+if __name__ == "__main__":
+	print(len(ISA), "instructions")
+	for kind in sorted({entry.handler for entry in ISA.values() if entry.handler is not None}):
+		print(kind + ":", " ".join(name for name, entry in ISA.items() if entry.handler == kind))
+	print("no effect on values:", " ".join(name for name, entry in ISA.items() if entry.handler is None and entry.implemented))
+	print("not implemented:", " ".join(name for name, entry in ISA.items() if not entry.implemented))
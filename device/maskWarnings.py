@@ -2,12 +2,155 @@
 
 class MaskingComplaint(Exception):
 	pass
-	
+
 def createWarning(message):
 	res = "\033[93mWarning!\033[0m "
 	return res+message
-	
+
 def createError(message):
 	res = "\033[91mError!\033[0m "
 	return res+message
 
+# kinds of findings
+FINDING_VALUE = "value" # combination of shares (or identical randoms) in a value
+FINDING_NEIGHBOUR = "neighbour" # shares of the same mask in neighbouring registers
+FINDING_INSTRUCTION = "instruction" # instruction that is not implemented or potentially unsafe
+FINDING_CARRY = "carry" # the carry flag is added to a value that it should not be combined with
+FINDING_ERROR = "error" # the instruction could not be simulated
+FINDING_TRANSITION = "transition" # shares of the same mask one after the other on the load/store bus
+
+# locations: (type, index)
+LOC_REG = "R"
+LOC_MEM = "MEM"
+LOC_STACK = "STACK"
+LOC_T = "T" # bit storage
+LOC_BUS = "BUS" # load/store bus
+LOC_SREG = "SREG" # status flag, e.g. (LOC_SREG, "C")
+
+def locationToStr(location):
+	if location[0] == LOC_REG:
+		return "R{0}".format(location[1])
+	elif location[0] == LOC_MEM:
+		if isinstance(location[1], int):
+			return "MEM[{0:#04X}]".format(location[1])
+		return "MEM[{0}]".format(location[1])
+	elif location[0] == LOC_STACK:
+		return "STACK[{0}]".format(location[1])
+	elif location[0] == LOC_SREG:
+		return "SREG[{0}]".format(location[1])
+	return location[0]
+
+class Finding:
+	"""
+	One problem found by the simulator. Only references are stored
+	(the messages are created when the finding is printed).
+		states: the (immutable) values involved, e.g. (old value, new value)
+		detail: message of an instruction finding or exception of an error
+	"""
+	__slots__ = ("pc", "kind", "instruction", "locations", "states", "detail")
+
+	def __init__(self, pc, kind, instruction=None, locations=(), states=(), detail=None):
+		self.pc = pc
+		self.kind = kind
+		self.instruction = instruction
+		self.locations = locations
+		self.states = states
+		self.detail = detail
+
+	def getMaskIds(self):
+		"""returns the IDs of the masks involved"""
+		if self.kind == FINDING_NEIGHBOUR: # shares of the first register found in the neighbours
+			maskIds = set(self.states[0].getMasksDict())
+			common = set()
+			for state in self.states[1:]:
+				common |= maskIds & set(state.getMasksDict())
+			return common
+
+		maskIds = None
+		for state in self.states:
+			if maskIds is None:
+				maskIds = set(state.getMasksDict())
+			else:
+				maskIds &= set(state.getMasksDict())
+		return maskIds or set()
+
+	def getMessage(self, thresholds={}):
+		"""thresholds: share thresholds of the simulation (see Device.maskThresholds)"""
+		if self.kind == FINDING_VALUE:
+			msg = self.states[0].checkValueCombination(self.states[1], thresholds)
+		elif self.kind == FINDING_NEIGHBOUR:
+			msg = ["Potential neighbouring register Leakage!"]
+			for state in self.states[1:]:
+				tmp = self.states[0].checkMaskCombination(state.masks, thresholds)
+				if len(tmp) != 0:
+					msg.append(tmp)
+			msg = "\n".join(msg)
+		elif self.kind == FINDING_TRANSITION:
+			msg = "Potential transition leakage!\n" + self.states[0].checkValueCombination(self.states[1], thresholds)
+		elif self.kind == FINDING_CARRY:
+			msg = "The carry flag is added to a value!\n" + self.states[0].checkValueCombination(self.states[1], thresholds) +\
+					"\nTo disable this check use: \"dev.unsafeCarryWarning=False\""
+		elif self.kind == FINDING_INSTRUCTION:
+			msg = createWarning(self.detail)
+		else:
+			msg = str(self.detail)
+
+		if len(self.locations) != 0:
+			msg += " [{0}]".format(", ".join(locationToStr(location) for location in self.locations))
+		return msg
+
+	def toStr(self, thresholds={}):
+		line = self.pc if self.instruction is None else self.instruction.line
+		return "At line {0}  >  {1}\n{2}".format(self.pc, line, self.getMessage(thresholds))
+
+	def __str__(self):
+		return self.toStr()
+
+class FindingsCollector:
+	""" Findings of a simulation, in the order they were found
+		unique: a finding is kept only once even if the same code is simulated several times
+	"""
+
+	def __init__(self, unique=False, thresholds=None):
+		self.findings = []
+		self.unique = unique
+		self.seen = set()
+		self.maskThresholds = {} if thresholds is None else thresholds # see Device.maskThresholds
+
+	def getKey(self, finding):
+		detail = finding.detail
+		if not isinstance(detail, str):
+			detail = repr(detail)
+		return (finding.pc, finding.kind, finding.locations, finding.states, detail)
+
+	def add(self, finding):
+		if self.unique:
+			key = self.getKey(finding)
+			if key in self.seen:
+				return
+			self.seen.add(key)
+		self.findings.append(finding)
+
+	def getKind(self, kind):
+		return [finding for finding in self.findings if finding.kind == kind]
+
+	def clear(self):
+		self.findings = []
+		self.seen = set()
+
+	def setFindings(self, findings):
+		"""replaces the findings (e.g. when a simulation is restored from a snapshot)"""
+		self.findings = list(findings)
+		if self.unique:
+			self.seen = {self.getKey(finding) for finding in self.findings}
+
+	def __iter__(self):
+		return iter(self.findings)
+
+	def __len__(self):
+		return len(self.findings)
+
+	def __str__(self):
+		if len(self.findings) == 0:
+			return "[No Findings]"
+		return "\n".join(finding.toStr(self.maskThresholds) for finding in self.findings)
@@ -0,0 +1,210 @@
+#!python3
+
+"""
+This module represents the SRAM of the device.
+Every cell holds the id (uid) of an interned ValueState, cells are stored
+in pages of PAGE_SIZE cells that are allocated on the first write
+(a missing page only contains [Not initialized] cells).
+Copies share their pages, a shared page is copied on the first write (copy on write).
+Labels are mapped to cells that follow the SRAM by a symbol table.
+"""
+
+from array import array
+from tracked_value import *
+
+SRAM_SIZE = 0x10000 # the whole data space (16 bit addresses)
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+
+class Memory:
+	def __init__(self, size=SRAM_SIZE, symbols=None, labels=None):
+		self.size = size
+		self.pages = [None] * ((size + PAGE_SIZE - 1) >> PAGE_BITS)
+		self.ownedPages = set() # pages that are not shared with a copy (written in place)
+		# symbol table, shared by the copies of a memory
+		self.symbols = {} if symbols is None else symbols # label -> cell
+		self.labels = [] if labels is None else labels # cell - size -> label
+
+	# ---- addresses ----
+
+	def getCell(self, adr):
+		"""returns the cell index of an address or a label (a new label gets a new cell)"""
+		if isinstance(adr, int):
+			if adr < 0 or adr >= self.size:
+				raise(Exception(createError("Address {0:#04X} is outside of the SRAM".format(adr))))
+			return adr
+		cell = self.symbols.get(adr)
+		if cell is None:
+			cell = self.size + len(self.labels)
+			self.symbols[adr] = cell
+			self.labels.append(adr)
+		return cell
+
+	def getAddress(self, cell):
+		"""returns the address or the label of a cell"""
+		if cell < self.size:
+			return cell
+		return self.labels[cell - self.size]
+
+	# ---- values ----
+
+	def load(self, adr):
+		cell = self.getCell(adr)
+		pageIndex = cell >> PAGE_BITS
+		if pageIndex >= len(self.pages):
+			return EMPTY
+		page = self.pages[pageIndex]
+		if page is None:
+			return EMPTY
+		return stateList[page[cell & PAGE_MASK]]
+
+	def getWritablePage(self, pageIndex):
+		"""returns a page that can be written in place (allocated or copied if needed)"""
+		if pageIndex in self.ownedPages:
+			return self.pages[pageIndex]
+		if pageIndex >= len(self.pages):
+			self.pages.extend([None] * (pageIndex + 1 - len(self.pages)))
+		page = self.pages[pageIndex]
+		if page is None:
+			page = array("I", bytes(4 * PAGE_SIZE))
+		else:
+			page = array("I", page)
+		self.pages[pageIndex] = page
+		self.ownedPages.add(pageIndex)
+		return page
+
+	def store(self, adr, state):
+		cell = self.getCell(adr)
+		pageIndex = cell >> PAGE_BITS
+		if pageIndex in self.ownedPages:
+			self.pages[pageIndex][cell & PAGE_MASK] = state.uid
+		else:
+			self.getWritablePage(pageIndex)[cell & PAGE_MASK] = state.uid
+
+	def fill(self, addresses, state):
+		"""stores the same state in several cells"""
+		for adr in addresses:
+			self.store(adr, state)
+
+	def fillRandom(self, addresses):
+		"""stores a different random in every cell (the address or label identifies the random)"""
+		for adr in addresses:
+			self.store(adr, makeRandom(adr))
+
+	# TrackedValue interface, a read returns a copy of the cell
+	def __getitem__(self, adr):
+		return TrackedValue(self.load(adr))
+
+	def __setitem__(self, adr, trackedValue):
+		self.store(adr, trackedValue.state)
+
+	def __contains__(self, adr):
+		return self.load(adr) is not EMPTY
+
+	def items(self):
+		"""yields (address or label, state) of the initialized cells"""
+		for pageIndex in range(len(self.pages)):
+			page = self.pages[pageIndex]
+			if page is None:
+				continue
+			for offset in range(PAGE_SIZE):
+				if page[offset] != EMPTY.uid:
+					cell = (pageIndex << PAGE_BITS) | offset
+					yield (self.getAddress(cell), stateList[page[offset]])
+
+	def __len__(self):
+		return sum(1 for item in self.items())
+
+	def cellsWithMask(self, maskId, share=None):
+		"""returns the addresses / labels of the cells that hold (a given share of) a mask"""
+		if maskId not in maskIndex:
+			return []
+		m = maskIndex[maskId]
+		shareBits = -1 if share is None else 1 << share
+		uids = {state.uid for state in stateList if m in state.masks and state.masks[m] & shareBits}
+
+		result = []
+		for pageIndex in range(len(self.pages)):
+			page = self.pages[pageIndex]
+			if page is None or uids.isdisjoint(page):
+				continue
+			for offset in range(PAGE_SIZE):
+				if page[offset] in uids:
+					result.append(self.getAddress((pageIndex << PAGE_BITS) | offset))
+		return result
+
+	def loadConfiguration(self, configuration, symbols={}):
+		""" initializes the random and masked cells given by a Configuration,
+			symbols: label -> address of the labels that name SRAM addresses (e.g. the data symbols of a listing)
+		"""
+		self.fillRandom(configuration.get_list('rand_list_of_addr'))
+		for label in configuration.get_list('rand_list_of_labels'):
+			self.store(symbols.get(label, label), makeRandom(label))
+
+		for mask in configuration.get_list('mask_list_of_addr') + configuration.get_list('mask_list_of_labels'):
+			self.store(symbols.get(mask[0], mask[0]), makeState({internMask(mask[1]): 1 << mask[2]}))
+
+	# ---- copies (snapshots and analysis of programs with control flow) ----
+
+	def copy(self):
+		"""returns a copy that shares the pages (both memories copy a page before writing it)"""
+		memory = Memory(self.size, self.symbols, self.labels)
+		memory.pages = list(self.pages)
+		self.ownedPages = set()
+		return memory
+
+	def joinedWith(self, other):
+		""" returns a memory where every cell is the join of the two cells (see ValueState.joinedWith)
+			a cell that is not initialized on one side keeps the value of the other side
+		"""
+		memory = self.copy()
+		for pageIndex in range(len(other.pages)):
+			otherPage = other.pages[pageIndex]
+			if otherPage is None:
+				continue
+			if pageIndex >= len(memory.pages):
+				memory.pages.extend([None] * (pageIndex + 1 - len(memory.pages)))
+			page = memory.pages[pageIndex]
+			if page is None:
+				memory.pages[pageIndex] = otherPage # shared, copied on write
+			elif page is not otherPage and page != otherPage:
+				page = memory.getWritablePage(pageIndex)
+				for offset in range(PAGE_SIZE):
+					uid, otherUid = page[offset], otherPage[offset]
+					if uid == otherUid or otherUid == EMPTY.uid:
+						continue
+					if uid == EMPTY.uid:
+						page[offset] = otherUid
+					else:
+						page[offset] = stateList[uid].joinedWith(stateList[otherUid]).uid
+		return memory
+
+	# the uids are only valid in one process, the states are pickled instead (see ValueState.__reduce__)
+	def __getstate__(self):
+		pages = tuple((pageIndex, tuple(stateList[uid] for uid in self.pages[pageIndex]))\
+					  for pageIndex in range(len(self.pages)) if self.pages[pageIndex] is not None)
+		return (self.size, self.symbols, self.labels, pages)
+
+	def __setstate__(self, content):
+		size, symbols, labels, pages = content
+		self.__init__(size, symbols, labels)
+		for pageIndex, states in pages:
+			self.getWritablePage(pageIndex)[:] = array("I", (state.uid for state in states))
+
+	def getKey(self):
+		"""hashable form of the content"""
+		return tuple((pageIndex, self.pages[pageIndex].tobytes()) for pageIndex in range(len(self.pages))\
+					 if self.pages[pageIndex] is not None and any(self.pages[pageIndex]))
+
+	def __eq__(self, other):
+		return isinstance(other, Memory) and self.getKey() == other.getKey()
+
+	def __str__(self):
+		memStr = ""
+		for adr, state in self.items():
+			if isinstance(adr, int):
+				memStr+= "{0:#04X}\t{1}\n".format(adr, state)
+			else:
+				memStr+= "{0}\t{1}\n".format(adr, state)
+		return memStr
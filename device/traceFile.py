@@ -0,0 +1,276 @@
+#!python3
+
+"""
+Execution traces of the simulator.
+A trace file is an append-only array of records of 5 unsigned 32-bit integers
+(native byte order): (step, pc, destination, value, source). The step counts the executed
+instructions, the value is the uid of the ValueState written in the destination
+(the stack pointer itself for DEST_SP), the source is the destination the value
+was copied from (moves, loads, stores, the stack) or NO_SOURCE. The states and the labels of the memory
+are saved in a companion file (<trace>.states) when the trace is closed.
+The trace file can be memory-mapped, so long traces are queried without loading them.
+"""
+
+import os
+import mmap
+import pickle
+from array import array
+from tracked_value import *
+from maskWarnings import *
+from memory import *
+from instructionSet import STATUS_FLAGS
+
+# destinations
+DEST_REG = 0 # + register index
+DEST_T = 0x100 # bit storage
+DEST_SP = 0x101 # value: stack pointer
+DEST_RESET = 0x102 # the whole state is replaced by the following records
+DEST_BUS = 0x103 # last value on the load/store bus
+DEST_FLAG = 0x104 # + index of the flag in STATUS_FLAGS
+DEST_STACK = 0x10000000 # + stack index
+DEST_MEM = 0x20000000 # + memory cell (see Memory.getCell)
+
+NO_PC = 0xFFFFFFFF # records that do not come from an instruction
+NO_SOURCE = 0xFFFFFFFF # the value was not copied (e.g. a combination or the initial state)
+RECORD_SIZE = 5 # integers per record
+BUFFER_SIZE = 1 << 16 # integers written at once
+STATES_SUFFIX = ".states"
+TRACE_VERSION = 3
+
+class TraceWriter:
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = open(filename, "wb")
+		self.buffer = array("I")
+		self.step = 0 # number of executed instructions
+		self.sources = {} # destination -> source of the values copied by the current instruction
+
+	def record(self, pc, destination, value, source=NO_SOURCE):
+		self.buffer.extend((self.step, pc, destination, value, source))
+		if len(self.buffer) >= BUFFER_SIZE:
+			self.flush()
+
+	def recordState(self, registers, bitStorage, stack, sp, memory, bus=EMPTY, flags=()):
+		"""records a whole state (e.g. at the beginning or when a state of the analysis is restored)"""
+		self.record(NO_PC, DEST_RESET, 0)
+		for regId in range(len(registers)):
+			if registers[regId] is not EMPTY:
+				self.record(NO_PC, DEST_REG + regId, registers[regId].uid)
+		if bitStorage is not EMPTY:
+			self.record(NO_PC, DEST_T, bitStorage.uid)
+		for index in range(len(stack)):
+			self.record(NO_PC, DEST_STACK + index, stack[index].uid)
+		self.record(NO_PC, DEST_SP, sp)
+		for adr, state in memory.items():
+			self.record(NO_PC, DEST_MEM + memory.getCell(adr), state.uid)
+		if bus is not EMPTY:
+			self.record(NO_PC, DEST_BUS, bus.uid)
+		for index in range(len(flags)):
+			if flags[index] is not EMPTY:
+				self.record(NO_PC, DEST_FLAG + index, flags[index].uid)
+
+	def flush(self):
+		self.buffer.tofile(self.file)
+		self.buffer = array("I")
+
+	def close(self, memory):
+		"""writes the remaining records and the companion file (states and memory labels)"""
+		self.flush()
+		self.file.close()
+		with open(self.filename + STATES_SUFFIX, "wb") as statesFile:
+			pickle.dump({"version":TRACE_VERSION, "states":tuple(stateList), "memorySize":memory.size,\
+						 "labels":list(memory.labels)}, statesFile, pickle.HIGHEST_PROTOCOL)
+
+class Trace:
+	""" read-only access to a trace file (memory-mapped)
+		a record is (step, pc, destination, value, source), see TraceWriter
+	"""
+
+	def __init__(self, filename):
+		with open(filename + STATES_SUFFIX, "rb") as statesFile:
+			companion = pickle.load(statesFile)
+		if companion.get("version") != TRACE_VERSION:
+			raise(Exception(createError("Unknown trace version in {0}".format(filename + STATES_SUFFIX))))
+		self.states = companion["states"] # uid in the file -> ValueState
+		self.memorySize = companion["memorySize"]
+		self.labels = companion["labels"]
+
+		self.file = open(filename, "rb")
+		if os.path.getsize(filename) == 0: # an empty file can not be mapped
+			self.mmap = None
+			self.records = memoryview(array("I"))
+		else:
+			self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+			self.records = memoryview(self.mmap).cast("I")
+
+	def close(self):
+		self.records.release()
+		if self.mmap is not None:
+			self.mmap.close()
+		self.file.close()
+
+	def __len__(self):
+		return len(self.records) // RECORD_SIZE
+
+	def __getitem__(self, index):
+		start = index * RECORD_SIZE
+		return tuple(self.records[start:start + RECORD_SIZE])
+
+	def getStepCount(self):
+		return self.records[-RECORD_SIZE] if len(self) != 0 else 0
+
+	def getIndex(self, step):
+		"""returns the index of the first record after the step (binary search, the steps never decrease)"""
+		low, high = 0, len(self)
+		while low < high:
+			middle = (low + high) // 2
+			if self.records[middle * RECORD_SIZE] <= step:
+				low = middle + 1
+			else:
+				high = middle
+		return low
+
+	# ---- destinations ----
+
+	def getAddress(self, cell):
+		if cell < self.memorySize:
+			return cell
+		return self.labels[cell - self.memorySize]
+
+	def getDestination(self, location):
+		"""returns the destination of a location of a finding, e.g. (LOC_REG, 3)"""
+		if location[0] == LOC_REG:
+			return DEST_REG + location[1]
+		elif location[0] == LOC_STACK:
+			return DEST_STACK + location[1]
+		elif location[0] == LOC_T:
+			return DEST_T
+		elif location[0] == LOC_BUS:
+			return DEST_BUS
+		elif location[0] == LOC_SREG:
+			return DEST_FLAG + STATUS_FLAGS.index(location[1])
+		elif location[0] == LOC_MEM:
+			if isinstance(location[1], int):
+				return DEST_MEM + location[1]
+			return DEST_MEM + self.memorySize + self.labels.index(location[1])
+		raise(Exception(createError("Unknown location {0}".format(location))))
+
+	def getLocation(self, destination):
+		if destination >= DEST_MEM:
+			return (LOC_MEM, self.getAddress(destination - DEST_MEM))
+		elif destination >= DEST_STACK:
+			return (LOC_STACK, destination - DEST_STACK)
+		elif destination == DEST_T:
+			return (LOC_T,)
+		elif destination == DEST_BUS:
+			return (LOC_BUS,)
+		elif DEST_FLAG <= destination < DEST_FLAG + len(STATUS_FLAGS):
+			return (LOC_SREG, STATUS_FLAGS[destination - DEST_FLAG])
+		elif destination < DEST_T:
+			return (LOC_REG, destination - DEST_REG)
+		return None # stack pointer or reset
+
+	# ---- queries ----
+
+	def getUidsWithMask(self, maskId, share=None):
+		"""returns the uids (in the file) of the states that hold (a given share of) a mask"""
+		if maskId not in maskIndex:
+			return set()
+		m = maskIndex[maskId]
+		shareBits = -1 if share is None else 1 << share
+		return {uid for uid in range(len(self.states)) if m in self.states[uid].masks and self.states[uid].masks[m] & shareBits}
+
+	def findMask(self, maskId, share=None):
+		"""returns the records (step, pc, destination, value, source) of the instructions that wrote (a given share of) a mask"""
+		uids = self.getUidsWithMask(maskId, share)
+		records = self.records
+		result = []
+		for start in range(0, len(records), RECORD_SIZE):
+			if records[start + 3] in uids and records[start + 1] != NO_PC and records[start + 2] != DEST_SP:
+				result.append(tuple(records[start:start + RECORD_SIZE]))
+		return result
+
+	def getPcsWithMask(self, maskId, share=None):
+		"""returns the pcs of the instructions that wrote (a given share of) a mask"""
+		return sorted({record[1] for record in self.findMask(maskId, share)})
+
+	def getLastWrite(self, destination, step):
+		"""returns the last record of a destination at or before a step (None if it was never written)"""
+		records = self.records
+		for index in range(self.getIndex(step) - 1, -1, -1):
+			start = index * RECORD_SIZE
+			if records[start + 2] == destination:
+				return tuple(records[start:start + RECORD_SIZE])
+			if records[start + 2] == DEST_RESET:
+				return None
+		return None
+
+	def getOrigin(self, destination, step):
+		""" returns the record where the value of a destination at a step was created,
+			the value is followed back through moves, loads, stores and the stack
+			(the source of each copy) to the instruction that computed it
+			or to the initial state
+		"""
+		record = self.getLastWrite(destination, step)
+		while record is not None and record[4] != NO_SOURCE:
+			source = self.getLastWrite(record[4], record[0] - 1) # value of the source before the copy
+			if source is None: # the source was never written (or the state was reset)
+				break
+			record = source
+		return record
+
+	# ---- replay ----
+
+	def getState(self, step, registerNbr=32):
+		""" returns the state after a step (0: initial state) as
+			(registers, bitStorage, memory, stack, sp, bus, flags, pc of the last instruction or None)
+		"""
+		registers = [EMPTY] * registerNbr
+		bitStorage = EMPTY
+		memory = Memory(self.memorySize)
+		stack = []
+		sp = 0
+		bus = EMPTY
+		flags = [EMPTY] * len(STATUS_FLAGS)
+		pc = None
+
+		records = self.records
+		end = self.getIndex(step)
+		# records before the last reset are not needed
+		begin = 0
+		for index in range(end - 1, -1, -1):
+			if records[index * RECORD_SIZE + 2] == DEST_RESET:
+				begin = index
+				break
+
+		states = self.states
+		for start in range(begin * RECORD_SIZE, end * RECORD_SIZE, RECORD_SIZE):
+			recordPc, destination, value = records[start + 1], records[start + 2], records[start + 3]
+			if recordPc != NO_PC:
+				pc = recordPc
+			if destination >= DEST_MEM:
+				memory.store(self.getAddress(destination - DEST_MEM), states[value])
+			elif destination >= DEST_STACK:
+				index = destination - DEST_STACK
+				if index >= len(stack):
+					stack.extend([EMPTY] * (index + 1 - len(stack)))
+				stack[index] = states[value]
+			elif destination == DEST_SP:
+				sp = value
+			elif destination == DEST_T:
+				bitStorage = states[value]
+			elif destination == DEST_BUS:
+				bus = states[value]
+			elif destination >= DEST_FLAG:
+				flags[destination - DEST_FLAG] = states[value]
+			elif destination == DEST_RESET:
+				registers = [EMPTY] * registerNbr
+				bitStorage = EMPTY
+				memory = Memory(self.memorySize)
+				stack = []
+				sp = 0
+				bus = EMPTY
+				flags = [EMPTY] * len(STATUS_FLAGS)
+			else:
+				registers[destination - DEST_REG] = states[value]
+		return (tuple(registers), bitStorage, memory, tuple(stack), sp, bus, tuple(flags), pc)
@@ -0,0 +1,231 @@
+#!python3
+
+"""
+Offline leakage scan of a recorded trace (see traceFile.py) with NumPy.
+The states of the trace are converted to arrays (mask bitset, random flag)
+and the register file is rebuilt as a matrix (one row per step that writes
+a register) so a leakage model is evaluated for all steps and all register
+pairs at once instead of instruction by instruction.
+A leakage model is a function (scan, uids a, uids b) -> boolean array,
+e.g. TraceScan.sharesMask or TraceScan.conflicts.
+"""
+
+import numpy as np
+from traceFile import *
+
+class TraceScan:
+	def __init__(self, trace, registerNbr=32):
+		self.trace = trace
+		self.registerNbr = registerNbr
+		if trace.mmap is None:
+			records = np.zeros((0, RECORD_SIZE), dtype=np.uint32)
+		else:
+			records = np.frombuffer(trace.mmap, dtype=np.uint32).reshape(-1, RECORD_SIZE)
+		self.steps = records[:, 0].astype(np.int64)
+		self.pcs = records[:, 1]
+		self.destinations = records[:, 2]
+		self.values = records[:, 3].astype(np.int64)
+		self.emptyUid = trace.states.index(EMPTY)
+
+		self.buildStateTables()
+		self.buildRegisters()
+
+	def buildStateTables(self):
+		"""arrays indexed by the uids of the trace"""
+		states = self.trace.states
+		masks = sorted({m for state in states for m in state.masks})
+		if len(masks) > 64:
+			raise(Exception(createError("The scan supports at most 64 masks ({0} in the trace)".format(len(masks)))))
+		column = {masks[i]: i for i in range(len(masks))}
+		self.maskColumns = [maskNames[m] for m in masks] # bit -> mask ID
+
+		self.maskBits = np.zeros(len(states), dtype=np.uint64) # bit i: shares of mask maskColumns[i]
+		self.random = np.zeros(len(states), dtype=bool)
+		for uid in range(len(states)):
+			state = states[uid]
+			bits = 0
+			for m in state.masks:
+				bits |= 1 << column[m]
+			self.maskBits[uid] = bits
+			if state.randoms:
+				self.random[uid] = True
+
+	def buildRegisters(self):
+		""" self.registers[row, regId]: uid of the register after the step self.registerSteps[row]
+			(a row for the initial state and for every step that writes a register)
+		"""
+		registerNbr = self.registerNbr
+		isRegister = self.destinations < registerNbr
+		isReset = self.destinations == DEST_RESET
+		indexes = np.nonzero(isRegister | isReset)[0]
+
+		# a reset writes every register (EMPTY if the register is not in the following records)
+		resets = indexes[isReset[indexes]]
+		writes = indexes[isRegister[indexes]]
+		order = np.concatenate([np.repeat(resets * (registerNbr + 1), registerNbr) + np.tile(np.arange(registerNbr), len(resets)),\
+								writes * (registerNbr + 1) + registerNbr])
+		steps = np.concatenate([np.repeat(self.steps[resets], registerNbr), self.steps[writes]])
+		regIds = np.concatenate([np.tile(np.arange(registerNbr), len(resets)), self.destinations[writes].astype(np.int64)])
+		uids = np.concatenate([np.full(len(resets) * registerNbr, self.emptyUid), self.values[writes]])
+		sort = np.argsort(order, kind="stable")
+		steps, regIds, uids = steps[sort], regIds[sort], uids[sort]
+
+		# the last write of a register in a step (the steps never decrease)
+		newStep = np.concatenate([[True], steps[1:] != steps[:-1]]) if len(steps) != 0 else np.zeros(0, dtype=bool)
+		self.registerSteps = steps[newStep]
+		if len(self.registerSteps) == 0 or self.registerSteps[0] != 0:
+			self.registerSteps = np.concatenate([[0], self.registerSteps])
+		rows = np.searchsorted(self.registerSteps, steps)
+		keys = rows * registerNbr + regIds
+		sort = np.argsort(keys, kind="stable")
+		keys = keys[sort]
+		last = sort[np.concatenate([keys[1:] != keys[:-1], [True]])] if len(keys) != 0 else sort
+
+		written = np.full((len(self.registerSteps), registerNbr), -1, dtype=np.int32)
+		written[rows[last], regIds[last]] = uids[last]
+		self.registerWritten = written >= 0 # the register is written in the step of the row
+		written[0][written[0] < 0] = self.emptyUid
+
+		# forward fill: the value of a register is the last one written
+		lastRow = np.where(self.registerWritten, np.arange(len(self.registerSteps), dtype=np.int32)[:, None], 0)
+		np.maximum.accumulate(lastRow, axis=0, out=lastRow)
+		self.registers = written[lastRow, np.arange(registerNbr)]
+
+		# pc of every step (NO_PC if unknown)
+		self.stepPcs = np.full(int(self.steps.max(initial=0)) + 1, NO_PC, dtype=np.int64)
+		fromInstruction = self.pcs != NO_PC
+		self.stepPcs[self.steps[fromInstruction]] = self.pcs[fromInstruction]
+
+	# ---- leakage models ----
+
+	def sharesMask(self, a, b):
+		"""shares of the same mask in both values (model of Device.checkNeighbours)"""
+		return (self.maskBits[a] & self.maskBits[b]) != 0
+
+	def sameRandom(self, a, b):
+		""" both values contain the same random (see ValueState.hasRandomConflict),
+			the bitsets of randoms can be large so every distinct pair of random states is tested once
+		"""
+		result = np.zeros(len(a), dtype=bool)
+		indexes = np.nonzero(self.random[a] & self.random[b])[0]
+		if len(indexes) != 0:
+			states = self.trace.states
+			keys = a[indexes].astype(np.int64) * len(states) + b[indexes]
+			pairs, inverse = np.unique(keys, return_inverse=True)
+			conflicts = np.array([states[key // len(states)].hasRandomConflict(states[key % len(states)].randoms) for key in pairs.tolist()], dtype=bool)
+			result[indexes] = conflicts[inverse]
+		return result
+
+	def conflicts(self, a, b):
+		"""vectorised ValueState.hasConflict (model of the value findings)"""
+		return self.sameRandom(a, b) | (~self.random[a] & ~self.random[b] & self.sharesMask(a, b))
+
+	# ---- scans ----
+
+	def getPairs(self, neighbours):
+		""" neighbours: {regId: [regIds]} (see Device.neighbours) or a boolean matrix
+			returns the arrays (first registers, second registers) of the neighbouring pairs
+		"""
+		if isinstance(neighbours, dict):
+			pairs = {(min(i, j), max(i, j)) for i in neighbours for j in neighbours[i] if i != j}
+		else:
+			matrix = np.asarray(neighbours, dtype=bool)
+			matrix = matrix | matrix.T
+			pairs = {(i, j) for i, j in zip(*np.nonzero(np.triu(matrix, 1)))}
+		pairs = sorted(pairs)
+		return (np.array([pair[0] for pair in pairs], dtype=np.int64), np.array([pair[1] for pair in pairs], dtype=np.int64))
+
+	def scanNeighbours(self, neighbours, model=None):
+		""" evaluates a leakage model on the pairs of neighbouring registers after every step
+			returns the list of (step, pc, regId, regId) where a pair starts to leak
+			(a pair can only start to leak in a step that writes one of its registers)
+		"""
+		if model is None:
+			model = TraceScan.sharesMask
+		first, second = self.getPairs(neighbours)
+		registers = self.registers
+
+		# pairs of each register: pairsByRegister[pairOffsets[regId]:pairOffsets[regId+1]]
+		pairRegisters = np.concatenate([first, second])
+		pairsByRegister = np.tile(np.arange(len(first)), 2)[np.argsort(pairRegisters, kind="stable")]
+		pairCounts = np.bincount(pairRegisters, minlength=self.registerNbr)
+		pairOffsets = np.concatenate([[0], np.cumsum(pairCounts)])
+
+		# (row, pair) for every write after the initial state
+		rows, regIds = np.nonzero(self.registerWritten[1:])
+		rows += 1
+		counts = pairCounts[regIds]
+		positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+		pairs = pairsByRegister[np.repeat(pairOffsets[regIds], counts) + positions]
+		rows = np.repeat(rows, counts)
+
+		leaks = model(self, registers[rows, first[pairs]], registers[rows, second[pairs]])
+		leaked = model(self, registers[rows - 1, first[pairs]], registers[rows - 1, second[pairs]])
+		# both registers of a pair can be written in the same step
+		keys = np.unique(rows[leaks & ~leaked] * len(first) + pairs[leaks & ~leaked])
+		rows, pairs = keys // len(first), keys % len(first)
+
+		# pairs that leak in the initial state
+		initial = np.nonzero(model(self, registers[0, first], registers[0, second]))[0]
+		rows, pairs = np.concatenate([np.zeros(len(initial), dtype=rows.dtype), rows]), np.concatenate([initial, pairs])
+
+		steps = self.registerSteps[rows]
+		return [(int(step), int(self.stepPcs[step]), int(first[pair]), int(second[pair])) for step, pair in zip(steps, pairs)]
+
+	def scanTransitions(self, model=None):
+		""" evaluates a leakage model on every write (registers, memory, stack, bit storage and bus)
+			with the previous value of the same destination
+			returns the list of (step, pc, destination, previous uid, new uid) of the leaking writes
+		"""
+		if model is None:
+			model = TraceScan.conflicts
+		destinations = self.destinations
+		epochs = np.cumsum(destinations == DEST_RESET) # a reset replaces all the values
+		isFlag = (destinations >= DEST_FLAG) & (destinations < DEST_FLAG + len(STATUS_FLAGS)) # flags are not checked for transitions
+		valid = np.nonzero((destinations != DEST_RESET) & (destinations != DEST_SP) & ~isFlag)[0]
+
+		# previous value of the same destination in the same epoch (EMPTY if there is none)
+		order = valid[np.lexsort((valid, epochs[valid], destinations[valid]))]
+		previous = np.full(len(order), self.emptyUid, dtype=np.int64)
+		sameGroup = (destinations[order[1:]] == destinations[order[:-1]]) & (epochs[order[1:]] == epochs[order[:-1]])
+		previous[1:][sameGroup] = self.values[order[:-1]][sameGroup]
+
+		fromInstruction = self.pcs[order] != NO_PC
+		order, previous = order[fromInstruction], previous[fromInstruction]
+		leaks = model(self, previous, self.values[order])
+		order, previous = order[leaks], previous[leaks]
+		sort = np.argsort(order)
+		return [(int(self.steps[i]), int(self.pcs[i]), int(destinations[i]), int(old), int(self.values[i]))\
+				for i, old in zip(order[sort], previous[sort])]
+
+if __name__ == "__main__":
+	import os, tempfile
+	from device import Device
+	from collections import namedtuple
+
+	Instruction = namedtuple('avr_8_ins', 'name op1 op2 line')
+	program = [
+				Instruction("lds", 1, 0xA000, "lds r1, 0xA000"),\
+				Instruction("lds", 2, 0xA001, "lds r2, 0xA001"),\
+				Instruction("lds", 4, 0xA001, "lds r4, 0xA001"),\
+				Instruction("mov", 3, 1, "mov r3, r1"),\
+				Instruction("ldi", 2, 0, "ldi r2, 0"),\
+				Instruction("lds", 3, 0xA001, "lds r3, 0xA001")]
+
+	device = Device()
+	device.loadProgram(program, ([], [(0xA000, "a", 0), (0xA001, "a", 1)]))
+	filename = os.path.join(tempfile.mkdtemp(), "scan.trace")
+	device.startTrace(filename)
+	device.runProgram()
+	device.stopTrace()
+
+	trace = Trace(filename)
+	scan = TraceScan(trace)
+	print("Neighbours (ATmega163):", scan.scanNeighbours(device.neighbours))
+	otherNeighbours = np.eye(32, k=1, dtype=bool) # every register is next to the following one
+	print("Neighbours (R[i], R[i+1]):", scan.scanNeighbours(otherNeighbours))
+	for step, pc, destination, old, new in scan.scanTransitions():
+		print("Transition at line {0}: {1} {2} -> {3}".format(pc, locationToStr(trace.getLocation(destination)), trace.states[old], trace.states[new]))
+	print("Online findings:", len(device.findings.getKind(FINDING_VALUE)), "value,", len(device.findings.getKind(FINDING_NEIGHBOUR)), "neighbour")
+	del scan # the arrays of the scan use the memory-mapped file
+	trace.close()
@@ -7,159 +7,391 @@ __author__ = "Nikita Veshchikov"
 This module represents an abstract value TrackedValue that is used by the simulator.
 The value could be a constant, a random value or a set of combined mask shares.
 A combinaiton of masks could also be combined with a random value.
+
+Mask IDs are interned to small integers and the shares of a mask are stored
+as an integer bitset (bit i is set if share i is present).
+Random values are interned the same way (one identity per random address or label),
+a value holds the bitset of its randoms, XORing the same random twice cancels it
+(xoredWith), any other combination keeps it (combinedWith).
 """
 
-import copy
 from maskWarnings import *
 
 # mask-tuple (ID, SHARE)
 ID = 0
 SHARE = 1
 
-class TrackedValue:
-	def __init__(self):
-		self.masks = {} # structure: {maskId0: set(share0, share1,..), maskId1: set(share0, share1, ..)}
-		self.random = False
-		self.randomVal = None
-		self.const = False
-		self.constVal = None
+# interned mask IDs
+maskIndex = {} # maskId -> index
+maskNames = [] # index -> maskId
+
+def internMask(maskId):
+	"""returns the small integer that represents a mask ID"""
+	index = maskIndex.get(maskId)
+	if index is None:
+		index = len(maskNames)
+		maskIndex[maskId] = index
+		maskNames.append(maskId)
+	return index
+
+# order-aware mode: number of shares of a mask that have to be combined to leak
+# (e.g. d+1 for a d-th order masking), a mask without threshold leaks as soon as
+# two of its shares meet, the thresholds belong to a simulation (see Device.maskThresholds)
+NO_THRESHOLDS = {} # maskIndex -> number of shares (never modified)
+
+def makeThresholds(thresholds):
+	"""thresholds: {maskId: number of shares}, returns {maskIndex: number of shares}"""
+	return {internMask(maskId): threshold for maskId, threshold in thresholds.items()}
+
+if hasattr(int, "bit_count"): # python 3.10
+	countShares = int.bit_count
+else:
+	def countShares(shares):
+		"""number of shares in a bitset"""
+		return bin(shares).count("1")
+
+# interned random identities
+randomIndex = {} # randomId -> index
+randomNames = [] # index -> randomId
+
+def internRandom(randomId):
+	"""returns the index of the bit that represents a random value (None: a random of unknown identity)"""
+	index = randomIndex.get(randomId)
+	if index is None:
+		index = len(randomNames)
+		randomIndex[randomId] = index
+		randomNames.append(randomId)
+	return index
+
+# a random of unknown identity could be any random, it never cancels
+UNKNOWN_RANDOM = 1 << internRandom(None)
+
+def randomsToList(randoms):
+	"""converts a bitset of randoms to the list of random IDs"""
+	result = []
+	index = 0
+	while randoms:
+		if randoms & 1:
+			result.append(randomNames[index])
+		randoms >>= 1
+		index += 1
+	return result
+
+def randomToStr(randomId):
+	"""random addresses are printed like memory addresses"""
+	if isinstance(randomId, int):
+		return "{0:#04X}".format(randomId)
+	return str(randomId)
+
+def sharesToSet(shares):
+	"""converts a bitset of shares to a set of share numbers"""
+	result = set()
+	share = 0
+	while shares:
+		if shares & 1:
+			result.add(share)
+		shares >>= 1
+		share += 1
+	return result
+
+def makeMasks(masks):
+	"""returns the canonical form of a {maskIndex: shareBits} dict (sorted by mask index)"""
+	return {m: masks[m] for m in sorted(masks)}
+
+def makeState(masks=None, randoms=0, const=False, constVal=None):
+	"""
+	returns the ValueState with the given content, 
+	equal states are always represented by the same object
+	masks: canonical {maskIndex: shareBits} dict (see makeMasks)
+	randoms: bitset of interned randoms (see internRandom)
+	"""
+	if masks is None:
+		masks = {}
+	key = (tuple(masks.items()), randoms, const, constVal)
+	state = stateTable.get(key)
+	if state is None:
+		state = ValueState(masks, randoms, const, constVal, len(stateList))
+		stateTable[key] = state
+		stateList.append(state)
+	return state
+
+def makeRandom(randomId=None):
+	"""returns the state of a random value"""
+	return makeState(None, 1 << internRandom(randomId))
+
+def stateFromNames(masks, randoms, const, constVal):
+	""" makeState with ((maskId, shareBits),..) and (randomId,..) instead of
+		interned indexes (used by pickle)
+	"""
+	randomBits = 0
+	for randomId in randoms:
+		randomBits |= 1 << internRandom(randomId)
+	return makeState(makeMasks({internMask(m): shares for m, shares in masks}), randomBits, const, constVal)
+
+class ValueState:
+	"""
+	Immutable content of a TrackedValue.
+	States are interned by makeState() so they are compared and hashed by identity,
+	never create them directly.
+	"""
+	__slots__ = ("masks", "randoms", "const", "constVal", "uid")
 	
-	def setToRandom(self, val=None):
-		msg = self.checkRandCombinaiton(True, val)
-		
-		self.random = True
-		self.randomVal = val
-		self.const = False
-		self.constVal = None
-		self.masks = {}
-		
-		if msg!= "":
-			raise(Exception(msg))
-		
-	def setToConst(self, val=None):
-		self.random = False
-		self.randomVal = None
-		self.const = True
-		self.constVal = val
-		self.masks = {}
+	def __init__(self, masks, randoms, const, constVal, uid):
+		# structure: {maskIndex0: shareBits0, maskIndex1: shareBits1}
+		self.masks = masks
+		self.randoms = randoms # bitset of interned randoms
+		self.const = const
+		self.constVal = constVal
+		self.uid = uid # small integer that identifies the state
 	
-	def addRandom(self, val = None):
-		
-		msg = self.checkRandCombinaiton(True, val)
-		self.random = True
-		self.randomVal = val
-		self.const = False
-		
-		if msg!= "":
-			raise(Exception(msg))
+	def __reduce__(self):
+		masks = tuple((maskNames[m], shares) for m, shares in self.masks.items())
+		return (stateFromNames, (masks, tuple(randomsToList(self.randoms)), self.const, self.constVal))
 	
-	def checkValueCombination(self, otherValue):
+	@property
+	def random(self):
+		return self.randoms != 0
+	
+	def hasConflict(self, otherValue, thresholds=NO_THRESHOLDS):
+		"""fast test, True if checkValueCombination(otherValue, thresholds) returns a message"""
+		if self.randoms and otherValue.randoms:
+			return self.hasRandomConflict(otherValue.randoms)
+		if self.randoms or otherValue.randoms or not self.masks:
+			return False
+		return self.hasMaskConflict(otherValue.masks, thresholds)
+	
+	def hasMaskConflict(self, masks, thresholds=NO_THRESHOLDS):
+		"""True if the shares of a mask in both values reach the threshold of the mask (see makeThresholds)"""
+		for m in masks:
+			if m in self.masks:
+				threshold = thresholds.get(m)
+				if threshold is None or countShares(self.masks[m] | masks[m]) >= threshold:
+					return True
+		return False
+	
+	def hasRandomConflict(self, randoms):
+		"""True if both values (could) contain the same random"""
+		return (self.randoms & randoms) != 0 or ((self.randoms | randoms) & UNKNOWN_RANDOM) != 0
+	
+	def checkValueCombination(self, otherValue, thresholds=NO_THRESHOLDS):
 		
 		msg=[]
-		tmp = self.checkRandCombinaiton(otherValue.random, otherValue.randomVal)
+		tmp = self.checkRandCombinaiton(otherValue.randoms)
 		if len(tmp) != 0:
 			msg.append(tmp)
 		
 		
-		if len(msg) != 0 or (not self.random and not otherValue.random): # rand problems
-			tmp = self.checkMaskCombination(otherValue.masks)
+		if len(msg) != 0 or (not self.randoms and not otherValue.randoms): # rand problems
+			tmp = self.checkMaskCombination(otherValue.masks, thresholds)
 			if len(tmp) != 0:
 				msg.append(tmp)
 		
 		return "\n".join(msg)
 	
-	def checkRandCombinaiton(self, otherRand, otherRandVal):
+	def checkRandCombinaiton(self, otherRandoms):
 		msg = ""
-		if (self.random and otherRand) and (self.randomVal == otherRandVal):
-			if (self.randomVal is None or otherRandVal is None):
+		if self.randoms and otherRandoms and self.hasRandomConflict(otherRandoms):
+			common = self.randoms & otherRandoms & ~UNKNOWN_RANDOM
+			if common:
+				msg = createWarning("Combining identical random values! ({0})".format(", ".join(map(randomToStr, randomsToList(common)))))
+			else:
 				msg = createWarning("Potential combination of identical random values!") 
-			elif (self.randomVal is not None) and (otherRandVal is not None):
-				msg = createWarning("Combining identical random values!")	
 		
 		return msg
 	
-	def checkMaskCombination(self, masks):
+	def checkMaskCombination(self, masks, thresholds=NO_THRESHOLDS):
 		"""Check potential problems while combining two values"""
-		messages = []
+		if not self.masks:
+			return ""
 		
+		messages = []
 		for m in masks:
-			if m in self.masks:
+			if m in self.masks: # shares of the same mask (bitsets are never empty)
+				threshold = thresholds.get(m)
+				if threshold is not None:
+					shares = self.masks[m] | masks[m]
+					if countShares(shares) >= threshold:
+						messages.append( createWarning("Mask shares {0} of '{1}' are combined in {2} (threshold: {3} shares)".format(sharesToSet(shares), maskNames[m], self, threshold)) )
+					continue
 				intersection = self.masks[m] & masks[m]
-				union = self.masks[m] | masks[m]
-				if len(union)!=0:
-					if len(intersection)!=0:
-						messages.append( createWarning("Mask share {0} of '{1}' is already in {2}".format(intersection, m, self)) )
-					else:
-						messages.append( createWarning("Mask share {0} of '{1}' is already in {2}".format(self.masks[m], m, self)) )
+				if intersection:
+					shares = intersection
+				else:
+					shares = self.masks[m]
+				messages.append( createWarning("Mask share {0} of '{1}' is already in {2}".format(sharesToSet(shares), maskNames[m], self)) )
 		
 		return "\n".join(messages)
 	
-	def combineWith(self, trackedVal):
+	def combinedWith(self, other):
+		"""returns the state obtained by combining the two states (and, or, add, ...), the randoms of both stay"""
+		return makeState(self.getCombinedMasks(other), self.randoms | other.randoms)
+	
+	def xoredWith(self, other):
+		"""returns the state of the XOR of the two states, a random that is in both cancels"""
+		# x ^ r ^ r = x, a random of unknown identity stays
+		randoms = (self.randoms ^ other.randoms) | ((self.randoms | other.randoms) & UNKNOWN_RANDOM)
+		return makeState(self.getCombinedMasks(other), randoms)
+	
+	def getCombinedMasks(self, other):
+		if not other.masks:
+			return self.masks
+		masks = dict(self.masks)
+		for m, shares in other.masks.items():
+			masks[m] = masks.get(m, 0) | shares
+		return makeMasks(masks)
+	
+	def joinedWith(self, other):
+		""" returns a state that over-approximates both states (used where control flow merges):
+			shares of both values, random or const only if both are
+		"""
+		if self is other:
+			return self
 		
-		msg = self.checkValueCombination(trackedVal)
-		self.const = False
-		self.constVal = None
+		masks = dict(self.masks)
+		for m, shares in other.masks.items():
+			masks[m] = masks.get(m, 0) | shares
 		
-		if self.randomVal is None:
-			self.randomVal = trackedVal.randomVal	
+		randoms = self.randoms & other.randoms
+		if not randoms and self.randoms and other.randoms:
+			randoms = UNKNOWN_RANDOM # random on both sides
+		const = self.const and other.const
+		constVal = self.constVal if self.constVal == other.constVal else None
+		return makeState(makeMasks(masks), randoms, const, constVal if const else None)
+	
+	def getMasksDict(self):
+		"""returns the masks as {maskId: set(share0, share1,..)}"""
+		return {maskNames[m]: sharesToSet(shares) for m, shares in self.masks.items()}
+	
+	def __str__(self):
+		result = ""
+		if self.const:
+			if self.constVal is None:
+				result+= "[const]"
+			else:
+				result+= "[const:%s]" % ( str(self.constVal) )
+		if self.randoms:
+			names = randomsToList(self.randoms)
+			if None in names:
+				result+= "[rand]"
+				names.remove(None)
+			if names:
+				result+= "[rand:%s]" % ( ",".join(map(randomToStr, names)) )
+		if len(self.masks) != 0:
+			result+= "({0})".format(self.getMasksDict())
+		if len(result) == 0:
+			result = "[Not initialized]"
 		
-		self.random |= trackedVal.random
+		return result
+
+# interned states
+stateTable = {} # content -> ValueState
+stateList = [] # uid -> ValueState
+EMPTY = makeState()
+
+class TrackedValue:
+	"""
+	Mutable cell (register, memory cell,..) that holds a reference to an interned ValueState,
+	copying a value only copies the reference.
+	"""
+	__slots__ = ("state",)
+	
+	def __init__(self, state=EMPTY):
+		self.state = state
+	
+	# read-only view of the state
+	@property
+	def masks(self):
+		return self.state.masks
+	@property
+	def random(self):
+		return self.state.randoms != 0
+	@property
+	def randoms(self):
+		return self.state.randoms
+	@property
+	def const(self):
+		return self.state.const
+	@property
+	def constVal(self):
+		return self.state.constVal
+	
+	def setToRandom(self, val=None):
+		state = makeRandom(val)
+		msg = self.state.checkRandCombinaiton(state.randoms)
 		
-		for m in trackedVal.masks:
-			if m in self.masks:
-				self.masks[m] |= trackedVal.masks[m]
-			else:
-				self.masks[m] = trackedVal.masks[m]
+		self.state = state
+		
+		if msg!= "":
+			raise(Exception(msg))
+		
+	def setToConst(self, val=None):
+		self.state = makeState(None, 0, True, val)
+	
+	def addRandom(self, val = None):
+		
+		randoms = makeRandom(val).randoms
+		msg = self.state.checkRandCombinaiton(randoms)
+		self.state = self.state.xoredWith(makeState(None, randoms))
+		
+		if msg!= "":
+			raise(Exception(msg))
+	
+	def checkValueCombination(self, otherValue):
+		return self.state.checkValueCombination(otherValue)
+	
+	def checkRandCombinaiton(self, otherRandoms):
+		return self.state.checkRandCombinaiton(otherRandoms)
+	
+	def checkMaskCombination(self, masks):
+		"""Check potential problems while combining two values"""
+		return self.state.checkMaskCombination(masks)
+	
+	def combineWith(self, trackedVal, thresholds=NO_THRESHOLDS):
+		
+		msg = self.state.checkValueCombination(trackedVal.state, thresholds)
+		self.state = self.state.combinedWith(trackedVal.state)
+		
+		if msg!="":
+			raise MaskingComplaint(msg)
+	
+	def xorWith(self, trackedVal, thresholds=NO_THRESHOLDS):
+		
+		msg = self.state.checkValueCombination(trackedVal.state, thresholds)
+		self.state = self.state.xoredWith(trackedVal.state)
 		
 		if msg!="":
 			raise MaskingComplaint(msg)
 	
 	def loadMask(self, mask):
 		"""loads a mask (ID, SHARE) in a memory cell"""
-		msg = self.checkMaskCombination({mask[ID]:set({mask[SHARE]})})
-		self.const = False
-		self.constVal = None
-		self.random = False
-		self.randomVal = None
-		self.masks = {mask[ID]:set({mask[SHARE]})}
+		masks = {internMask(mask[ID]): 1 << mask[SHARE]}
+		msg = self.state.checkMaskCombination(masks)
+		self.state = makeState(masks)
 		
 		if msg!="":	
 			raise MaskingComplaint(msg)
 	
 	def replaceBy(self, trackedVal):
-		msg = self.checkValueCombination(trackedVal)
-		self.const = trackedVal.const
-		self.constVal = trackedVal.constVal
-		self.random = trackedVal.random
-		self.randomVal = trackedVal.randomVal
-		self.masks = copy.deepcopy(trackedVal.masks)
+		msg = self.state.checkValueCombination(trackedVal.state)
+		self.state = trackedVal.state
 		
 		if msg!="":
 			raise MaskingComplaint(msg)
 	
 	def isRandom(self):
-		return self.random
+		return self.state.randoms != 0
 	def isConst(self):
-		return self.const
+		return self.state.const
+	
+	def getMasksDict(self):
+		"""returns the masks as {maskId: set(share0, share1,..)}"""
+		return self.state.getMasksDict()
+	
+	def __eq__(self, other):
+		return isinstance(other, TrackedValue) and self.state is other.state
 	
 	def __str__(self):
-		result = ""
-		if self.const:
-			if self.constVal is None:
-				result+= "[const]"
-			else:
-				result+= "[const:%s]" % ( str(self.constVal) )
-		if self.random:
-			if self.randomVal is None:
-				result+= "[rand]"
-			else:
-				result+= "[rand:%s]" % ( str(self.randomVal) )
-		if len(self.masks) != 0:
-			result+= "({0})".format(self.masks)
-		if len(result) == 0:
-			result = "[Not initialized]"
-		
-		return result
+		return str(self.state)
 
 
 
@@ -174,10 +406,13 @@ def test_LoadMask(mask, val):
 	print("Value :\t", val)
 	return val
 
-def test_Combine(val1, val2):
-	print("Combine :\t", val1, "\t", val2)
+def test_Combine(val1, val2, thresholds=NO_THRESHOLDS, xor=False):
+	print("Xor :\t" if xor else "Combine :\t", val1, "\t", val2)
 	try:
-		val1.combineWith(val2)
+		if xor:
+			val1.xorWith(val2, thresholds)
+		else:
+			val1.combineWith(val2, thresholds)
 	except Exception as e:
 		print(e)
 	print("Result :\t", val1)
@@ -308,5 +543,41 @@ if __name__ == "__main__" :
 	val3.loadMask(mask4)
 	val1 = test_Combine(val1, val3)
 	
+	print("---- Random cancellation ----")
+	val1 = TrackedValue()
+	val2 = TrackedValue()
+	val1.loadMask(mask1)
+	val1 = test_addRandom(val1, "r1")
+	val1 = test_addRandom(val1, "r2")
+	val2.setToRandom("r1")
+	test_Combine(TrackedValue(val1.state), val2) # and, add, ...: r1 stays
+	val1 = test_Combine(val1, val2, xor=True) # r1 cancels, still masked by r2
+	val2.setToRandom("r2")
+	val1 = test_Combine(val1, val2, xor=True) # only the mask share is left
+	
+	print("---- Interned states ----")
+	val1 = TrackedValue()
+	val2 = TrackedValue()
+	val1.loadMask(mask1)
+	val2.loadMask(mask2)
+	val2.combineWith(val1)
+	val1.combineWith(test_LoadMask(mask2, TrackedValue()))
+	print("Same content:\t", val1, val2, val1 == val2, val1.state is val2.state)
+	val1.setToConst(1)
+	print("Copy on write:\t", val1, val2, val1 == val2)
+	
+	print("---- Order-aware masking ----")
+	thresholds = makeThresholds({"e": 3}) # 2nd order masking: 3 shares
+	val1 = TrackedValue()
+	val2 = TrackedValue()
+	val1.loadMask(("e", 0))
+	val2.loadMask(("e", 1))
+	val1 = test_Combine(val1, val2, thresholds) # 2 shares: safe
+	val2 = TrackedValue()
+	val2.loadMask(("e", 2))
+	val1 = test_Combine(val1, val2, thresholds) # 3 shares
+	val2 = TrackedValue()
+	val2.loadMask(("e", 31))
+	print("Share 31:", val2, "conflict with", val1, val2.state.hasConflict(val1.state, thresholds))
 	
 	print ("---------------- End ----------------")
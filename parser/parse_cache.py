@@ -0,0 +1,124 @@
+#!python3
+# on-disk cache of parsed files
+
+import os
+import hashlib
+import marshal
+from parser_avr_8 import avr_8_ins, avr_8_parser, PARSER_VERSION
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ascold")
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024 # bytes
+CACHE_SUFFIX = ".parsed"
+
+class parse_cache:
+	"""
+	parse_cache stores the instructions of parsed files in a directory.
+	An entry is named after the hash of the content of the file, of
+	PARSER_VERSION, of the parser class and of its include directories,
+	so a modified file (or parser) never hits an old entry.
+	The instructions are stored as plain tuples with marshal, with the
+	mtimes of the included files (an entry is not used if one has changed).
+	When the directory is bigger than max_size the least recently
+	used entries are removed.
+	"""
+
+	def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+		self.directory = directory
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+
+	def get_key(self, parser, content):
+		"""get_key returns the name of the entry of a file content (bytes) parsed by a parser"""
+		context = (PARSER_VERSION, type(parser).__name__, tuple(parser.preprocessor.include_dirs))
+		digest = hashlib.sha256(repr(context).encode() + b"\0" + content)
+		return digest.hexdigest() + CACHE_SUFFIX
+
+	def load(self, key):
+		"""load returns the list of instructions of an entry or None"""
+		path = os.path.join(self.directory, key)
+		try:
+			with open(path, "rb") as entry:
+				dependencies, instructions = marshal.load(entry)
+			for dependency, mtime in dependencies: # included files
+				if os.path.getmtime(dependency) != mtime:
+					return None
+			os.utime(path) # most recently used
+		except (OSError, EOFError, ValueError, TypeError):
+			return None
+		return list(map(avr_8_ins._make, instructions))
+
+	def store(self, key, instructions, dependencies=()):
+		"""store writes an entry, the cache is only an optimisation so failures are ignored"""
+		path = os.path.join(self.directory, key)
+		tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			with open(tmp_path, "wb") as entry:
+				marshal.dump((tuple(dependencies), tuple(tuple(ins) for ins in instructions)), entry)
+			os.replace(tmp_path, path) # another process never reads a partial entry
+		except (OSError, ValueError):
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+			return
+		self.evict()
+
+	def evict(self):
+		"""evict removes the least recently used entries until the cache fits in max_size"""
+		entries = []
+		total_size = 0
+		try:
+			with os.scandir(self.directory) as it:
+				for dir_entry in it:
+					if dir_entry.name.endswith(CACHE_SUFFIX):
+						stat = dir_entry.stat()
+						entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+						total_size += stat.st_size
+		except OSError:
+			return
+
+		entries.sort()
+		for mtime, size, path in entries:
+			if total_size <= self.max_size:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total_size -= size
+
+	def parse_file(self, parser, input_file):
+		"""
+		parse_file returns the instructions of a file like
+		parser.parse_file, the file is parsed only on a miss.
+		"""
+		with open(input_file, "rb") as myfile:
+			key = self.get_key(parser, myfile.read())
+
+		instructions = self.load(key)
+		if instructions is not None:
+			self.hits += 1
+			return instructions
+
+		self.misses += 1
+		instructions = parser.parse_file(input_file)
+		self.store(key, instructions, tuple(parser.preprocessor.dependencies.items()))
+		return instructions
+
+if __name__ == "__main__":
+	import tempfile
+
+	with tempfile.TemporaryDirectory() as directory:
+		cache = parse_cache(directory)
+		eg_parser = avr_8_parser("parser_test.s", cache)
+		first = eg_parser.parse()
+		second = eg_parser.parse()
+		print("Same instructions:", first == second)
+		print("Hits: {0}, misses: {1}".format(cache.hits, cache.misses))
+		other_parser = avr_8_parser("parser_test.s", cache, include_dirs=[directory])
+		other_parser.parse()
+		print("Other include directories, hits: {0}, misses: {1}".format(cache.hits, cache.misses))
+
+		cache.max_size = 0
+		cache.evict()
+		print("Entries after eviction:", len(os.listdir(directory)))
@@ -1,8 +1,10 @@
 #!python3
 # avr 8 parser
 
-from pyparsing import Word, Optional, OneOrMore, Group, ParseException, ZeroOrMore, delimitedList, Suppress, Or
+import re
+from pyparsing import Word, Optional, OneOrMore, Group, ParseException, ZeroOrMore, delimitedList, Suppress, Or, ParserElement
 from collections import namedtuple, defaultdict
+from preprocessor_avr_8 import avr_8_preprocessor
 
 # constants
 
@@ -10,49 +12,119 @@ digits = "0123456789"
 caps = "ABCDEFGHIJKLMNOPQRSTUVWXYZ" 
 
 ins_avr = Word(caps.lower())
-param = Word(caps + caps.lower() + digits + "+")
+param = Word(caps + caps.lower() + digits + "+_-", caps + caps.lower() + digits + "+_")
 
 nameIns = ins_avr.setResultsName("name_ins")
 paramIns = param.setResultsName("param_ins")
 
 avr_8_ins = namedtuple('avr_8_ins', 'name op1 op2 line')
 
+# version of the parsed form, it must be increased every time the parser
+# produces different instructions for the same input (see parse_cache.py)
+PARSER_VERSION = 3
+
+# pointers with a pre-decrement, e.g. 'ld r1, -X' -> name 'ld-', op2 'X'
+PRE_DECREMENT_POINTERS = ("-X", "-Y", "-Z")
+
+# name of the pseudo-instruction that marks a label, op1 is the name of the label
+LABEL = "label"
+
+# grammar
+
+def build_grammar():
+	"""
+	build_grammar returns the pyparsing grammar of a line
+	of AVR-8 assembly code (one or several instructions).
+	"""
+	COMMA = Suppress(",")
+
+	avr_elem_simp = (ins_avr + param).setResultsName("ins_group_simp")
+	avr_elem = (ins_avr + param + COMMA + param).setResultsName("ins_group")
+	return Or(avr_elem | avr_elem_simp) + ZeroOrMore(Or(avr_elem | avr_elem_simp))
+
+# The grammar is built only once, Or() tries both alternatives
+# at the same position so packrat caching avoids parsing twice.
+ParserElement.enablePackrat()
+avr_grammar = build_grammar()
+
+# Fast path for the common 'mnemonic op1' and 'mnemonic op1, op2' lines,
+# it accepts exactly the same tokens as the grammar above. Any other
+# line goes through pyparsing.
+fast_line = re.compile(r"[ \t]*([a-z]+)[ \t]+(-?[A-Za-z0-9+_]+)(?:[ \t]*,[ \t]*(-?[A-Za-z0-9+_]+))?[ \t]*$")
+
+# 'label:' (optionally followed by an instruction) and instructions without operands (e.g. 'ret')
+label_line = re.compile(r"[ \t]*([A-Za-z_.][A-Za-z0-9_.]*):[ \t]*(.*)$")
+no_operand_line = re.compile(r"[ \t]*([a-z]+)[ \t]*$")
+
+# files that are decoded by avr_8_binary_parser (parser_avr_8_binary.py)
+BINARY_EXTENSIONS = (".hex", ".ihex", ".ihx", ".bin", ".img")
+
+def get_parser(input_file, cache=None):
+	"""
+	get_parser returns the parser of a file: avr_8_binary_parser
+	for firmware images, avr_8_objdump_parser for avr-objdump
+	listings and avr_8_parser for assembly code.
+	Only assembly code is cached (cache: optional parse_cache),
+	listings and images are always parsed.
+	"""
+	if input_file is None:
+		return avr_8_parser(input_file, cache)
+	if input_file.lower().endswith(BINARY_EXTENSIONS):
+		from parser_avr_8_binary import avr_8_binary_parser # needs numpy
+		return avr_8_binary_parser(input_file)
+	from parser_avr_8_objdump import avr_8_objdump_parser, is_objdump_listing
+	if is_objdump_listing(input_file):
+		return avr_8_objdump_parser(input_file)
+	return avr_8_parser(input_file, cache)
+
 # classes
 
 class avr_8_parser:
 
-	def __init__(self, input_file):
+	def __init__(self, input_file, cache=None, include_dirs=()):
 		self.input_file = input_file
+		self.cache = cache # optional parse_cache
+		self.preprocessor = avr_8_preprocessor(include_dirs) # directives, macros and includes
 		
+	def iter_asm_lines(self, file_in):
+		"""
+		iter_asm_lines yields the stripped non-empty lines
+		of an input file, the file is read through a buffer
+		and is never loaded at once.
+		"""
+		with open (file_in, "r") as myfile:
+			for line in myfile:
+				line = line.strip()
+				if line:
+					yield line
+
 	def sanitize_asm_file(self, file_in):
 		""" 
 		This method prepares an input file 
 		before parsing by replacing unconfortable 
 		characters not related to our grammar.
 		"""
-		default_sep = "\n"
-
-		with open (self.input_file, "r") as myfile:
-			string_in = myfile.read()
-
-		ins_list = list(filter(None, [i.strip() for i in string_in.split(default_sep)]))
-
-		return ins_list
-
-	
+		return list(self.iter_asm_lines(file_in))
 
 	def parse_line(self, string_in):
 		"""
 		parse_line returns a tuple of name, op1, op2 based on an line
 		of AVR-8 assembly code.
 		"""
-		COMMA = Suppress(",")
-	
-		avr_elem_simp = (ins_avr + param).setResultsName("ins_group_simp")
-		avr_elem = (ins_avr + param + COMMA + param).setResultsName("ins_group")
-		list_of_avr_elem = Or(avr_elem | avr_elem_simp) + ZeroOrMore(Or(avr_elem | avr_elem_simp))
+		match = fast_line.match(string_in)
+		if match is not None:
+			if match.group(3) is None:
+				return [match.group(1), match.group(2)]
+			return [match.group(1), match.group(2), match.group(3)]
+
+		match = label_line.match(string_in)
+		if match is not None:
+			return [LABEL, match.group(1)]
+		match = no_operand_line.match(string_in)
+		if match is not None:
+			return [match.group(1)]
 
-		return list_of_avr_elem.parseString(string_in)
+		return avr_grammar.parseString(string_in)
 
 
 	def parsed_line_to_obj(self, parsed_line, line):	
@@ -62,9 +134,15 @@ class avr_8_parser:
 		'name op1 op2'.
 		"""
 		ins_t = parsed_line[0]
-		operand_1 = parsed_line[1]
+		if len(parsed_line) == 1:
+			operand_1 = "EMPTY"
+		else:
+			operand_1 = parsed_line[1]
+		
+		if ins_t == LABEL:
+			return (avr_8_ins(name=ins_t, op1=operand_1, op2="EMPTY", line=line))
 		
-		if len(parsed_line) == 2:
+		if len(parsed_line) <= 2:
 		 operand_2 = "EMPTY" 
 		else:
 			operand_2 = parsed_line[2]
@@ -81,12 +159,23 @@ class avr_8_parser:
 			operand_2 = operand_2[:-1]
 			ins_t = ins_t + "+"
 
+		# Same for the pre-decrement of
+		# a pointer, e.g. '-X'.
+
+		if operand_1 in PRE_DECREMENT_POINTERS:
+			operand_1 = operand_1[1:]
+			ins_t = ins_t + "-"
+
+		if operand_2 in PRE_DECREMENT_POINTERS:
+			operand_2 = operand_2[1:]
+			ins_t = ins_t + "-"
+
 		# Remove r from registers name.
 
-		if operand_1.startswith('r'):
+		if operand_1.startswith('r') and operand_1[1:].isdigit():
 			operand_1 = int(operand_1[1:])
 		
-		if operand_2.startswith('r'):
+		if operand_2.startswith('r') and operand_2[1:].isdigit():
 			operand_2 = int(operand_2[1:])
 
 		#If the operands are an hex value,
@@ -105,36 +194,39 @@ class avr_8_parser:
 	def parse(self):
 		if self.input_file is None:
 			return None
+		elif self.cache is not None:
+			return self.cache.parse_file(self, self.input_file)
 		else:
 			return self.parse_file(self.input_file)
 
+	def parse_iter(self, input_file=None):
+		"""
+		parse_iter lazily yields the instructions of a file
+		containing AVR-8 instructions, one avr_8_ins at a time.
+		Memory usage does not depend on the size of the file.
+		"""
+		if input_file is None:
+			input_file = self.input_file
+
+		for line in self.preprocessor.iter_lines(input_file):
+			match = label_line.match(line)
+			if match is not None and match.group(2): # 'label: instruction'
+				yield avr_8_ins(name=LABEL, op1=match.group(1), op2="EMPTY", line=match.group(1)+":")
+				line = match.group(2)
+			parsed_line = self.parse_line(line)
+			yield self.parsed_line_to_obj(parsed_line, line)
+
 	def parse_file(self, input_file):
 		"""
 		parse_file processes a file containing AVR-8 instructions and
 		transform them into a list of maps according to the "name, 
 		op1, op2" format.
 		"""
-		# Sanitize input file
-
-		ins_list = self.sanitize_asm_file(input_file)
-		
-		if ins_list[-1] == "": # lst[-1] : gives last elem
-			ins_list.pop()
-
-		# Parse instructions line per line
-
-		obj_list = []
-
-		for line in ins_list:
-			parsed_line = self.parse_line(line)
-			obj = self.parsed_line_to_obj(parsed_line, line)
-			obj_list.append(obj)
-
-		return obj_list
+		return list(self.parse_iter(input_file))
 	
 if __name__ == "__main__":
 
-	eg_parser = avr_8_parser("asm_expls/parser_test.s")
+	eg_parser = avr_8_parser("parser_test.s")
 	obj_list = eg_parser.parse()
 
 	for i in obj_list:
@@ -0,0 +1,439 @@
+#!python3
+# avr 8 binary loader (Intel HEX and raw flash images)
+
+import numpy as np
+from parser_avr_8 import avr_8_ins, LABEL
+
+# pre-decrement pointer instructions, e.g. 'ld r0, -X' is ('ld-', 0, 'X', ..)
+# like 'ld r0, X+' is ('ld+', 0, 'X', ..) for the text parser
+PRE_DECREMENT = "-"
+
+# name of the pseudo-instruction of a word that is not an instruction (e.g. data in flash),
+# the Device only reports it when it is reached
+DATA_WORD = ".dw"
+
+# Instruction set: (pattern, name, operands)
+# pattern: the 16 bits of the (first) opcode word, 0 and 1 are fixed bits and
+# the letters are the bits of the fields, from the most significant bit.
+# A field named 'k' in a 32 bit instruction continues in the second word.
+# operands: how the fields are turned into operands
+#	'd', 'r'      register
+#	'd16', 'r16'  register r16-r31
+#	'd2', 'r2'    register pair (movw)
+#	'dw'          register pair r24-r30 (adiw, sbiw)
+#	'K', 'A', 'b', 's'  constant, i/o address, bit number, SREG bit
+#	'k'           relative jump (label)
+#	'kabs'        absolute jump of a 32 bit instruction (label)
+#	'kmem'        data address of a 32 bit instruction (lds, sts)
+#	'Y+q', 'Z+q'  pointer with displacement
+#	any other string is used as is (e.g. the pointers 'X', 'Y', 'Z')
+INSTRUCTION_SET = [
+	("0000000000000000", "nop", ()),
+	("00000001ddddrrrr", "movw", ("d2", "r2")),
+	("00000010ddddrrrr", "muls", ("d16", "r16")),
+	("000000110ddd0rrr", "mulsu", ("d16", "r16")),
+	("000000110ddd1rrr", "fmul", ("d16", "r16")),
+	("000000111ddd0rrr", "fmuls", ("d16", "r16")),
+	("000000111ddd1rrr", "fmulsu", ("d16", "r16")),
+	("000001rdddddrrrr", "cpc", ("d", "r")),
+	("000010rdddddrrrr", "sbc", ("d", "r")),
+	("000011rdddddrrrr", "add", ("d", "r")),
+	("000100rdddddrrrr", "cpse", ("d", "r")),
+	("000101rdddddrrrr", "cp", ("d", "r")),
+	("000110rdddddrrrr", "sub", ("d", "r")),
+	("000111rdddddrrrr", "adc", ("d", "r")),
+	("001000rdddddrrrr", "and", ("d", "r")),
+	("001001rdddddrrrr", "eor", ("d", "r")),
+	("001010rdddddrrrr", "or", ("d", "r")),
+	("001011rdddddrrrr", "mov", ("d", "r")),
+	("0011KKKKddddKKKK", "cpi", ("d16", "K")),
+	("0100KKKKddddKKKK", "sbci", ("d16", "K")),
+	("0101KKKKddddKKKK", "subi", ("d16", "K")),
+	("0110KKKKddddKKKK", "ori", ("d16", "K")),
+	("0111KKKKddddKKKK", "andi", ("d16", "K")),
+	("10q0qq0ddddd0qqq", "ldd", ("d", "Z+q")),
+	("10q0qq0ddddd1qqq", "ldd", ("d", "Y+q")),
+	("10q0qq1rrrrr0qqq", "std", ("Z+q", "r")),
+	("10q0qq1rrrrr1qqq", "std", ("Y+q", "r")),
+	("1001000ddddd0000", "lds", ("d", "kmem")),
+	("1001000ddddd0001", "ld+", ("d", "Z")),
+	("1001000ddddd0010", "ld-", ("d", "Z")),
+	("1001000ddddd0100", "lpm", ("d", "Z")),
+	("1001000ddddd0101", "lpm+", ("d", "Z")),
+	("1001000ddddd0110", "elpm", ("d", "Z")),
+	("1001000ddddd0111", "elpm+", ("d", "Z")),
+	("1001000ddddd1001", "ld+", ("d", "Y")),
+	("1001000ddddd1010", "ld-", ("d", "Y")),
+	("1001000ddddd1100", "ld", ("d", "X")),
+	("1001000ddddd1101", "ld+", ("d", "X")),
+	("1001000ddddd1110", "ld-", ("d", "X")),
+	("1001000ddddd1111", "pop", ("d",)),
+	("1001001rrrrr0000", "sts", ("kmem", "r")),
+	("1001001rrrrr0001", "st+", ("Z", "r")),
+	("1001001rrrrr0010", "st-", ("Z", "r")),
+	("1001001rrrrr0100", "xch", ("Z", "r")),
+	("1001001rrrrr0101", "las", ("Z", "r")),
+	("1001001rrrrr0110", "lac", ("Z", "r")),
+	("1001001rrrrr0111", "lat", ("Z", "r")),
+	("1001001rrrrr1001", "st+", ("Y", "r")),
+	("1001001rrrrr1010", "st-", ("Y", "r")),
+	("1001001rrrrr1100", "st", ("X", "r")),
+	("1001001rrrrr1101", "st+", ("X", "r")),
+	("1001001rrrrr1110", "st-", ("X", "r")),
+	("1001001rrrrr1111", "push", ("r",)),
+	("1001010ddddd0000", "com", ("d",)),
+	("1001010ddddd0001", "neg", ("d",)),
+	("1001010ddddd0010", "swap", ("d",)),
+	("1001010ddddd0011", "inc", ("d",)),
+	("1001010ddddd0101", "asr", ("d",)),
+	("1001010ddddd0110", "lsr", ("d",)),
+	("1001010ddddd0111", "ror", ("d",)),
+	("1001010ddddd1010", "dec", ("d",)),
+	("1001010kkkkk110k", "jmp", ("kabs",)),
+	("1001010kkkkk111k", "call", ("kabs",)),
+	("100101000sss1000", "bset", ("s",)),
+	("100101001sss1000", "bclr", ("s",)),
+	("1001010100001000", "ret", ()),
+	("1001010100011000", "reti", ()),
+	("1001010110001000", "sleep", ()),
+	("1001010110011000", "break", ()),
+	("1001010110101000", "wdr", ()),
+	("1001010111001000", "lpm", ()),
+	("1001010111011000", "elpm", ()),
+	("1001010111101000", "spm", ()),
+	("1001010111111000", "spm+", ("Z",)),
+	("1001010000001001", "ijmp", ()),
+	("1001010000011001", "eijmp", ()),
+	("1001010100001001", "icall", ()),
+	("1001010100011001", "eicall", ()),
+	("10010100KKKK1011", "des", ("K",)),
+	("10010110KKddKKKK", "adiw", ("dw", "K")),
+	("10010111KKddKKKK", "sbiw", ("dw", "K")),
+	("10011000AAAAAbbb", "cbi", ("A", "b")),
+	("10011001AAAAAbbb", "sbic", ("A", "b")),
+	("10011010AAAAAbbb", "sbi", ("A", "b")),
+	("10011011AAAAAbbb", "sbis", ("A", "b")),
+	("100111rdddddrrrr", "mul", ("d", "r")),
+	("10110AAdddddAAAA", "in", ("d", "A")),
+	("10111AArrrrrAAAA", "out", ("A", "r")),
+	("1100kkkkkkkkkkkk", "rjmp", ("k",)),
+	("1101kkkkkkkkkkkk", "rcall", ("k",)),
+	("1110KKKKddddKKKK", "ldi", ("d16", "K")),
+	("111100kkkkkkksss", "brbs", ("s", "k")),
+	("111101kkkkkkksss", "brbc", ("s", "k")),
+	("1111100ddddd0bbb", "bld", ("d", "b")),
+	("1111101ddddd0bbb", "bst", ("d", "b")),
+	("1111110rrrrr0bbb", "sbrc", ("r", "b")),
+	("1111111rrrrr0bbb", "sbrs", ("r", "b")),
+]
+
+# instructions with a second opcode word
+LONG_INSTRUCTIONS = {"lds", "sts", "jmp", "call"}
+
+# aliases used by disassemblers (and by the text parser): name -> names by SREG bit
+SREG_ALIASES = {
+	"brbs": ("brcs", "breq", "brmi", "brvs", "brlt", "brhs", "brts", "brie"),
+	"brbc": ("brcc", "brne", "brpl", "brvc", "brge", "brhc", "brtc", "brid"),
+	"bset": ("sec", "sez", "sen", "sev", "ses", "seh", "set", "sei"),
+	"bclr": ("clc", "clz", "cln", "clv", "cls", "clh", "clt", "cli"),
+}
+# instructions with the same register twice: name -> alias with one operand
+SAME_REGISTER_ALIASES = {"add": "lsl", "adc": "rol", "and": "tst", "eor": "clr"}
+
+def get_pattern_bits(pattern):
+	"""returns (mask, value, {field: [bit positions from the most significant]}) of a pattern"""
+	mask = 0
+	value = 0
+	fields = {}
+	for i in range(16):
+		position = 15 - i
+		if pattern[i] in "01":
+			mask |= 1 << position
+			value |= int(pattern[i]) << position
+		else:
+			fields.setdefault(pattern[i], []).append(position)
+	return (mask, value, fields)
+
+def build_opcode_table():
+	"""
+	build_opcode_table returns an array that gives the index in
+	INSTRUCTION_SET of every 16 bit word (-1 if it is not an instruction)
+	"""
+	words = np.arange(1 << 16, dtype=np.uint32)
+	table = np.full(1 << 16, -1, dtype=np.int16)
+	formats = [get_pattern_bits(pattern) for pattern, name, operands in INSTRUCTION_SET]
+	# the most specific pattern wins if two patterns overlap
+	order = sorted(range(len(formats)), key=lambda index: bin(formats[index][0]).count("1"))
+	for index in order:
+		mask, value = formats[index][0], formats[index][1]
+		table[(words & mask) == value] = index
+	return (table, formats)
+
+# the table is built only once
+opcode_table, opcode_formats = build_opcode_table()
+# formats with a second word and relative jumps (the last entry is for the words that are not instructions)
+long_formats = np.array([name in LONG_INSTRUCTIONS for pattern, name, operands in INSTRUCTION_SET] + [False])
+relative_formats = np.array(["k" in operands for pattern, name, operands in INSTRUCTION_SET] + [False])
+
+# extensions of the Intel HEX files (other binary files are raw images)
+INTEL_HEX_EXTENSIONS = (".hex", ".ihex", ".ihx")
+
+# kinds of keys of the decoded instructions (see avr_8_binary_parser.decode)
+KEY_LONG = 1
+KEY_RELATIVE = 2
+KEY_DATA = 3 # e.g. a truncated 32 bit instruction
+
+def extract_field(words, positions):
+	"""returns the values of a field (bit positions from the most significant) for an array of words"""
+	values = np.zeros(len(words), dtype=np.int64)
+	for position in positions:
+		values = (values << 1) | ((words >> position) & 1)
+	return values
+
+def read_intel_hex(input_file):
+	"""
+	read_intel_hex returns the bytes of the program memory
+	described by an Intel HEX file (erased bytes are 0xFF)
+	"""
+	image = bytearray()
+	base = 0
+	with open(input_file, "r") as myfile:
+		for line_number, line in enumerate(myfile, 1):
+			line = line.strip()
+			if not line:
+				continue
+			if not line.startswith(":"):
+				raise(Exception("Intel HEX: line {0} does not start with ':'".format(line_number)))
+			record = bytes.fromhex(line[1:])
+			if len(record) < 5 or len(record) != record[0] + 5:
+				raise(Exception("Intel HEX: wrong length at line {0}".format(line_number)))
+			if sum(record) & 0xFF != 0:
+				raise(Exception("Intel HEX: wrong checksum at line {0}".format(line_number)))
+			record_type = record[3]
+			data = record[4:-1]
+			if record_type == 0x00: # data
+				address = base + ((record[1] << 8) | record[2])
+				if len(image) < address + len(data):
+					image.extend(b"\xff" * (address + len(data) - len(image)))
+				image[address:address + len(data)] = data
+			elif record_type == 0x01: # end of file
+				break
+			elif record_type == 0x02: # extended segment address
+				base = int.from_bytes(data, "big") << 4
+			elif record_type == 0x04: # extended linear address
+				base = int.from_bytes(data, "big") << 16
+			# 0x03 and 0x05 (start address) have no effect on the program memory
+	return bytes(image)
+
+# classes
+
+class avr_8_binary_parser:
+	"""
+	avr_8_binary_parser decodes the program memory of a firmware
+	(Intel HEX file or raw image) into the same avr_8_ins records
+	as avr_8_parser, without going through assembly text.
+	Every opcode word is looked up in a precomputed table and the
+	fields of all the instructions of a format are extracted at once.
+	The targets of jumps, calls and branches get a label 'L_<address>'
+	(byte address in hex) that is inserted before the target.
+	"""
+
+	def __init__(self, input_file):
+		self.input_file = input_file # not cached, decoding is faster than a cache lookup
+		self.addresses = {} # byte address of an instruction -> pc
+
+	def read_image(self, input_file):
+		"""read_image returns the bytes of the program memory"""
+		if input_file.lower().endswith(INTEL_HEX_EXTENSIONS):
+			image = read_intel_hex(input_file)
+		else:
+			with open(input_file, "rb") as myfile:
+				image = myfile.read()
+		image = image.rstrip(b"\xff") # erased flash
+		if len(image) % 2:
+			image += b"\xff"
+		return image
+
+	def decode(self, image):
+		"""
+		decode returns the list of instructions of a program memory image
+		(bytes, little endian words).
+		"""
+		words = np.frombuffer(image, dtype="<u2").astype(np.int64)
+		formats = opcode_table[words]
+
+		# the second word of a 32 bit instruction is not an instruction,
+		# only the words that look like 32 bit instructions are walked through
+		is_second = np.zeros(len(words) + 1, dtype=bool)
+		previous = -2
+		for index in np.nonzero(long_formats[formats])[0].tolist():
+			if previous != index - 1:
+				is_second[index + 1] = True
+				previous = index
+		if is_second[len(words)]: # truncated 32 bit instruction
+			formats[previous] = -1
+		starts = np.nonzero(~is_second[:-1])[0]
+		start_formats = formats[starts]
+
+		# every distinct instruction is decoded once: the key is the opcode word with
+		# the second word (32 bit instructions) or the address (relative jumps)
+		next_words = np.append(words, 0)[starts + 1]
+		keys = np.where(long_formats[start_formats], (KEY_LONG << 40) | (next_words << 16),\
+						np.where(relative_formats[start_formats], (KEY_RELATIVE << 40) | (starts << 16),\
+						np.where(start_formats < 0, KEY_DATA << 40, 0))) | words[starts]
+		keys, inverse = np.unique(keys, return_inverse=True)
+		decoded, targets = self.decode_keys(keys)
+
+		# labels of the targets that are instructions
+		targets = np.array(sorted(targets), dtype=np.int64)
+		label_indexes = np.searchsorted(starts, targets)
+		found = label_indexes < len(starts)
+		found[found] = starts[label_indexes[found]] == targets[found]
+		label_indexes = label_indexes[found].tolist()
+		labels = [self.get_label(target) for target in targets[found].tolist()]
+		pcs = np.arange(len(starts)) + np.searchsorted(label_indexes, np.arange(len(starts)), side="right")
+		self.addresses = dict(zip((starts * 2).tolist(), pcs.tolist()))
+
+		instructions = [decoded[i] for i in inverse.tolist()]
+		program = []
+		previous = 0
+		for index, label in zip(label_indexes, labels):
+			program += instructions[previous:index]
+			program.append(avr_8_ins(name=LABEL, op1=label, op2="EMPTY", line=label + ":"))
+			previous = index
+		program += instructions[previous:]
+		return program
+
+	def decode_keys(self, keys):
+		"""
+		decode_keys returns the avr_8_ins of the keys (see decode) and the set
+		of the targets (word addresses), the fields of all the keys of a format
+		are extracted at once
+		"""
+		words = keys & 0xFFFF
+		payloads = (keys >> 16) & 0xFFFFFF # second word or address
+		formats = np.where((keys >> 40) == KEY_DATA, -1, opcode_table[words])
+		decoded = [None] * len(keys)
+		targets = set()
+		for format_index in np.unique(formats).tolist():
+			selected = np.nonzero(formats == format_index)[0]
+			if format_index < 0:
+				for i, word in zip(selected.tolist(), words[selected].tolist()):
+					decoded[i] = self.make_instruction(DATA_WORD, [word], ("K",))
+				continue
+			name, operand_types = INSTRUCTION_SET[format_index][1:]
+			fields = opcode_formats[format_index][2]
+			values = {field: extract_field(words[selected], positions) for field, positions in fields.items()}
+			if name in LONG_INSTRUCTIONS:
+				values["k"] = (values.get("k", 0) << 16) | payloads[selected]
+			elif "k" in values: # relative to the next instruction, signed
+				bits = len(fields["k"])
+				k = values["k"]
+				values["k"] = payloads[selected] + 1 + np.where(k >= (1 << (bits - 1)), k - (1 << bits), k)
+			if "kabs" in operand_types or "k" in operand_types:
+				targets.update(values["k"].tolist())
+			columns = [self.get_operand_column(operand_type, values, len(selected)) for operand_type in operand_types]
+			if operand_types[-1:] in (("k",), ("kabs",)): # jumps and branches: one distinct instruction per target
+				names = [SREG_ALIASES[name][sreg_bit] for sreg_bit in columns[0]] if name in SREG_ALIASES else [name] * len(selected)
+				for i, alias, label in zip(selected.tolist(), names, columns[-1]):
+					decoded[i] = avr_8_ins(name=alias, op1=label, op2="EMPTY", line=alias + " " + label)
+				continue
+			for i, ops in zip(selected.tolist(), zip(*columns) if columns else [()] * len(selected)):
+				decoded[i] = self.make_instruction(name, list(ops), operand_types)
+		return (decoded, targets)
+
+	def get_operand_column(self, operand_type, values, count):
+		"""get_operand_column returns the list of operands of a type for all the instructions of a format"""
+		if operand_type in ("d", "r", "K", "A", "b", "s", "kmem"):
+			return values[operand_type[0]].tolist()
+		if operand_type in ("d16", "r16"):
+			return (values[operand_type[0]] + 16).tolist()
+		if operand_type in ("d2", "r2"):
+			return (values[operand_type[0]] * 2).tolist()
+		if operand_type == "dw":
+			return (values["d"] * 2 + 24).tolist()
+		if operand_type in ("k", "kabs"):
+			return [self.get_label(target) for target in values["k"].tolist()]
+		if operand_type.endswith("+q"):
+			return ["{0}+{1}".format(operand_type[0], q) if q else operand_type[0] for q in values["q"].tolist()]
+		return [operand_type] * count
+
+	def make_instruction(self, name, ops, operand_types):
+		"""make_instruction returns the avr_8_ins of a decoded instruction, with the names of the text parser"""
+		texts = [self.get_operand_text(name, operand_type, op) for operand_type, op in zip(operand_types, ops)]
+		if name in ("ldd", "std") and "+" not in (ops[1] if name == "ldd" else ops[0]): # no displacement
+			name = name[:2]
+		elif name in SREG_ALIASES:
+			name = SREG_ALIASES[name][ops[0]]
+			ops, texts = ops[1:], texts[1:]
+		elif name in SAME_REGISTER_ALIASES and ops[0] == ops[1]:
+			name = SAME_REGISTER_ALIASES[name]
+			ops, texts = ops[:1], texts[:1]
+
+		line = "{0} {1}".format(name.rstrip("+-"), ", ".join(texts)).strip()
+		ops = ops + ["EMPTY"] * (2 - len(ops))
+		return avr_8_ins(name=name, op1=ops[0], op2=ops[1], line=line)
+
+	def get_label(self, word_address):
+		return "L_{0:04X}".format(word_address * 2)
+
+	def get_operand_text(self, name, operand_type, op):
+		"""get_operand_text returns the assembly text of an operand"""
+		if operand_type in ("d", "r", "d16", "r16", "d2", "r2", "dw"):
+			return "r{0}".format(op)
+		if isinstance(op, int):
+			return "0x{0:02X}".format(op)
+		if op in ("X", "Y", "Z") and name.endswith("+"):
+			return op + "+"
+		if op in ("X", "Y", "Z") and name.endswith(PRE_DECREMENT):
+			return PRE_DECREMENT + op
+		return op
+
+	def parse(self):
+		if self.input_file is None:
+			return None
+		return self.parse_file(self.input_file)
+
+	def parse_iter(self, input_file=None):
+		"""parse_iter yields the decoded instructions (the image is always decoded at once)"""
+		if input_file is None:
+			input_file = self.input_file
+		return iter(self.parse_file(input_file))
+
+	def parse_file(self, input_file):
+		"""
+		parse_file decodes an Intel HEX file or a raw image and
+		returns the list of avr_8_ins.
+		"""
+		return self.decode(self.read_image(input_file))
+
+if __name__ == "__main__":
+	import os
+	import tempfile
+	import time
+
+	# ldi r16, 0x12 / lds r1, 0x0100 / eor r1, r16 / lsl r1 / ld r2, X+ / ldd r3, Y+5 / breq .-8 / rjmp .-2 / ret
+	words = [0xE102, 0x9010, 0x0100, 0x2610, 0x0C11, 0x902D, 0x803D, 0xF3C1, 0xCFFF, 0x9508]
+	image = b"".join(word.to_bytes(2, "little") for word in words)
+	data = image[:16]
+	checksum = (-(len(data) + sum(data))) & 0xFF
+	hex_content = ":{0:02X}000000{1}{2:02X}\n".format(len(data), data.hex().upper(), checksum)
+	data = image[16:]
+	checksum = (-(len(data) + 0x10 + sum(data))) & 0xFF
+	hex_content += ":{0:02X}001000{1}{2:02X}\n:00000001FF\n".format(len(data), data.hex().upper(), checksum)
+
+	with tempfile.TemporaryDirectory() as directory:
+		hex_file = os.path.join(directory, "test.hex")
+		with open(hex_file, "w") as myfile:
+			myfile.write(hex_content)
+		eg_parser = avr_8_binary_parser(hex_file)
+		for ins in eg_parser.parse():
+			print(ins)
+		print("Addresses:", eg_parser.addresses)
+
+		bin_file = os.path.join(directory, "flash.bin")
+		with open(bin_file, "wb") as myfile:
+			myfile.write(image * (128 * 1024 // len(image)))
+		start = time.time()
+		program = avr_8_binary_parser(bin_file).parse()
+		print("128 KB image: {0} instructions in {1:.3f} s".format(len(program), time.time() - start))
@@ -0,0 +1,195 @@
+#!python3
+# avr 8 objdump listing parser
+
+import re
+from bisect import bisect_right
+from parser_avr_8 import avr_8_parser, avr_8_ins, LABEL
+
+# lines of 'avr-objdump -d' (any other line is skipped: header, sections, source code, '...')
+# 00000068 <__ctors_end>:
+symbol_line = re.compile(r"[0-9a-fA-F]+ <([^>]+)>:$")
+#   96:	80 91 00 01 	lds	r24, 0x0100	; 0x800100 <state>
+instruction_line = re.compile(r"([0-9a-fA-F]+):\t(?:[0-9a-fA-F]{2} )+[ \t]*([.a-z]+)[ \t]*([^;]*?)[ \t]*(?:;[ \t]*(.*))?$")
+# target in a comment: '0xa0 <main+0x10>'
+comment_target = re.compile(r"0x([0-9a-fA-F]+)(?: <([^>+]+)(\+0x[0-9a-fA-F]+)?>)?")
+
+# instructions whose last operand is a jump target
+ABSOLUTE_JUMPS = {"jmp", "call"}
+RELATIVE_JUMPS = {"rjmp", "rcall", "brbs", "brbc", "breq", "brne", "brcs", "brcc", "brsh", "brlo", "brmi", "brpl",\
+				  "brge", "brlt", "brhs", "brhc", "brts", "brtc", "brvs", "brvc", "brie", "brid"}
+# instructions with a data address (the second operand of lds, the first of sts)
+DATA_ADDRESS = {"lds": 1, "sts": 0}
+# data addresses are shown in the comments with the offset of the data space
+DATA_OFFSET = 0x800000
+
+# files that are parsed as listings
+OBJDUMP_EXTENSIONS = (".lss", ".lst", ".dis")
+
+def is_objdump_listing(input_file):
+	"""is_objdump_listing returns True if a file looks like an avr-objdump listing"""
+	if input_file.lower().endswith(OBJDUMP_EXTENSIONS):
+		return True
+	try:
+		with open(input_file, "r") as myfile:
+			head = myfile.read(1024)
+	except (OSError, UnicodeDecodeError):
+		return False
+	return "file format elf32-avr" in head
+
+# classes
+
+class avr_8_objdump_parser(avr_8_parser):
+	"""
+	avr_8_objdump_parser reads the listings of 'avr-objdump -d', the
+	addresses, raw bytes and comments are dropped and the instructions are
+	the same avr_8_ins as for assembly code. While the listing is read:
+	 - labels: name of a symbol -> pc of its label pseudo-instruction
+	 - addresses: byte address of an instruction -> pc
+	 - symbols: name of a data symbol -> data address (lds/sts comments),
+	   data addresses stay numeric, the symbols are only shown in the text
+	   and name addresses in the configurations (see Device.dataSymbols)
+	The targets of jumps and branches are the symbols when the comment of
+	the listing names one, otherwise a label 'L_<address>' (byte address
+	in hex) that is inserted before the target by parse_file.
+	"""
+
+	def __init__(self, input_file):
+		avr_8_parser.__init__(self, input_file) # not cached: the indexes are built while parsing
+		self.labels = {}
+		self.addresses = {}
+		self.symbols = {}
+		self.targets = {} # label of a target -> byte address
+
+	def get_target(self, name, address, operand, comment):
+		"""get_target returns the label of a jump target and its byte address"""
+		match = comment_target.match(comment) if comment else None
+		if match is not None:
+			target = int(match.group(1), 16)
+			if match.group(2) is not None and match.group(3) is None:
+				return (match.group(2), target)
+		elif name in ABSOLUTE_JUMPS:
+			target = int(operand, 0)
+		else: # '.+2' or '.-4', relative to the next instruction
+			target = address + 2 + int(operand[1:], 0)
+		return ("L_{0:04X}".format(target), target)
+
+	def get_data_symbol(self, operand, comment):
+		"""
+		get_data_symbol returns the data symbol of a comment (e.g. 'state+0x1')
+		or the operand and records the symbol in symbols,
+		the symbol is only displayed, the address stays numeric so that
+		all the accesses to a byte (lds/sts, X/Y/Z) share the same memory cell
+		"""
+		match = comment_target.match(comment) if comment else None
+		if match is None or match.group(2) is None:
+			return operand
+		offset = int(match.group(3)[1:], 16) if match.group(3) else 0
+		self.symbols[match.group(2)] = int(match.group(1), 16) - DATA_OFFSET - offset
+		return match.group(2) + (match.group(3) or "")
+
+	def parse_iter(self, input_file=None):
+		"""
+		parse_iter lazily yields the instructions of a listing,
+		the indexes are complete at the end of the listing.
+		"""
+		if input_file is None:
+			input_file = self.input_file
+		self.labels = {}
+		self.addresses = {}
+		self.symbols = {}
+		self.targets = {}
+
+		pc = 0
+		for line in self.iter_asm_lines(input_file):
+			match = instruction_line.match(line)
+			if match is None:
+				match = symbol_line.match(line)
+				if match is not None:
+					self.labels[match.group(1)] = pc
+					pc += 1
+					yield avr_8_ins(name=LABEL, op1=match.group(1), op2="EMPTY", line=match.group(1)+":")
+				continue
+
+			address = int(match.group(1), 16)
+			name = match.group(2)
+			operands = [op.strip() for op in match.group(3).split(",")] if match.group(3) else []
+			if operands and (name in RELATIVE_JUMPS or name in ABSOLUTE_JUMPS):
+				label, target = self.get_target(name, address, operands[-1], match.group(4))
+				operands[-1] = label
+				self.targets[label] = target
+			shown = operands
+			if name in DATA_ADDRESS and len(operands) == 2:
+				shown = list(operands)
+				shown[DATA_ADDRESS[name]] = self.get_data_symbol(operands[DATA_ADDRESS[name]], match.group(4))
+			text = "{0} {1}".format(name, ", ".join(shown)).strip()
+			for i in range(len(operands)):
+				if operands[i].startswith("-"): # pre-decrement, like 'X+' for the text parser
+					operands[i] = operands[i][1:]
+					name = name + "-"
+
+			self.addresses[address] = pc
+			pc += 1
+			yield self.parsed_line_to_obj([name] + operands, text)
+
+	def parse_file(self, input_file):
+		"""
+		parse_file returns the instructions of a listing with the labels
+		of the targets that are not symbols.
+		"""
+		program = list(self.parse_iter(input_file))
+
+		# one label per target that is an instruction, inserted in a single pass
+		inserted = sorted((self.addresses[target], label) for label, target in self.targets.items()\
+						  if label not in self.labels and target in self.addresses)
+		if not inserted:
+			return program
+		result = []
+		previous = 0
+		for pc, label in inserted:
+			result += program[previous:pc]
+			result.append(avr_8_ins(name=LABEL, op1=label, op2="EMPTY", line=label+":"))
+			previous = pc
+		result += program[previous:]
+
+		# the indexes follow the inserted labels
+		pcs = [pc for pc, label in inserted]
+		shift = lambda pc: pc + bisect_right(pcs, pc)
+		self.labels = {label: shift(pc) for label, pc in self.labels.items()}
+		self.labels.update({label: pc + i for i, (pc, label) in enumerate(inserted)})
+		self.addresses = {address: shift(pc) for address, pc in self.addresses.items()}
+		return result
+
+if __name__ == "__main__":
+	import os
+	import tempfile
+
+	listing = """
+test.elf:     file format elf32-avr
+
+
+Disassembly of section .text:
+
+00000000 <__vectors>:
+   0:	0c 94 34 00 	jmp	0x68	; 0x68 <main>
+	...
+
+00000068 <main>:
+  68:	80 91 00 01 	lds	r24, 0x0100	; 0x800100 <state>
+  6c:	90 91 01 01 	lds	r25, 0x0101	; 0x800101 <state+0x1>
+  70:	89 27       	eor	r24, r25
+  72:	8e 91       	ld	r24, -X
+  74:	81 83       	std	Z+1, r24	; 0x01
+  76:	01 f4       	brne	.+0      	; 0x78 <main+0x10>
+  78:	ff cf       	rjmp	.-2      	; 0x78 <main+0x10>
+  7a:	f6 cf       	rjmp	.-20     	; 0x68 <main>
+"""
+	with tempfile.TemporaryDirectory() as directory:
+		listing_file = os.path.join(directory, "test.lss")
+		with open(listing_file, "w") as myfile:
+			myfile.write(listing)
+		eg_parser = avr_8_objdump_parser(listing_file)
+		for ins in eg_parser.parse():
+			print(ins)
+		print("Labels:", eg_parser.labels)
+		print("Addresses:", eg_parser.addresses)
+		print("Symbols:", eg_parser.symbols)
@@ -0,0 +1,386 @@
+#!python3
+# avr 8 assembler preprocessor (directives, symbols, macros and includes)
+
+import os
+import re
+import ast
+
+# directives that have no effect on the simulated code (the line is dropped)
+IGNORED_DIRECTIVES = {".org", ".global", ".globl", ".extern", ".device", ".list", ".nolist", ".listmac",\
+					  ".db", ".dw", ".dd", ".dq", ".byte", ".word", ".ascii", ".asciz", ".string", ".space",\
+					  ".skip", ".align", ".balign", ".p2align", ".type", ".size", ".file", ".ident", ".exit",\
+					  ".message", ".warning", ".overlap", ".nooverlap", ".csegsize", ".eseg"}
+# directives that start a segment without code / with code
+DATA_SEGMENTS = {".dseg", ".data", ".bss", ".eseg"}
+CODE_SEGMENTS = {".cseg", ".text"}
+
+# maximal depth of nested macros and includes
+MAX_DEPTH = 64
+
+comment = re.compile(r"\s*(;|//).*$")
+identifier = re.compile(r"[A-Za-z_.][A-Za-z0-9_.]*")
+# 'label:' at the start of a line
+label_prefix = re.compile(r"([A-Za-z_.][A-Za-z0-9_.]*:)\s*(.*)$")
+# '.equ NAME = value', '.equ NAME, value', '.def NAME = r16'
+definition = re.compile(r"([A-Za-z_.][A-Za-z0-9_.]*)\s*[=,]\s*(.+)$")
+# operands that are never symbols: registers, pointers (X, X+, -X) and their halves
+plain_operand = re.compile(r"(r[0-9]+|R[0-9]+|-?[XYZxyz]\+?|[XYZxyz][HLhl])$")
+pointer_displacement = re.compile(r"([YZyz])\s*\+\s*(.+)$")
+# avrasm hexadecimal ($1F) and character ('a') constants
+dollar_hex = re.compile(r"\$([0-9A-Fa-f]+)")
+character = re.compile(r"'(.)'")
+
+# functions of the expressions
+FUNCTIONS = {
+	"low": lambda x: x & 0xFF, "lo8": lambda x: x & 0xFF, "byte1": lambda x: x & 0xFF,
+	"high": lambda x: (x >> 8) & 0xFF, "hi8": lambda x: (x >> 8) & 0xFF, "byte2": lambda x: (x >> 8) & 0xFF,
+	"byte3": lambda x: (x >> 16) & 0xFF, "hh8": lambda x: (x >> 16) & 0xFF, "byte4": lambda x: (x >> 24) & 0xFF,
+	"lwrd": lambda x: x & 0xFFFF, "hwrd": lambda x: (x >> 16) & 0xFFFF, "exp2": lambda x: 1 << x,
+}
+OPERATORS = {
+	ast.Add: lambda a, b: a + b, ast.Sub: lambda a, b: a - b, ast.Mult: lambda a, b: a * b,
+	ast.Div: lambda a, b: a // b, ast.FloorDiv: lambda a, b: a // b, ast.Mod: lambda a, b: a % b,
+	ast.LShift: lambda a, b: a << b, ast.RShift: lambda a, b: a >> b,
+	ast.BitAnd: lambda a, b: a & b, ast.BitOr: lambda a, b: a | b, ast.BitXor: lambda a, b: a ^ b,
+}
+COMPARISONS = {
+	ast.Eq: lambda a, b: a == b, ast.NotEq: lambda a, b: a != b, ast.Lt: lambda a, b: a < b,
+	ast.LtE: lambda a, b: a <= b, ast.Gt: lambda a, b: a > b, ast.GtE: lambda a, b: a >= b,
+}
+
+# expansions of the included files: (absolute path, include directories, definitions of the includer) -> (dependencies, expansion)
+# dependencies: ((path, mtime),..) of the file and of the files it includes
+include_cache = {}
+
+class avr_8_expansion:
+	"""
+	avr_8_expansion is the result of the preprocessing of a file:
+	lines of code and definitions (symbols, registers and macros)
+	"""
+
+	def __init__(self):
+		self.lines = []
+		self.symbols = {} # .equ/.set: name (lower case) -> value
+		self.registers = {} # .def: name (lower case) -> register
+		self.macros = {} # name (lower case) -> (parameters, lines)
+
+	def copy_definitions(self):
+		"""copy_definitions returns an expansion without lines with a copy of the definitions"""
+		other = avr_8_expansion()
+		other.set_definitions(self)
+		return other
+
+	def set_definitions(self, other):
+		"""set_definitions replaces the definitions by the ones of another expansion"""
+		self.symbols = dict(other.symbols)
+		self.registers = dict(other.registers)
+		self.macros = dict(other.macros)
+
+	def get_key(self):
+		"""get_key returns a hashable form of the definitions"""
+		return (frozenset(self.symbols.items()), frozenset(self.registers.items()),\
+				frozenset((name, tuple(parameters), tuple(lines)) for name, (parameters, lines) in self.macros.items()))
+
+class avr_8_preprocessor:
+	"""
+	avr_8_preprocessor turns a source file (avrasm2 or GNU as syntax)
+	into the plain lines of code of avr_8_parser: comments and
+	directives are removed, .def/.equ/.set names are replaced by
+	registers and constants (written in hex so the parser gives integers),
+	macros (@0 or \\name parameters) are expanded and included files are
+	inserted.
+	An included file is expanded with the definitions of the includer
+	(.if/.ifdef, .equ and .def can use them) and its definitions are then
+	the ones of the includer. Its expansion is cached by path, include
+	directories and incoming definitions (checked with the mtimes), so a
+	shared header is processed once per run for a given context.
+	"""
+
+	def __init__(self, include_dirs=()):
+		self.include_dirs = list(include_dirs)
+		self.dependencies = {} # path -> mtime of the files included by the last preprocessed file
+		self.hits = 0
+		self.misses = 0
+
+	def iter_lines(self, input_file):
+		"""
+		iter_lines yields the preprocessed lines of a file,
+		the file is read through a buffer and is never loaded at once
+		"""
+		self.dependencies = {}
+		expansion = avr_8_expansion()
+		with open(input_file, "r") as myfile:
+			for line in self.process_lines(myfile, expansion, os.path.dirname(input_file), 0):
+				yield line
+
+	def process_lines(self, lines, expansion, directory, depth):
+		"""process_lines yields the code of source lines and adds their definitions to expansion"""
+		if depth > MAX_DEPTH:
+			raise(Exception("Too many nested macros or includes"))
+		code = True # in a code segment
+		conditions = [] # stack of (active, a branch was taken) of .if blocks
+		macro = None # (name, parameters, lines) of the macro that is being defined
+		for line in lines:
+			if ";" in line or "/" in line:
+				line = comment.sub("", line)
+			line = line.strip()
+			if not line:
+				continue
+			if line[0] != "." and ":" not in line and macro is None and code and not expansion.macros and\
+			   (not conditions or conditions[-1][0]): # plain code (most lines)
+				yield self.substitute(line, expansion)
+				continue
+			words = line.split(None, 1)
+			directive = words[0].lower()
+			rest = words[1].strip() if len(words) > 1 else ""
+
+			if macro is not None:
+				if directive in (".endm", ".endmacro"):
+					expansion.macros[macro[0]] = (macro[1], macro[2])
+					macro = None
+				else:
+					macro[2].append(line)
+				continue
+
+			# conditional blocks
+			if directive in (".if", ".ifdef", ".ifndef"):
+				if conditions and not conditions[-1][0]:
+					conditions.append((False, True)) # inside an inactive block
+				else:
+					if directive == ".if":
+						active = bool(self.evaluate(rest, expansion))
+					else:
+						active = (rest.lower() in expansion.symbols or rest.lower() in expansion.registers) == (directive == ".ifdef")
+					conditions.append((active, active))
+				continue
+			if directive in (".elif", ".else"):
+				if not conditions:
+					raise(Exception("{0} without .if".format(directive)))
+				taken = conditions[-1][1]
+				outer = len(conditions) < 2 or conditions[-2][0]
+				active = outer and not taken and (directive == ".else" or bool(self.evaluate(rest, expansion)))
+				conditions[-1] = (active, taken or active)
+				continue
+			if directive == ".endif":
+				if not conditions:
+					raise(Exception(".endif without .if"))
+				conditions.pop()
+				continue
+			if conditions and not conditions[-1][0]:
+				continue
+
+			if directive == ".macro":
+				names = re.split(r"[\s,]+", rest)
+				macro = (names[0].lower(), [name for name in names[1:] if name], [])
+			elif directive in (".equ", ".set", ".def"):
+				match = definition.match(rest)
+				if match is None:
+					raise(Exception("Wrong definition: {0}".format(line)))
+				name, value = match.group(1).lower(), match.group(2).strip()
+				if directive == ".def":
+					expansion.registers[name] = self.resolve_operand(value, expansion)
+				else:
+					expansion.symbols[name] = self.evaluate(value, expansion)
+			elif directive == ".undef":
+				expansion.registers.pop(rest.lower(), None)
+			elif directive == ".include":
+				included = self.process_include(rest.strip("\"'<>"), directory, depth, expansion)
+				expansion.set_definitions(included)
+				for included_line in included.lines:
+					yield included_line
+			elif directive in DATA_SEGMENTS or directive == ".section" and not rest.startswith(".text"):
+				code = False
+			elif directive in CODE_SEGMENTS or directive == ".section":
+				code = True
+			elif directive in IGNORED_DIRECTIVES or not code:
+				continue
+			elif directive in expansion.macros:
+				parameters, body = expansion.macros[directive]
+				for expanded in self.process_lines(self.expand_macro(parameters, body, rest), expansion, directory, depth + 1):
+					yield expanded
+			else:
+				match = label_prefix.match(line)
+				if match is not None: # 'label:', 'label: instruction' or 'label: .directive'
+					yield match.group(1)
+					for expanded in self.process_lines([match.group(2)], expansion, directory, depth + 1):
+						yield expanded
+				elif directive.startswith("."): # unknown directive
+					continue
+				else:
+					yield self.substitute(line, expansion)
+		if macro is not None:
+			raise(Exception("Missing .endm of the macro {0}".format(macro[0])))
+
+	def process_include(self, filename, directory, depth, expansion):
+		"""
+		process_include returns the expansion of an included file with the
+		definitions of expansion (cached by path, context and mtime)
+		"""
+		for include_dir in [directory] + self.include_dirs:
+			path = os.path.abspath(os.path.join(include_dir, filename))
+			if os.path.isfile(path):
+				break
+		else:
+			raise(Exception("Included file not found: {0}".format(filename)))
+
+		key = (path, tuple(self.include_dirs), expansion.get_key())
+		cached = include_cache.get(key)
+		if cached is not None and all(os.path.getmtime(dependency) == mtime for dependency, mtime in cached[0]):
+			self.hits += 1
+			dependencies, included = cached
+		else:
+			self.misses += 1
+			outer_dependencies = self.dependencies
+			self.dependencies = {path: os.path.getmtime(path)}
+			included = expansion.copy_definitions()
+			with open(path, "r") as myfile:
+				included.lines = list(self.process_lines(myfile, included, os.path.dirname(path), depth + 1))
+			dependencies = tuple(self.dependencies.items())
+			include_cache[key] = (dependencies, included)
+			self.dependencies = outer_dependencies
+		self.dependencies.update(dependencies)
+		return included
+
+	def expand_macro(self, parameters, body, arguments):
+		"""expand_macro returns the lines of a macro with the arguments of a call"""
+		arguments = [argument.strip() for argument in arguments.split(",")] if "," in arguments or not parameters\
+					else arguments.split()
+		arguments = [argument for argument in arguments if argument]
+		lines = []
+		for line in body:
+			for i in reversed(range(len(arguments))): # @10 before @1
+				line = line.replace("@{0}".format(i), arguments[i])
+			for i in range(len(parameters)):
+				value = arguments[i] if i < len(arguments) else ""
+				line = re.sub(r"\\{0}\b".format(re.escape(parameters[i])), lambda match: value, line)
+			lines.append(line)
+		return lines
+
+	def substitute(self, line, expansion):
+		"""substitute returns a line of code where the names of registers and constants are replaced"""
+		words = line.split(None, 1)
+		if len(words) < 2 or not (expansion.symbols or expansion.registers):
+			return line
+		operands = [self.resolve_operand(operand.strip(), expansion) for operand in words[1].split(",")]
+		return "{0} {1}".format(words[0], ", ".join(operands))
+
+	def resolve_operand(self, operand, expansion):
+		"""resolve_operand returns a register name, a constant in hex or the operand itself (e.g. a label)"""
+		register = expansion.registers.get(operand.lower())
+		if register is not None:
+			return register
+		if plain_operand.match(operand):
+			return operand
+		match = pointer_displacement.match(operand)
+		if match is not None:
+			value = self.evaluate(match.group(2), expansion, None)
+			return operand if value is None else "{0}+{1}".format(match.group(1), value)
+		if not any(name.group(0).lower() in expansion.symbols or name.group(0).lower() in FUNCTIONS for name in identifier.finditer(operand)):
+			return operand # a literal or a label
+		value = self.evaluate(operand, expansion, None)
+		if value is None or value < 0:
+			return operand if value is None else str(value)
+		return "0x{0:02X}".format(value)
+
+	def evaluate(self, expression, expansion, default=False):
+		"""
+		evaluate returns the value of a constant expression, if it can not be
+		evaluated an exception is raised (or default is returned if it is not False)
+		"""
+		text = dollar_hex.sub(r"0x\1", expression)
+		text = character.sub(lambda match: str(ord(match.group(1))), text)
+		text = text.replace("&&", " and ").replace("||", " or ").replace("!=", "<>").replace("!", " not ").replace("<>", "!=")
+		try:
+			return self.evaluate_node(ast.parse(text.strip(), mode="eval").body, expansion)
+		except Exception as e:
+			if default is not False:
+				return default
+			raise(Exception("Can not evaluate '{0}': {1}".format(expression, e)))
+
+	def evaluate_node(self, node, expansion):
+		if isinstance(node, ast.Constant) and isinstance(node.value, int):
+			return node.value
+		if isinstance(node, ast.Name):
+			name = node.id.lower()
+			if name in expansion.symbols:
+				return expansion.symbols[name]
+			raise(Exception("unknown symbol {0}".format(node.id)))
+		if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+			return OPERATORS[type(node.op)](self.evaluate_node(node.left, expansion), self.evaluate_node(node.right, expansion))
+		if isinstance(node, ast.UnaryOp):
+			value = self.evaluate_node(node.operand, expansion)
+			if isinstance(node.op, ast.USub):
+				return -value
+			if isinstance(node.op, ast.UAdd):
+				return value
+			if isinstance(node.op, ast.Invert):
+				return ~value
+			if isinstance(node.op, ast.Not):
+				return int(not value)
+		if isinstance(node, ast.BoolOp):
+			values = [self.evaluate_node(value, expansion) for value in node.values]
+			return int(all(values) if isinstance(node.op, ast.And) else any(values))
+		if isinstance(node, ast.Compare) and all(type(op) in COMPARISONS for op in node.ops):
+			left = self.evaluate_node(node.left, expansion)
+			for op, comparator in zip(node.ops, node.comparators):
+				right = self.evaluate_node(comparator, expansion)
+				if not COMPARISONS[type(op)](left, right):
+					return 0
+				left = right
+			return 1
+		if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id.lower() in FUNCTIONS and len(node.args) == 1:
+			return FUNCTIONS[node.func.id.lower()](self.evaluate_node(node.args[0], expansion))
+		raise(Exception("unsupported expression"))
+
+if __name__ == "__main__":
+	import tempfile
+
+	header = """
+; shared definitions
+.ifndef SIZE
+.equ SIZE = 16
+.endif
+.equ MASK_ADDR = $0100
+.def temp = r16
+.macro LOAD16 ; @0:@1 <- @2
+	lds @1, low(@2)
+	lds @0, @2+1
+.endm
+"""
+	source = """
+.include "defs.inc"
+.equ OFFSET, SIZE / 4
+.macro xor_into dst, src
+	eor \\dst, \\src   // GNU as parameters
+.endm
+.dseg
+buffer: .byte SIZE
+.cseg
+start:	ldi temp, SIZE-1 ; comment
+	LOAD16 r25, r24, MASK_ADDR
+	xor_into r24, temp
+	ldd r0, Y+OFFSET
+.if SIZE > 8
+	ldi r17, high(MASK_ADDR)
+.else
+	ldi r17, 0
+.endif
+	ret
+"""
+	with tempfile.TemporaryDirectory() as directory:
+		with open(os.path.join(directory, "defs.inc"), "w") as myfile:
+			myfile.write(header)
+		with open(os.path.join(directory, "test.s"), "w") as myfile:
+			myfile.write(source)
+		preprocessor = avr_8_preprocessor()
+		for i in range(3): # the header is processed once
+			lines = list(preprocessor.iter_lines(os.path.join(directory, "test.s")))
+		for line in lines:
+			print(line)
+		print("Include cache hits: {0}, misses: {1}".format(preprocessor.hits, preprocessor.misses))
+
+		# the header sees the definitions of the includer
+		with open(os.path.join(directory, "small.s"), "w") as myfile:
+			myfile.write(".equ SIZE = 4\n" + source)
+		print("With SIZE = 4:", [line for line in preprocessor.iter_lines(os.path.join(directory, "small.s")) if line.startswith("ldi")])
+		print("Include cache hits: {0}, misses: {1}".format(preprocessor.hits, preprocessor.misses))
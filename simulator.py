@@ -5,6 +5,8 @@ __author__ = "Nikita Veshchikov"
 
 
 import sys
+import os
+import glob
 
 # in order to be able to import code from another directory
 sys.path.append("./device/")
@@ -14,6 +16,8 @@ sys.path.append("./config_file/")
 from parser_avr_8 import *
 from device import *
 from config import Configuration
+from parse_cache import parse_cache, DEFAULT_CACHE_DIR
+from analysis import *
 
 def printProgram(program, fullObject=False):
 	for line in program:
@@ -22,35 +26,123 @@ def printProgram(program, fullObject=False):
 		else:
 			print(line.line)
 
-if len(sys.argv) < 3:
-	print("Error! Missing argument: filename")
-	print("Usage: python3", sys.argv[0], "<filename asm> <filename config>")
-	exit(-1)
+def printUsage():
+	print("Usage: python3", sys.argv[0], "<filename asm> <filename config> [<filename config> ...] [--stream] [--jobs=N]")
+	print("       python3", sys.argv[0], "<directory or glob> <filename config> [--jobs=N]")
+	print("\t<filename asm> can also be an avr-objdump -d listing or a firmware image: Intel HEX (.hex) or raw binary (.bin)")
+	print("\t--stream: the program is parsed while it is simulated (it is never stored)")
+	print("\t--cache[=DIR]: parsed assembly files are cached on disk (default directory: " + DEFAULT_CACHE_DIR + ")")
+	print("\t--transitions: values that follow each other on the load/store bus are checked (transition leakage)")
+	print("\t--order-aware[=N]: a mask leaks only when N of its shares are combined (default: all the shares, see mask_shares and leakage_threshold in config_file/config_order_aware.yaml)")
+	print("\t--trace=FILE: every state change is recorded in a binary trace file (see device/traceFile.py)")
+	print("\t--incremental[=FILE]: only the changes since the previous run are simulated (default session: <filename asm>.session)")
+	print("\twith several configurations or files only a summary of the findings is printed (batch mode)")
+	print("\t--jobs=N: number of processes used in batch mode")
 
+def simulate(filenameCode, filenameConfig, stream=False, cache=None, filenameTrace=None, deviceOptions={}):
+	# Parsing the input
+	if stream:
+		parser = get_parser(filenameCode, cache)
+		program = []
+	else:
+		program, deviceOptions = parseProgram(filenameCode, cache, deviceOptions)
 
-# Parsing the input
-filenameCode = sys.argv[1]
-filenameConfig = sys.argv[2]
-parser = avr_8_parser(filenameCode)
-program = parser.parse()
+	# TODO: config file
+	config = Configuration(filenameConfig)
 
-# TODO: config file
-config = Configuration(filenameConfig) 
+	#exit(0)
 
-randAdr = config.get_rand_list_of_addr()
-maskAdr = config.get_mask_list_of_addr()
+	# initialize the device
+	device = createDevice(program, deviceOptions)
+	device.loadConfiguration(config)
+	print("-------- Initial state --------")
+	if not stream:
+		print("Code")
+		device.printProgram()
+	print("Memory")
+	device.printMemory()
 
-#exit(0)
+	if filenameTrace is not None:
+		device.startTrace(filenameTrace)
+	if stream:
+		device.runProgram(parser.parse_iter())
+	else:
+		device.runProgram()
+	if filenameTrace is not None:
+		device.stopTrace()
+	print("Findings")
+	device.printFindings()
+	print("End")
+	device.printRegisters()
 
-# initialize the device
-device = Device()
-device.loadProgram(program, {CONF_RND:randAdr, CONF_MASK:maskAdr})
-print("-------- Initial state --------")
-print("Code")
-device.printProgram()
-print("Memory")
-device.printMemory()
+def simulateIncremental(filenameCode, filenameConfig, filenameSession, cache=None, deviceOptions={}):
+	program, deviceOptions = parseProgram(filenameCode, cache, deviceOptions)
+	device, start, converged = analyseIncremental(program, filenameConfig, filenameSession, options=deviceOptions)
+	if converged is None:
+		print("Simulated from line {0} to the end".format(start))
+	else:
+		print("Simulated from line {0} to line {1} (same state as the previous run)".format(start, converged))
+	print("Findings")
+	device.printFindings()
+	print("End")
+	device.printRegisters()
 
-device.runProgram()
-print("End")
-device.printRegisters()
+def simulateBatch(filenameCode, filenamesConfig, processes=1, cache=None, deviceOptions={}):
+	# the program is parsed and compiled only once
+	program, deviceOptions = parseProgram(filenameCode, cache, deviceOptions)
+	results = analyseConfigurations(program, filenamesConfig, processes, deviceOptions)
+	print(getSummaryStr(results))
+	print("Findings per line")
+	print(getFindingsMatrixStr(results, program))
+
+def simulateFiles(path, filenameConfig, processes=1, cache=None, deviceOptions={}):
+	filenamesCode = getAsmFiles(path)
+	if len(filenamesCode) == 0:
+		print("Error! No assembly file found:", path)
+		exit(-1)
+	results = analyseFiles(filenamesCode, filenameConfig, processes, cache, deviceOptions)
+	print(getSummaryStr(results, "file"))
+
+if __name__ == "__main__":
+	arguments = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	options = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+
+	if len(arguments) < 2:
+		print("Error! Missing argument: filename")
+		printUsage()
+		exit(-1)
+
+	processes = 1
+	cache = None
+	filenameSession = None
+	filenameTrace = None
+	deviceOptions = {}
+	for option in options:
+		if option.startswith("--jobs="):
+			processes = int(option[len("--jobs="):])
+		elif option == "--cache":
+			cache = parse_cache()
+		elif option.startswith("--cache="):
+			cache = parse_cache(option[len("--cache="):])
+		elif option == "--transitions":
+			deviceOptions["transitionWarning"] = True
+		elif option == "--order-aware":
+			deviceOptions["orderAware"] = True
+		elif option.startswith("--order-aware="):
+			deviceOptions["orderAware"] = True
+			deviceOptions["shareThreshold"] = int(option[len("--order-aware="):])
+		elif option.startswith("--trace="):
+			filenameTrace = option[len("--trace="):]
+		elif option == "--incremental":
+			filenameSession = arguments[0] + ".session"
+		elif option.startswith("--incremental="):
+			filenameSession = option[len("--incremental="):]
+
+	if os.path.isdir(arguments[0]) or glob.has_magic(arguments[0]):
+		simulateFiles(arguments[0], arguments[1], processes, cache, deviceOptions)
+	elif len(arguments) > 2:
+		simulateBatch(arguments[0], arguments[1:], processes, cache, deviceOptions)
+	elif filenameSession is not None:
+		simulateIncremental(arguments[0], arguments[1], filenameSession, cache, deviceOptions)
+	else:
+		simulate(arguments[0], arguments[1], "--stream" in options, cache, filenameTrace, deviceOptions)